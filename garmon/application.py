@@ -31,6 +31,7 @@ from gobject import GObject
 import gtk
 import locale
 import os
+import time
 from optparse import OptionParser
 
 import garmon
@@ -39,10 +40,19 @@ from garmon.logger import log
 from garmon.preferences import PreferenceManager
 from garmon.plugin_manager import PluginManager
 from garmon.device import ELMDevice, OBDError, OBDDataError, OBDPortError
-from garmon.command_queue import CommandQueue, QueueTimer
+from garmon.command_queue import CommandQueue, QueueStatus
+from garmon.pipeline_stats import PipelineStats
+from garmon.recorder import Recorder
+from garmon.widgets import PipelineStatsDialog
 from garmon.utils import PropertyObject, gproperty, gsignal
 from garmon.backdoor import BackDoor
 
+# seconds between automatic reconnects, doubled after every failure
+RECONNECT_MIN = 0.25
+RECONNECT_MAX = 30
+# how long an opened port gets to connect before we try again
+CONNECT_TIMEOUT = 15
+
 GTK_RECOMMENDED = (2,16,0)
 GTK_VERSION = gtk.ver
 if GTK_VERSION < GTK_RECOMMENDED:
@@ -63,12 +73,14 @@ ui_info = \
     <menu action='DeviceMenu'>
       <menuitem action='Reset'/>
       <menuitem action='Monitor'/>
+      <menuitem action='Record'/>
       <separator/>
     <placeholder name='DeviceMenuItems'/>
     </menu>
     <menu action='ViewMenu'>
       <menuitem action='FullScreen'/>
       <menuitem action='PythonShell'/>
+      <menuitem action='Timing'/>
     </menu>    
     <menu action='HelpMenu'>
       <menuitem action='About'/>
@@ -114,6 +126,14 @@ class GarmonApp(gobject.GObject, PropertyObject):
         self._setup_prefs()
         
         self._backdoor = None
+        self._timing_dialog = None
+        self.recorder = None
+        self._reconnect_id = None
+        self._reconnect_delay = RECONNECT_MIN
+        self._resume_monitor = False
+        
+        # times every command on its way through the queue and device
+        self.stats = PipelineStats()
         
         self.window.connect('delete-event', self._window_delete_event_cb)
         
@@ -151,15 +171,17 @@ class GarmonApp(gobject.GObject, PropertyObject):
         
         self.device = ELMDevice(self)
         self.device.connect('connected', self._device_connected_cb)
+        self.device.connect('connection-lost', 
+                            self._device_connection_lost_cb)
         self._device_connected_cb (self.device, self.device.connected)
         
-        self.queue = CommandQueue(self.device)
+        self.queue = CommandQueue(self.device, self.stats)
         self.queue.connect('state_changed', self._queue_state_changed_cb)
         
         self._statusbar = gtk.Statusbar()    
         self.main_vbox.pack_end(self._statusbar, False, False)    
-        timer = QueueTimer(self.queue)
-        self._statusbar.pack_start(timer)
+        status = QueueStatus(self.queue)
+        self._statusbar.pack_start(status)
         
         self._plugman = PluginManager(self)
         if self.prefs.get('plugins.start'):
@@ -215,7 +237,11 @@ class GarmonApp(gobject.GObject, PropertyObject):
                 _("Plugin Manager"), self._activate_plugin_dialog ),
             ( "Reset", gtk.STOCK_REFRESH,
                 _("_Reset"), "<control>R",
-                _("Reset Device"), self._activate_reset )
+                _("Reset Device"), self._activate_reset ),
+            ( "Timing", None,
+                _("Command _Timing"), "",
+                _("Show where the time per command goes"), 
+                self._activate_timing_dialog )
             );
         
         # GtkToggleActionEntry
@@ -224,6 +250,11 @@ class GarmonApp(gobject.GObject, PropertyObject):
                 _("_Monitor"), "<control>M",
                 _("Monitoring"), self._activate_monitor,
                 False ),
+            ( "Record", gtk.STOCK_MEDIA_RECORD,
+                _("R_ecord"), "",
+                _("Record the monitored data to a file"), 
+                self._activate_record,
+                False ),
             ( "FullScreen", gtk.STOCK_FULLSCREEN,
                 _("_Full Screen"), "F11",
                 _("Full Screen"), self._toggle_fullscreen,
@@ -259,6 +290,12 @@ class GarmonApp(gobject.GObject, PropertyObject):
         self._plugman.hide()
         
 
+    def _activate_timing_dialog(self, action):
+        if not self._timing_dialog:
+            self._timing_dialog = PipelineStatsDialog(self.stats, self.window)
+        self._timing_dialog.show_all()
+        
+
     def _activate_about(self, action):
 
         dialog = gtk.AboutDialog()
@@ -288,6 +325,8 @@ class GarmonApp(gobject.GObject, PropertyObject):
             if self.prefs.get('plugins.save'):
                 self._plugman.save_active_plugins()
             #TODO: Clean things up
+            self._stop_recording()
+            self.queue.triggers.close()
             self.prefs.save()
             gtk.main_quit()
         dialog.destroy()
@@ -299,6 +338,38 @@ class GarmonApp(gobject.GObject, PropertyObject):
         elif self.queue.working :
             self.queue.stop()
     
+    def _activate_record(self, action):
+        if action.get_active():
+            if self.recorder:
+                return
+            dialog = gtk.FileChooserDialog(_('Record to'), self.window,
+                                    gtk.FILE_CHOOSER_ACTION_SAVE,
+                                    (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+                                     gtk.STOCK_SAVE, gtk.RESPONSE_OK))
+            dialog.set_do_overwrite_confirmation(True)
+            dialog.set_current_name(time.strftime('garmon-%Y%m%d-%H%M%S.log'))
+            res = dialog.run()
+            filename = dialog.get_filename()
+            dialog.destroy()
+            if res != gtk.RESPONSE_OK or not filename:
+                action.set_active(False)
+                return
+            try:
+                self.recorder = Recorder(filename)
+            except IOError, e:
+                log.error('could not record to %s: %s' % (filename, e))
+                action.set_active(False)
+                return
+            self.queue.recorder = self.recorder
+        else:
+            self._stop_recording()
+            
+    def _stop_recording(self):
+        if self.recorder:
+            self.queue.recorder = None
+            self.recorder.close()
+            self.recorder = None
+    
     def _queue_state_changed_cb(self, queue, working):
         self.ui.get_widget('/ToolBar/Monitor').set_active(working)
         self.ui.get_widget('/MenuBar/DeviceMenu/Monitor').set_active(working)
@@ -306,6 +377,48 @@ class GarmonApp(gobject.GObject, PropertyObject):
     def _device_connected_cb(self, device, connected):
         self.ui.get_widget('/ToolBar/Monitor').set_sensitive(connected)
         self.ui.get_widget('/MenuBar/DeviceMenu/Monitor').set_sensitive(connected)
+        if connected:
+            self._cancel_reconnect()
+            self._reconnect_delay = RECONNECT_MIN
+            if self._resume_monitor:
+                self._resume_monitor = False
+                self.queue.start()
+                
+    def _device_connection_lost_cb(self, device):
+        log.warning('lost the connection to the device, reconnecting')
+        # the queue stops when the device closes
+        self._resume_monitor = self._resume_monitor or self.queue.working
+        self._schedule_reconnect()
+        
+    def _schedule_reconnect(self, delay=None):
+        if delay is None:
+            delay = self._reconnect_delay
+        if self._reconnect_id is None:
+            self._reconnect_id = gobject.timeout_add(int(delay * 1000), 
+                                                     self._reconnect_cb)
+                        
+    def _cancel_reconnect(self):
+        if self._reconnect_id is not None:
+            gobject.source_remove(self._reconnect_id)
+            self._reconnect_id = None
+        
+    def _reconnect_cb(self):
+        self._reconnect_id = None
+        # a previous attempt may have opened the port without
+        # getting the adapter to answer
+        self.device.close()
+        self._reconnect_delay = min(self._reconnect_delay * 2, RECONNECT_MAX)
+        try:
+            self.device.open(warm=True)
+        except OBDPortError, e:
+            log.info('reconnect failed: %s, retrying in %gs' % 
+                     (e[1], self._reconnect_delay))
+            self._schedule_reconnect()
+        else:
+            # try again if the adapter does not get connected
+            self._schedule_reconnect(max(CONNECT_TIMEOUT, 
+                                         self._reconnect_delay))
+        return False
 
     def _window_delete_event_cb(self, window, event):
         self._activate_quit()
@@ -338,13 +451,15 @@ class GarmonApp(gobject.GObject, PropertyObject):
     def reset(self):
         """This methods stops all stoppable plugins, closes the obd device
            and tries to reopen it."""
+        self._cancel_reconnect()
+        self._resume_monitor = False
         if self.device.connected:
             for name, plugin in self._plugman.plugins:
                 plugin.stop()
             self.device.close()
 
         try:
-            self.device.open()
+            self.device.open(warm=True)
         except OBDPortError, e:
             err, msg = e
             dialog = gtk.MessageDialog(self.window, gtk.DIALOG_DESTROY_WITH_PARENT,
@@ -378,7 +493,11 @@ def main():
 
     garmon.logger.set_level(level)
 
+    # the preferences are saved and the log is written
+    # from separate threads
+    gobject.threads_init()
     GarmonApp()
     gtk.main()
+    garmon.logger.shutdown()
 
 
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+#
+# batch_decode.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+"""Decoding of whole columns of recorded data with numpy, for the
+   analysis of long recordings. The decoders in sensor.py take one
+   hex string at a time, which is fine live but far too slow for
+   millions of results. numpy is optional, without it available()
+   returns False and the functions here raise ImportError.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import binascii
+
+from garmon import blocks
+from garmon.recorder import PACKED
+
+
+(START, LENGTH, SCALE, OFFSET, IMPERIAL_SCALE, IMPERIAL_OFFSET,
+ INVALID) = range(7)
+
+_PERCENT = (0, 1, 100 / 255.0, 0, 1, 0, None)
+_FUEL_TRIM = (0, 1, 0.78125, -100, 1, 0, None)
+_TEMP = (0, 1, 1, -40, 1.8, 32, None)
+_O2_VOLTAGE = (0, 1, 0.005, 0, 1, 0, None)
+# 255 means the sensor is not used for the fuel trim
+_O2_FUEL_TRIM = (1, 1, 0.78125, -100, 1, 0, 255)
+
+# The formulas of the numeric values of sensor.SENSORS, per pid a tuple
+# per index: metric = (data bytes START to START + LENGTH as a number)
+# * SCALE + OFFSET, imperial = metric * IMPERIAL_SCALE + IMPERIAL_OFFSET.
+# Data equal to INVALID decodes as nan. Unlike the decoders in
+# sensor.py nothing is rounded.
+FORMULAS = {#  pid     start  len  scale     offset  imperial         invalid
+            "04": (_PERCENT,),
+            "05": (_TEMP,),
+            "06": (_FUEL_TRIM,),
+            "07": (_FUEL_TRIM,),
+            "08": (_FUEL_TRIM,),
+            "09": (_FUEL_TRIM,),
+            "0A": ((0,     1,   3,        0,      0.14504, 0,      None),),
+            "0B": ((0,     1,   1,        0,      0.14504, 0,      None),),
+            "0C": ((0,     2,   0.25,     0,      1,       0,      None),),
+            "0D": ((0,     1,   1,        0,      0.621,   0,      None),),
+            "0E": ((0,     1,   0.5,      -64,    1,       0,      None),),
+            "0F": (_TEMP,),
+            "10": ((0,     2,   0.01,     0,      0.1323,  0,      None),),
+            "11": (_PERCENT,),
+            "14": (_O2_VOLTAGE, _O2_FUEL_TRIM),
+            "15": (_O2_VOLTAGE, _O2_FUEL_TRIM),
+            "16": (_O2_VOLTAGE, _O2_FUEL_TRIM),
+            "17": (_O2_VOLTAGE, _O2_FUEL_TRIM),
+            "18": (_O2_VOLTAGE, _O2_FUEL_TRIM),
+            "19": (_O2_VOLTAGE, _O2_FUEL_TRIM),
+            "1A": (_O2_VOLTAGE, _O2_FUEL_TRIM),
+            "1B": (_O2_VOLTAGE, _O2_FUEL_TRIM),
+            "1F": ((0,     2,   1 / 60.0, 0,      1,       0,      None),),
+            "2C": (_PERCENT,),
+            "2D": (_FUEL_TRIM,),
+}
+
+
+def available():
+    return numpy is not None
+
+
+def _check():
+    if numpy is None:
+        raise ImportError, 'batch decoding needs numpy'
+
+
+def decode_varints(data):
+    """Returns the unsigned varints of data as a numpy uint64 array,
+       all of them at once instead of a byte at a time.
+    """
+    _check()
+    buf = numpy.frombuffer(data, dtype=numpy.uint8)
+    if not len(buf):
+        return numpy.zeros(0, dtype=numpy.uint64)
+    # the last byte of each varint has the high bit cleared
+    ends = numpy.flatnonzero(buf < 0x80)
+    starts = numpy.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    # the position of each byte within its varint
+    shift = numpy.arange(len(buf)) - numpy.repeat(starts, ends - starts + 1)
+    parts = (buf & 0x7F).astype(numpy.uint64) << \
+            (shift * 7).astype(numpy.uint64)
+    return numpy.add.reduceat(parts, starts)
+
+
+def _unzigzag(n):
+    return (n >> numpy.uint64(1)).astype(numpy.int64) ^ \
+           -(n & numpy.uint64(1)).astype(numpy.int64)
+
+
+def decode_column(buf, start, column):
+    """numpy version of blocks.decode_column for NUMBER columns: returns
+       the ticks and the data read as numbers, both int64 arrays.
+    """
+    command, ecu, count, kind, width, pos, length = column
+    if kind != blocks.NUMBER:
+        raise ValueError, 'column of %s is not numeric' % command
+    varints = decode_varints(buffer(buf, pos, length))
+    ticks = numpy.cumsum(varints[:count].astype(numpy.int64)) + start
+    values = numpy.cumsum(_unzigzag(varints[count:2 * count]))
+    return ticks, values
+
+
+def payload_numbers(payloads, width):
+    """Returns a list of byte strings, e.g. from Recording.payloads,
+       as an int64 array of the first width bytes read as a number.
+       Shorter ones are -1.
+    """
+    _check()
+    n = len(payloads)
+    data = ''.join(payloads)
+    short = None
+    if len(data) != n * width:
+        short = numpy.array([len(p) < width for p in payloads], dtype=bool)
+        data = ''.join([p[:width].ljust(width, '\0') for p in payloads])
+    matrix = numpy.frombuffer(data, dtype=numpy.uint8).reshape(n, width)
+    ret = numpy.zeros(n, dtype=numpy.int64)
+    for i in range(width):
+        ret = (ret << 8) | matrix[:, i]
+    if short is not None:
+        ret[short] = -1
+    return ret
+
+
+def _payloads(datas):
+    ret = []
+    for data in datas:
+        try:
+            ret.append(binascii.unhexlify(data))
+        except TypeError:
+            # not hex, decodes as nan
+            ret.append('')
+    return ret
+
+
+def decode(pid, values, width, index=0):
+    """Applies the formula of pid to a column of data.
+       Returns the metric and the imperial values as float64 arrays,
+       nan where the data is missing or invalid.
+       @param pid: e.g. '0C'
+       @param values: the data bytes of each result as a number, as
+                      returned by decode_column or payload_numbers
+       @param width: the number of data bytes per result
+    """
+    _check()
+    start, length, scale, offset, imperial_scale, imperial_offset, \
+        invalid = FORMULAS[pid][index]
+    if start + length > width:
+        raise ValueError, '%s needs %d data bytes, not %d' % (
+                                pid, start + length, width)
+    shift = 8 * (width - start - length)
+    raw = (values >> shift) & ((1 << 8 * length) - 1)
+    metric = raw * float(scale) + offset
+    missing = values < 0
+    if invalid is not None:
+        missing |= raw == invalid
+    metric[missing] = numpy.nan
+    imperial = metric * imperial_scale + imperial_offset
+    return metric, imperial
+
+
+def decode_recording(recording, command, ecu=None, index=0, start=None,
+                     end=None):
+    """Returns the times and the metric and imperial values of a mode
+       01 command in a Recording as float64 arrays. Packed numeric
+       columns are decoded without python loops over the results.
+    """
+    _check()
+    pid = command[2:4]
+    times = []
+    metric = []
+    imperial = []
+    if recording.version == PACKED:
+        for buf, first, column in recording.columns(command, ecu, start,
+                                                    end):
+            # wider numbers don't fit in an int64
+            if column[3] == blocks.NUMBER and column[4] < 8:
+                ticks, values = decode_column(buf, first, column)
+                width = column[4]
+                ticks = ticks / float(blocks.TICKS)
+            else:
+                ticks, values = blocks.decode_column(buf, first, column)
+                ticks = numpy.array(ticks) / float(blocks.TICKS)
+                values = _payloads(blocks.column_data(column, values))
+                width = FORMULAS[pid][index][START] + \
+                        FORMULAS[pid][index][LENGTH]
+                values = payload_numbers(values, width)
+            m, i = decode(pid, values, width, index)
+            times.append(ticks)
+            metric.append(m)
+            imperial.append(i)
+    else:
+        t, payloads = recording.payloads(command, ecu, start, end)
+        width = FORMULAS[pid][index][START] + FORMULAS[pid][index][LENGTH]
+        m, i = decode(pid, payload_numbers(payloads, width), width, index)
+        times.append(numpy.array(t, dtype=numpy.float64))
+        metric.append(m)
+        imperial.append(i)
+
+    if not times:
+        empty = numpy.zeros(0)
+        return empty, empty, empty
+    times = numpy.concatenate(times)
+    metric = numpy.concatenate(metric)
+    imperial = numpy.concatenate(imperial)
+    first = 0
+    last = len(times)
+    if start is not None:
+        first = numpy.searchsorted(times, start)
+    if end is not None:
+        last = numpy.searchsorted(times, end)
+    return times[first:last], metric[first:last], imperial[first:last]
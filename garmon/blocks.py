@@ -0,0 +1,265 @@
+#!/usr/bin/python
+#
+# blocks.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+"""The packed blocks of a recording.
+
+   A block holds a column per (command, ecu): the times and the data
+   bytes of its results. Times are in ticks since the start of the
+   recording, values are the data read as one big endian number. Both
+   are stored as the difference with the previous one, zigzag and
+   varint encoded, so a slowly changing sensor takes a few bytes per
+   result instead of a line of text.
+
+   body:   varint start, varint end - start, varint columns,
+           a column header per column, then the column data
+   header: string command, string ecu, varint count, byte kind,
+           varint width, varint length of the data
+   data:   count time differences, the first one from start, then
+           for NUMBER count value differences, for RAW count strings
+"""
+
+import binascii
+
+
+# ticks per second of the times
+TICKS = 10000
+
+# the kinds of column
+NUMBER = 0
+RAW = 1
+
+_HEX = frozenset('0123456789ABCDEF')
+
+
+def put_varint(out, n):
+    """Appends unsigned n to bytearray out"""
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def get_varint(buf, pos):
+    """Returns the unsigned number at pos of bytearray buf and the
+       position after it."""
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def zigzag(n):
+    if n < 0:
+        return -2 * n - 1
+    return 2 * n
+
+
+def unzigzag(n):
+    if n & 1:
+        return -(n + 1) >> 1
+    return n >> 1
+
+
+def _put_string(out, s):
+    put_varint(out, len(s))
+    out.extend(s)
+
+
+def _get_string(buf, pos):
+    n, pos = get_varint(buf, pos)
+    return str(buf[pos:pos + n]), pos + n
+
+
+
+class Column(object):
+    """The results of one command and ecu in a block, while it is
+       being written."""
+
+    __slots__ = ('command', 'ecu', 'ticks', 'data')
+
+    def __init__(self, command, ecu):
+        self.command = command
+        self.ecu = ecu
+        # a list, the ticks of a recording of a few days don't fit
+        # in an array('l') on 32 bit platforms
+        self.ticks = []
+        self.data = []
+
+
+    def add(self, tick, data):
+        self.ticks.append(tick)
+        self.data.append(data)
+
+
+    def encode(self, start):
+        """Returns (kind, width, encoded data)"""
+        out = bytearray()
+        last = start
+        for tick in self.ticks:
+            put_varint(out, tick - last)
+            last = tick
+
+        length = len(self.data[0])
+        number = not length & 1
+        for data in self.data:
+            if len(data) != length or not _HEX.issuperset(data):
+                number = False
+                break
+        if number:
+            last = 0
+            for data in self.data:
+                value = int(data, 16)
+                put_varint(out, zigzag(value - last))
+                last = value
+            return NUMBER, length / 2, out
+        for data in self.data:
+            _put_string(out, data)
+        return RAW, 0, out
+
+
+
+def encode_block(columns):
+    """Returns the body of a block of Columns"""
+    start = min([column.ticks[0] for column in columns])
+    end = max([column.ticks[-1] for column in columns])
+    out = bytearray()
+    put_varint(out, start)
+    put_varint(out, end - start)
+    put_varint(out, len(columns))
+    encoded = []
+    for column in columns:
+        kind, width, data = column.encode(start)
+        _put_string(out, column.command)
+        _put_string(out, column.ecu or '')
+        put_varint(out, len(column.ticks))
+        out.append(kind)
+        put_varint(out, width)
+        put_varint(out, len(data))
+        encoded.append(data)
+    for data in encoded:
+        out.extend(data)
+    return str(out)
+
+
+def read_header(buf):
+    """Returns the start and end tick of a block and a (command, ecu,
+       count, kind, width, offset, length) tuple per column.
+       @param buf: the body as a bytearray
+    """
+    start, pos = get_varint(buf, 0)
+    end, pos = get_varint(buf, pos)
+    n, pos = get_varint(buf, pos)
+    columns = []
+    for i in xrange(n):
+        command, pos = _get_string(buf, pos)
+        ecu, pos = _get_string(buf, pos)
+        count, pos = get_varint(buf, pos)
+        kind = buf[pos]
+        width, pos = get_varint(buf, pos + 1)
+        length, pos = get_varint(buf, pos)
+        columns.append([command, ecu or None, count, kind, width, length])
+    for column in columns:
+        length = column[-1]
+        column[-1:] = [pos, length]
+        pos += length
+    return start, start + end, [tuple(column) for column in columns]
+
+
+def decode_column(buf, start, column):
+    """Returns the ticks of a column and its values as lists, the
+       values being numbers for NUMBER columns, strings for RAW ones.
+       @param column: a tuple from read_header
+    """
+    command, ecu, count, kind, width, pos, length = column
+    ticks = []
+    tick = start
+    for i in xrange(count):
+        delta, pos = get_varint(buf, pos)
+        tick += delta
+        ticks.append(tick)
+    values = []
+    if kind == NUMBER:
+        value = 0
+        for i in xrange(count):
+            delta, pos = get_varint(buf, pos)
+            value += unzigzag(delta)
+            values.append(value)
+    else:
+        for i in xrange(count):
+            data, pos = _get_string(buf, pos)
+            values.append(data)
+    return ticks, values
+
+
+def column_data(column, values):
+    """Returns the values of decode_column as the hex strings they
+       were recorded as."""
+    if column[3] == RAW:
+        return values
+    fmt = '%%0%dX' % (column[4] * 2)
+    return [fmt % value for value in values]
+
+
+def payload(data):
+    """Returns the data of a result as a byte string. Data that isn't
+       hex, like the answer to atrv, is returned as it is.
+    """
+    if len(data) & 1 or not _HEX.issuperset(data):
+        return data
+    return binascii.unhexlify(data)
+
+
+def column_payloads(column, values):
+    """Returns the values of decode_column as byte strings, see
+       payload"""
+    if column[3] == RAW:
+        return [payload(data) for data in values]
+    fmt = '%%0%dX' % (column[4] * 2)
+    return [binascii.unhexlify(fmt % value) for value in values]
+
+
+def decode_block(body, commands=None):
+    """Returns the (time, command, ecu, data) tuples of a block in
+       time order, of commands only if given. The columns of other
+       commands are not decoded.
+    """
+    buf = bytearray(body)
+    start, end, columns = read_header(buf)
+    ret = []
+    for column in columns:
+        command, ecu = column[:2]
+        if commands is not None and not command in commands:
+            continue
+        ticks, values = decode_column(buf, start, column)
+        ret.extend([(float(tick) / TICKS, command, ecu, data)
+                    for tick, data in zip(ticks,
+                                          column_data(column, values))])
+    ret.sort()
+    return ret
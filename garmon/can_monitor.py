@@ -0,0 +1,147 @@
+#!/usr/bin/python
+#
+# can_monitor.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+from collections import namedtuple
+
+
+# id is the can id as an int, data the payload as a hex string
+CANFrame = namedtuple('CANFrame', 'time id data')
+
+# what the adapter may print while monitoring, besides frames
+BUFFER_FULL = 'BUFFER FULL'
+STOPPED = 'STOPPED'
+PROMPT = '>'
+
+_HEX = frozenset('0123456789ABCDEF')
+
+
+class MonitorParser(object):
+    """Turns the output of atma into CANFrames. The adapter is
+       expected to print headers without spaces (ath1, ats0), so an
+       11 bit frame looks like 7E803410C1A and a 29 bit one like
+       18DAF11003410C1A. Lines can be split over several reads.
+    """
+
+    def __init__(self):
+        self._partial = ''
+        self.frames = 0
+        self.errors = 0
+
+
+    def feed(self, chunk, now):
+        """Parses the data read from the adapter.
+           Returns (frames, events), events being the non frame lines
+           like BUFFER FULL, STOPPED or the prompt.
+        """
+        lines = (self._partial + chunk).split('\r')
+        self._partial = lines.pop()
+        frames = []
+        events = []
+
+        if PROMPT in self._partial:
+            # the prompt is not followed by a newline
+            lines.append(self._partial)
+            self._partial = ''
+
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            if PROMPT in line:
+                before = line[:line.index(PROMPT)].strip()
+                if before:
+                    events.append(before)
+                events.append(PROMPT)
+                continue
+            if ' ' in line:
+                compact = line.replace(' ', '')
+            else:
+                compact = line
+            length = len(compact)
+            if length & 1:
+                id_length = 3
+            else:
+                id_length = 8
+            if length < id_length or not _HEX.issuperset(compact):
+                events.append(line)
+                continue
+            frames.append(CANFrame(now, int(compact[:id_length], 16),
+                                   compact[id_length:]))
+
+        self.frames += len(frames)
+        for event in events:
+            if event not in (PROMPT, STOPPED):
+                self.errors += 1
+        return frames, events
+
+
+
+class Subscribers(object):
+    """Callbacks interested in frames, either of one id or of all"""
+
+    def __init__(self):
+        self._by_id = {}
+        self._all = []
+        self._ids = {}
+        self._next = 1
+
+
+    def add(self, callback, can_id=None):
+        """Adds callback(frame), called for the frames with can_id or
+           for all frames if can_id is None. Returns an id to remove it.
+        """
+        sub_id = self._next
+        self._next += 1
+        if can_id is None:
+            self._all.append(callback)
+        else:
+            self._by_id.setdefault(can_id, []).append(callback)
+        self._ids[sub_id] = (callback, can_id)
+        return sub_id
+
+
+    def remove(self, sub_id):
+        callback, can_id = self._ids.pop(sub_id)
+        if can_id is None:
+            self._all.remove(callback)
+        else:
+            self._by_id[can_id].remove(callback)
+            if not self._by_id[can_id]:
+                del self._by_id[can_id]
+
+
+    def dispatch(self, frames):
+        by_id = self._by_id
+        for frame in frames:
+            for callback in self._all:
+                callback(frame)
+            callbacks = by_id.get(frame.id)
+            if callbacks:
+                for callback in callbacks:
+                    callback(frame)
+
+
+    def __len__(self):
+        return len(self._ids)
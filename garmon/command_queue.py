@@ -26,15 +26,36 @@
 import gobject
 from gobject import GObject
 import gtk
-import datetime
+import math
+import string
+import time
 
 import inspect
 
 import garmon
-from garmon.device import OBDDevice
+from garmon.device import OBDDevice, bus_time
 from garmon.utils import PropertyObject, gproperty, gsignal
-from garmon.sensor import Command
-from garmon.logger import log
+from garmon.sensor import Command, result_values
+from garmon.virtual_sensor import VirtualSensor
+from garmon.trip_stats import TripStats
+from garmon.triggers import TriggerEngine
+from garmon.logger import log, trace
+
+
+# A command that fails is skipped for BACKOFF_BASE seconds, doubling
+# with every consecutive failure up to BACKOFF_MAX. After QUARANTINE_AFTER
+# consecutive failures it is only tried every REPROBE_INTERVAL seconds.
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+QUARANTINE_AFTER = 5
+REPROBE_INTERVAL = 30.0
+
+# The answers that only say something about the command that got them.
+# Others, like UNABLE TO CONNECT, BUS ERROR or TIMEOUT, are about the
+# bus or the adapter and don't count as failures of the command.
+COMMAND_ERRORS = ('NO DATA', '?')
+
+_HEX_DIGITS = frozenset(string.hexdigits)
 
 
 class QueueItem(str):
@@ -42,6 +63,32 @@ class QueueItem(str):
         str.__init__(self)
         self.oneshot = False
         self.list = []
+        self.failures = 0
+        self.retry_at = 0.0
+        
+    def _get_quarantined(self):
+        return self.failures >= QUARANTINE_AFTER
+        
+    quarantined = property(_get_quarantined)
+    
+    def failed(self, now):
+        """Records a failure, returns True when the item was just
+           quarantined"""
+        self.failures += 1
+        if self.quarantined:
+            self.retry_at = now + REPROBE_INTERVAL
+            return self.failures == QUARANTINE_AFTER
+        self.retry_at = now + min(BACKOFF_BASE * 2 ** (self.failures - 1),
+                                  BACKOFF_MAX)
+        return False
+        
+    def succeeded(self):
+        """Forgets the failures, returns True when the item was
+           quarantined"""
+        quarantined = self.quarantined
+        self.failures = 0
+        self.retry_at = 0.0
+        return quarantined
 
         
 
@@ -52,7 +99,6 @@ class CommandQueue (GObject, PropertyObject):
     __gtype_name__ = "CommandQueue"
     
     ################# Properties and signals ###############    
-    gsignal('command-executed')
     gsignal('state-changed', bool)
     
     gproperty('device', object)
@@ -67,13 +113,26 @@ class CommandQueue (GObject, PropertyObject):
         return self._working
         
                
-    def __init__(self, device):
+    def __init__(self, device, stats=None):
         """ @param device: the OBDDevice to send commands
-            @param timeout: the time between two commands
+            @param stats: the PipelineStats that time the commands
         """
         GObject.__init__(self)
         PropertyObject.__init__(self, device=device)
         self._queue = []
+        # errors since the last answer
+        self._errors_in_row = 0
+        # the VirtualSensors whose inputs are queued
+        self._virtual = []
+        self._stats = stats
+        self.metrics = QueueMetrics()
+        self.trip = TripStats()
+        # a Recorder that gets every result, when recording
+        self.recorder = None
+        # captures what happens around the moments its rules fire
+        self.triggers = TriggerEngine(queue=self)
+        # set while all commands are backing off
+        self._wait_id = None
 
         self._working = False
 
@@ -81,7 +140,7 @@ class CommandQueue (GObject, PropertyObject):
         self.device.connect('connected', self._device_connected_cb)
 
     def start(self):
-        log.debug('CommandQueue.start')
+        trace('CommandQueue.start')
         if (self.device.connected):
             if not self._working:
                 self._working = True
@@ -90,7 +149,8 @@ class CommandQueue (GObject, PropertyObject):
 
 
     def stop(self):
-        log.debug('CommandQueue.stop')
+        trace('CommandQueue.stop')
+        self._cancel_wait()
         if self._working:
             self._working = False
             self.emit('state-changed', self._working)
@@ -103,33 +163,152 @@ class CommandQueue (GObject, PropertyObject):
     
     
     def _command_success_cb(self, cmd, result, args):
-        log.debug('entering CommandQueue._command_success_cb: %s' % cmd)
-        # We only care about the first result
-        result = result[0]
+        trace('entering CommandQueue._command_success_cb: %s', cmd)
+        # result maps each responding ecu to its data. Commands that 
+        # are not bound to an ecu get the data of the first one.
+        first = None
+        if result:
+            first = result.values()[0]
         for item in cmd.list:
-            item.data = result
+            if item.ecu:
+                item.data = result.get(item.ecu)
+            else:
+                item.data = first
+        if result:
+            now = time.time()
+            values = self._values(cmd, result)
+            self.trip.add(values)
+            self.triggers.add(now, cmd, result, values)
+            if self.recorder:
+                self.recorder.add(now, cmd, result, values)
+        if self._stats:
+            self._stats.mark('notified')
+        self._record(cmd, result=result)
+        if self._silent():
+            # whatever failed while the vehicle didn't answer gets a
+            # new chance
+            log.info('the vehicle answers again')
+            for item in self._queue:
+                item.succeeded()
+        elif cmd.succeeded():
+            log.info('%s answers again, leaving quarantine' % cmd)
+        self._errors_in_row = 0
         self._execute_next_command()
+
+
+    def _silent(self):
+        """Returns True when a whole round of the queue failed, as
+           when the ignition is off. The errors then don't tell which
+           commands are not supported.
+        """
+        polled = len([item for item in self._queue if not item.oneshot])
+        return self._errors_in_row >= max(polled, 1)
             
+    def _values(self, cmd, result):
+        """Returns the (command, index, ecu, metric value) tuples of a
+           result, decoded once for the trip, the triggers and the
+           recorder, with those of the virtual sensors it updated.
+        """
+        values = result_values(cmd, result)
+        seen = set()
+        for sensor in self._virtual:
+            key = (sensor.command, sensor.index, sensor.ecu or None)
+            if key in seen or not sensor.data:
+                continue
+            for command in sensor.inputs:
+                if command in cmd.list:
+                    break
+            else:
+                continue
+            try:
+                value = float(sensor.metric_value)
+            except (TypeError, ValueError):
+                continue
+            seen.add(key)
+            values.append(key + (value,))
+        return values
+
+
     def _command_error_cb(self, cmd, msg, args):
-        log.debug('CommandQueue._command_error_cb: command was: %s' % cmd)
-        log.debug('CommandQueue._command_error_cb: msg is %s' % msg)
+        trace('CommandQueue._command_error_cb: command was: %s', cmd)
+        trace('CommandQueue._command_error_cb: msg is %s', msg)
+        self._record(cmd, msg)
+        self._errors_in_row += 1
+        if not cmd.oneshot and msg in COMMAND_ERRORS and not self._silent():
+            if cmd.failed(time.time()):
+                log.info('%s failed %d times in a row (%s), only retrying '
+                         'every %ds' % (cmd, cmd.failures, msg,
+                                        REPROBE_INTERVAL))
         if self._working:
             self._execute_next_command()
     
     
+    def _record(self, cmd, msg=None, result=None):
+        busy = 0.0
+        if self._stats and self._stats.current:
+            busy = self._stats.current.duration('write', 'received') or 0.0
+        bus = 0.0
+        # only obd requests go over the bus, not the commands the
+        # adapter answers itself, like voltage
+        if _HEX_DIGITS.issuperset(cmd):
+            vehicle = self.device.vehicle
+            request = len(cmd) / 2
+            # the answers repeat the mode and the pids of the request
+            responses = [len(data) / 2 + request 
+                         for data in (result or {}).values() if data]
+            bus = bus_time(vehicle and vehicle.protocol, request, responses)
+        self.metrics.record(cmd, msg, busy, bus)
+    
+    
+    def _next_item(self, now):
+        """Rotates the queue to the first item that is not backing off.
+           Returns it, or the time the first one becomes ready.
+        """
+        ready_at = None
+        for n in range(len(self._queue)):
+            queue_item = self._queue.pop(0)
+            if not queue_item.oneshot:
+                self._queue.append(queue_item)
+            if queue_item.retry_at <= now:
+                return queue_item
+            if ready_at is None or queue_item.retry_at < ready_at:
+                ready_at = queue_item.retry_at
+        return ready_at
+        
+        
+    def _cancel_wait(self):
+        if self._wait_id is not None:
+            gobject.source_remove(self._wait_id)
+            self._wait_id = None
+            
+            
+    def _wait_cb(self):
+        self._wait_id = None
+        self._execute_next_command()
+        return False
+        
+    
     def _execute_next_command(self):
-        log.debug('entering CommandQueue._execute_next_command')
+        trace('entering CommandQueue._execute_next_command')
         if self._working:
-            if len(self._queue):
-                queue_item = self._queue.pop(0)
-                if not queue_item.oneshot:
-                    self._queue.append(queue_item)
-            else:
-                log.debug('CommandQueue: nothing in queue')
+            if not len(self._queue):
+                trace('CommandQueue: nothing in queue')
                 self.stop()
                 return
+            
+            now = time.time()
+            queue_item = self._next_item(now)
+            if not isinstance(queue_item, QueueItem):
+                # everything is backing off, wait for the first one
+                trace('CommandQueue: all commands are backing off')
+                self._cancel_wait()
+                delay = int((queue_item - now) * 1000) + 1
+                self._wait_id = gobject.timeout_add(delay, self._wait_cb)
+                return
         
-            log.debug('CommandQueue: executing next command: %s' % queue_item  ) 
+            trace('CommandQueue: executing next command: %s', queue_item)
+            if self._stats:
+                self._stats.dispatch(queue_item)
             self.device.read_command(queue_item, 
                                               self._command_success_cb,
                                               self._command_error_cb)
@@ -151,6 +330,14 @@ class CommandQueue (GObject, PropertyObject):
         if not isinstance(cmd, Command):
             raise ValueError, 'command should be an instance of Command'
             
+        if isinstance(cmd, VirtualSensor):
+            # only its inputs go to the device
+            for command in cmd.inputs:
+                self.add(command, oneshot)
+            if not cmd in self._virtual:
+                self._virtual.append(cmd)
+            return
+            
         if cmd.command in self._queue:
             queue_item = self._queue[self._queue.index(cmd.command)]
         else:
@@ -158,6 +345,17 @@ class CommandQueue (GObject, PropertyObject):
             queue_item.oneshot = oneshot
             self._queue.append(queue_item)
         queue_item.list.append(cmd)
+        
+        if self._wait_id is not None and queue_item.retry_at <= time.time():
+            # we were idle because everything else is backing off
+            self._cancel_wait()
+            self._execute_next_command()
+            
+            
+    def quarantined(self):
+        """Returns the commands that failed too often and are only
+           retried now and then"""
+        return [str(item) for item in self._queue if item.quarantined]
 
            
     def remove(self, cmd):
@@ -167,6 +365,13 @@ class CommandQueue (GObject, PropertyObject):
         if not isinstance(cmd, Command):
             raise ValueError, 'cmd should be an instance of Command'
 
+        if isinstance(cmd, VirtualSensor):
+            for command in cmd.inputs:
+                self.remove(command)
+            if cmd in self._virtual:
+                self._virtual.remove(cmd)
+            return
+            
         for queue_item in self._queue:
             if queue_item == cmd.command:
                 if cmd in queue_item.list:
@@ -175,47 +380,144 @@ class CommandQueue (GObject, PropertyObject):
                     self._queue.remove(queue_item)
     
     
-class QueueTimer(gtk.Label, PropertyObject):
+class QueueMetrics(object):
+    """Counts the executed commands. The rates are only computed when
+       update() is called, e.g. from a timer, as exponentially weighted
+       moving averages so they react to changes without jumping around.
+    """
     
-    gproperty('active', bool, False)
+    def __init__(self, tau=5.0):
+        """ @param tau: the time constant of the averages in seconds
+        """
+        self.tau = tau
+        self.reset()
+        
+        
+    def reset(self):
+        # command -> number of times it was executed
+        self._counts = {}
+        self._last_counts = {}
+        self._rates = {}
+        self._errors = 0
+        self._nodata = 0
+        self._busy = 0.0
+        self._bus = 0.0
+        # totals at the previous update: 
+        # (commands, errors, nodata, busy, bus)
+        self._last = (0, 0, 0, 0.0, 0.0)
+        self._last_update = None
+        
+        self.rate = 0.0
+        self.error_rate = 0.0
+        self.nodata_rate = 0.0
+        # the part of the time the adapter is working on a command,
+        # about 1 when polling without pause
+        self.adapter_busy = 0.0
+        # the estimated part of the bus capacity our requests and the
+        # answers take
+        self.bus_load = 0.0
+        
+        
+    def record(self, command, error=None, busy=0.0, bus=0.0):
+        """Called for every executed command.
+           @param error: the error message or None on success
+           @param busy: the time the adapter spent on the command
+           @param bus: the estimated time the frames took on the bus,
+                       see device.bus_time
+        """
+        self._counts[command] = self._counts.get(command, 0) + 1
+        if error == 'NO DATA':
+            self._nodata += 1
+        elif error is not None:
+            self._errors += 1
+        self._busy += busy
+        self._bus += bus
+        
+        
+    def update(self, now=None):
+        """Updates the averages with the commands recorded since the
+           previous update.
+        """
+        if now is None:
+            now = time.time()
+        if self._last_update is None:
+            self._last_update = now
+            return
+        dt = now - self._last_update
+        if dt <= 0:
+            return
+        self._last_update = now
+        alpha = 1 - math.exp(-dt / self.tau)
+        
+        def average(old, new):
+            return old + alpha * (new - old)
+        
+        total = 0
+        for command, count in self._counts.items():
+            total += count
+            new = (count - self._last_counts.get(command, 0)) / dt
+            self._rates[command] = average(self._rates.get(command, new), new)
+        self._last_counts = self._counts.copy()
+        
+        commands, errors, nodata, busy, bus = self._last
+        self.rate = average(self.rate, (total - commands) / dt)
+        self.error_rate = average(self.error_rate, 
+                                  (self._errors - errors) / dt)
+        self.nodata_rate = average(self.nodata_rate, 
+                                   (self._nodata - nodata) / dt)
+        self.adapter_busy = average(self.adapter_busy, 
+                                    min((self._busy - busy) / dt, 1.0))
+        self.bus_load = average(self.bus_load, 
+                                min((self._bus - bus) / dt, 1.0))
+        self._last = (total, self._errors, self._nodata, self._busy, 
+                      self._bus)
+        
+        
+    def command_rate(self, command):
+        """Returns the average number of times per second command is
+           executed"""
+        return self._rates.get(command, 0.0)
+        
+        
+    def command_rates(self):
+        return self._rates.copy()
+        
+        
+        
+class QueueStatus(gtk.Label):
+    """Shows the QueueMetrics of a queue, refreshed every second while
+       the queue is working"""
 
     def __init__(self, queue):
-        GObject.__init__(self)
-        PropertyObject.__init__(self)
+        gtk.Label.__init__(self)
         
-        self._rate = 0
-        self._samples = []
+        self._queue = queue
+        self._timeout_id = None
         self.set_text(_('command rate: N/A'))
         
-        queue.connect('command_executed', self._queue_command_executed_cb)
-        queue.connect('notify::working', self._queue_notify_working_cb)
+        queue.connect('state-changed', self._queue_state_changed_cb)
                     
-    def _queue_notify_working_cb(self, queue, working):
-        if not working:
+                    
+    def _queue_state_changed_cb(self, queue, working):
+        if working:
+            queue.metrics.reset()
+            queue.metrics.update()
+            if self._timeout_id is None:
+                self._timeout_id = gobject.timeout_add(1000, self._timeout_cb)
+        else:
+            if self._timeout_id is not None:
+                gobject.source_remove(self._timeout_id)
+                self._timeout_id = None
             self.set_text(_('command rate: N/A'))
     
-    def _queue_command_executed_cb(self, queue):
-        now = datetime.datetime.now()
-        if len(self._samples) == 0:
-            self._samples.append((now, datetime.timedelta(0,0,0)))
-        else:
-            if len(self._samples) > 20:
-                self._samples.pop(0)
-            previous = self._samples[len(self._samples) - 1]
-            delta = now - previous[0]
-            self._samples.append((now, delta))
-            
-            total = 0.0
-            count = 0
-            for item in self._samples:
-                count += 1
-                u_seconds = item[1].seconds + item[1].microseconds / 1000000.0
-                total += u_seconds
-                
-            rate = round(count / total, 1)
-            
-            self.set_text(_('command rate: %s Hz') % rate)
-        
-        
-        
-        
+    
+    def _timeout_cb(self):
+        metrics = self._queue.metrics
+        metrics.update()
+        self.set_text(_('command rate: %.1f Hz, bus load: %.1f%%, '
+                        'adapter busy: %d%%, '
+                        'errors: %.1f/s, no data: %.1f/s') % 
+                      (metrics.rate, metrics.bus_load * 100,
+                       round(metrics.adapter_busy * 100),
+                       metrics.error_rate, metrics.nodata_rate))
+        return True
@@ -28,6 +28,8 @@ import serial
 import string
 import math
 import os
+import time
+from collections import OrderedDict
 
 import gtk
 import gobject
@@ -36,16 +38,70 @@ from gobject import GObject
 import garmon
 import garmon.sensor as sensor
 from garmon.sensor import SENSORS, OBD_DESIGNATIONS, METRIC, IMPERIAL
-from garmon.sensor import dtc_decode_num, dtc_decode_mil
+from garmon.sensor import dtc_decode_num, dtc_decode_mil, DATA_BYTES
 from garmon.preferences import PreferenceManager
+from garmon.flight_recorder import FlightRecorder
+from garmon.can_monitor import MonitorParser, Subscribers, BUFFER_FULL, PROMPT
+from garmon.mode06 import SUPPORTED_MIDS, MAX_SUPPORTED_MIDS
+from garmon.virtual_sensor import is_virtual, virtual_inputs
+from garmon.mode06 import decode_supported_mids, decode_test_results
+from xdg.BaseDirectory import save_cache_path
+from garmon.vehicle_cache import VehicleCache, VehicleInfo, make_fingerprint
+from garmon.pid_bitmap import PIDBitmap, PID_NAMES, PID_NUMBERS
 from garmon.utils import PropertyObject, gproperty, gsignal
 
-from garmon.logger import log
+from garmon.logger import log, trace
 
 import datetime
 
 MAX_TIMEOUT = 3
 
+# seconds to wait for the prompt after a command, searching for the
+# protocol can take several seconds
+COMMAND_TIMEOUT = 15
+
+# don't dump the flight recorder more than once in this many seconds
+DUMP_INTERVAL = 5
+
+# the protocols (atdpn) that are can based, they allow requesting 
+# several pids in one go
+CAN_PROTOCOLS = ('6', '7', '8', '9', 'A', 'B', 'C')
+
+# per protocol (atdpn): the bit rate, the bits per data byte and the
+# bits a frame adds to its data, to estimate the load on the bus
+BUS_PROTOCOLS = {
+    '1' : (41600,  8,  48),     # SAE J1850 PWM
+    '2' : (10400,  8,  48),     # SAE J1850 VPW
+    '3' : (10400,  10, 40),     # ISO 9141-2
+    '4' : (10400,  10, 40),     # ISO 14230-4 KWP, 5 baud init
+    '5' : (10400,  10, 40),     # ISO 14230-4 KWP, fast init
+    '6' : (500000, 8,  47),     # ISO 15765-4 CAN, 11 bit, 500 kbaud
+    '7' : (500000, 8,  67),     # ISO 15765-4 CAN, 29 bit, 500 kbaud
+    '8' : (250000, 8,  47),     # ISO 15765-4 CAN, 11 bit, 250 kbaud
+    '9' : (250000, 8,  67),     # ISO 15765-4 CAN, 29 bit, 250 kbaud
+    'A' : (250000, 8,  67),     # SAE J1939 CAN
+    'B' : (125000, 8,  47),     # user1 CAN, default 11 bit, 125 kbaud
+    'C' : (50000,  8,  47),     # user2 CAN, default 11 bit, 50 kbaud
+}
+# a single can frame has room for 3 pid and frame number pairs in mode 02
+MAX_FREEZE_FRAME_PIDS = 3
+
+# stored, pending and permanent trouble codes
+DTC_MODES = ('03', '07', '0A')
+
+# put in the pending commands to start monitoring once the adapter 
+# is set up for it
+_MONITOR_START = object()
+
+# rates tried with atbrd, fastest first
+FAST_BAUDRATES = (500000, 230400, 115200)
+# the adapter waits this many units of 5 ms for our answer at the new
+# rate (atbrt), the default of 75 ms is tight when we are busy
+BAUDRATE_TIMEOUT = 0x28
+# seconds the gui may be blocked trying faster rates, rates that fail
+# are remembered per adapter and not tried again
+BAUDRATE_BUDGET = 1.0
+
 class OBDError(Exception):
     """Base class for exceptions in this module"""
 
@@ -61,11 +117,20 @@ class OBDDevice(GObject, PropertyObject):
     __gtype_name__ = "OBDDevice"
     
     _special_commands = {}
-    _supported_pids = []
+    _supported_pids = PIDBitmap()
+    _supported_commands = None
     _connected = False 
     
     gsignal('connected', bool)
     gsignal('supported-pids-changed')
+    # the port failed or hung up, emitted before the device is closed
+    gsignal('connection-lost')
+    # the dtcs and the data stored with them were cleared
+    gsignal('dtc-cleared')
+    
+    _ecus = []
+    _vehicle = None
+    _connect_timing = []
     
     gproperty('port', str, flags=gobject.PARAM_READABLE)
     #gproperty('initial-baudrate', int, 38400, flags=gobject.PARAM_READABLE)
@@ -74,6 +139,10 @@ class OBDDevice(GObject, PropertyObject):
     gproperty('supported_pids', object, flags=gobject.PARAM_READABLE)
     gproperty('special_commands', object, flags=gobject.PARAM_READABLE)
     gproperty('supported_commands', object, flags=gobject.PARAM_READABLE)
+    gproperty('ecus', object, flags=gobject.PARAM_READABLE)
+    gproperty('vehicle', object, flags=gobject.PARAM_READABLE)
+    gproperty('connect-timing', object, flags=gobject.PARAM_READABLE)
+    gproperty('monitoring', bool, False, flags=gobject.PARAM_READABLE)
     
 
     def prop_get_connected(self):
@@ -85,11 +154,24 @@ class OBDDevice(GObject, PropertyObject):
     def prop_get_special_commands(self):
         return self._special_commands
         
+    def prop_get_ecus(self):
+        return self._ecus
+        
+    def prop_get_vehicle(self):
+        return self._vehicle
+        
+    def prop_get_connect_timing(self):
+        return self._connect_timing
+        
+    def prop_get_monitoring(self):
+        return self._monitoring
+        
     def prop_get_supported_commands(self):
-        commands = self._special_commands.keys()
-        for pid in self.supported_pids:
-            commands.append(pid)
-        return commands
+        if self._supported_commands is None:
+            commands = self._special_commands.keys()
+            commands.extend(self._supported_pids)
+            self._supported_commands = frozenset(commands)
+        return self._supported_commands
         
     def prop_get_baudrate(self):
         if self._serial:
@@ -107,9 +189,29 @@ class OBDDevice(GObject, PropertyObject):
     def __init__(self):
         GObject.__init__(self)
         PropertyObject.__init__(self)
+        self.connect('supported-pids-changed', 
+                     self._supported_pids_changed_cb)
+        
+    def _supported_pids_changed_cb(self, device):
+        self._supported_commands = None
 
     ####################### Public Interface ###################
     
+    def is_supported(self, command):
+        """Returns True if command is supported by the device"""
+        return command in self.supported_commands
+        
+    def filter_supported(self, commands):
+        """Returns the set of commands from the iterable commands 
+           that are supported by the device"""
+        commands = set(commands)
+        ret = set(self.supported_commands.intersection(commands))
+        for command in commands:
+            if is_virtual(command) and \
+               self.supported_commands.issuperset(virtual_inputs(command)):
+                ret.add(command)
+        return ret
+    
     def open(self, port):
         raise NotImplementedError
     def close(self):
@@ -118,6 +220,10 @@ class OBDDevice(GObject, PropertyObject):
         raise NotImplementedError
     def read_dtc(self, ret_cb, err_cb, *args):
         raise NotImplementedError
+    def read_all_dtc(self, ret_cb, err_cb, force=False):
+        raise NotImplementedError
+    def read_monitor_tests(self, ret_cb, err_cb):
+        raise NotImplementedError
     def clear_dtc(self, ret_cb, err_cb, *args):
         raise NotImplementedError
     def get_dtc_num(self, ret_cb, err_cb, *args):
@@ -146,19 +252,48 @@ class ELMDevice(OBDDevice, PropertyObject):
         OBDDevice.__init__(self)
         PropertyObject.__init__(self)
 
-        # TODO: ignore for the moment (see request_baudrate)
-        # self._current_baudrate = self.initial_baudrate
-        # self._requested_baudrate = None
-
         self.app = app
         self._connected = False
         self._serial = None
         self._watch_id = None
         
-        self._supported_pids = []
+        self._supported_pids = PIDBitmap()
+        self._ecus = []
+        self._headers = False
+        self._vehicle = None
+        self._vehicle_cache = VehicleCache()
+        # what we know about the connection that was closed last,
+        # used to reconnect without resetting the adapter
+        self._last_vehicle = None
+        self._last_port = None
+        # the settings we applied to the adapter since its last reset
+        self._adapter = {}
+        # the answer to atz or ati, identifies the adapter
+        self._adapter_id = None
+        # the rate negotiated with atbrd, None for device.baudrate
+        self._link_rate = None
+        self._connect_timing = []
+        self._phase_start = None
+        self._recorder = FlightRecorder()
+        self._last_dump = None
+        self._stats = app.stats
+        self._span = None
         
         self._sent_command = None
-        self._cleanup_command = True
+        self._pending = []
+        self._timeout_id = None
+        
+        # passive can monitoring with atma
+        self._monitoring = False
+        self._monitor_filter = None
+        self._monitor_stop_cb = None
+        self._monitor_parser = None
+        self._frame_subscribers = Subscribers()
+        self.buffer_full_count = 0
+        
+        # (vehicle, ecu) -> (status, {mode: codes}), see read_all_dtc
+        self._dtc_cache = {}
+        
         self._ret_cb = None
         self._err_cb = None
         self._cb_args = None
@@ -166,6 +301,8 @@ class ELMDevice(OBDDevice, PropertyObject):
         self.app.prefs.register('device.port', '/dev/ttyUSB0')
         self.app.prefs.register('device.baudrate', 38400)
         self.app.prefs.register('device.ignore-keywords', False)
+        self.app.prefs.register('device.headers', False)
+        self.app.prefs.register('device.fast-baudrate', True)
 
         fname = os.path.join(garmon.dirs.UI, 'device_prefs.ui')
         self.app.builder.add_from_file(fname)
@@ -178,33 +315,94 @@ class ELMDevice(OBDDevice, PropertyObject):
         self.app.prefs.add_dialog_page('device_prefs_vbox', _('Device'))
     
 
-    def _send_command(self, command, ret, err, cleanup=True, *args):
-        log.debug('entering ELMDevice._send_command: %s' % command)
+    def _send_command(self, command, ret, err, *args):
+        trace('entering ELMDevice._send_command: %s', command)
         if not self._serial.isOpen():
             raise OBDPortError('PortNotOpen', _('The port is not open'))
 
-        self._cleanup_command = cleanup
+        if self._sent_command or self._monitoring:
+            # The device is still busy with the previous command,
+            # this one is sent as soon as that result is handled.
+            trace('ELMDevice._send_command: busy, queueing %s', command)
+            self._pending.append((command, ret, err, args))
+            return
+            
         self._sent_command = command
         self._ret_cb = ret
         self._err_cb = err
         self._cb_args = args
+        self._span = self._stats.start(command)
+        self._timeout_id = gobject.timeout_add(COMMAND_TIMEOUT * 1000,
+                                               self._command_timeout_cb)
         try:
             self._serial.flushOutput()
             self._serial.flushInput()
+            self._recorder.tx(command)
             self._serial.write(command)
             self._serial.write("\r")
+            self._span.mark('written')
         except serial.SerialException:
-            self._sent_command = None
-            self._ret_cb = None
-            self._err_cb = None
-            self._cb_args = None
+            self._clear_sent_command()
+            self.emit('connection-lost')
             self.close()           
-            raise OBDPortError('PortIOFailed', 
-                               _('Unable to write to ') + self.port)         
+            raise self._port_error('PortIOFailed', 
+                                   _('Unable to write to ') + self.port)         
+            
+
+    def _clear_sent_command(self):
+        """Forgets the command in flight, its answer is ignored"""
+        if self._timeout_id is not None:
+            gobject.source_remove(self._timeout_id)
+            self._timeout_id = None
+        self._sent_command = None
+        self._ret_cb = None
+        self._err_cb = None
+        self._cb_args = None
+        self._span = None
+
+
+    def _command_timeout_cb(self):
+        # the prompt never came, without this every later command
+        # would wait behind this one forever
+        self._timeout_id = None
+        cmd = self._sent_command
+        err_cb = self._err_cb
+        args = self._cb_args
+        log.warning('no answer to %s in %d seconds' % (cmd, COMMAND_TIMEOUT))
+        self._clear_sent_command()
+        try:
+            if err_cb:
+                err_cb(cmd, 'TIMEOUT', args)
+        finally:
+            self._send_pending()
+        return False
+        
+
+    def _port_error(self, code, msg):
+        """Returns an OBDPortError to raise, after dumping the flight
+           recorder so the traffic that led to it can be inspected.
+        """
+        now = self._recorder.clock()
+        if self._last_dump is None or now - self._last_dump > DUMP_INTERVAL:
+            self._last_dump = now
+            self.dump_flight_recorder()
+        return OBDPortError(code, msg)
+
+
+    def _send_pending(self):
+        if self._pending and not self._sent_command and not self._monitoring:
+            command, ret, err, args = self._pending.pop(0)
+            if command is _MONITOR_START:
+                self._start_monitoring(*args)
+            else:
+                self._send_command(command, ret, err, *args)
             
 
     def _read_result(self):
-        log.debug('entering ELMDevice._read_result')
+        trace('entering ELMDevice._read_result')
+        if self._span:
+            # we get here as soon as there is something to read
+            self._span.mark('first-byte')
         timeout_count = 0
         try:
             buf = ''
@@ -216,24 +414,28 @@ class ELMDevice(OBDDevice, PropertyObject):
                     break
                 else:
                     buf = buf + ch
+            self._recorder.rx(buf)
+            if self._span:
+                self._span.mark('received')
             if buf == '':
-                raise OBDPortError('PortIOFailed', 
-                                   _('Read timeout from ') + self.port)
+                raise self._port_error('PortIOFailed', 
+                                       _('Read timeout from ') + self.port)
             buf = buf.replace('\r\r', '')
             return buf
             
         except serial.SerialException:
-            raise OBDPortError('PortIOFailed', 
-                               _('Unable to read from ') + self.port)
+            raise self._port_error('PortIOFailed', 
+                                   _('Unable to read from ') + self.port)
                                           
                 
         return None
          
       
     def _parse_result(self, data):
-        log.debug('entering ELMDevice._parse_result: %s' % data)
+        trace('entering ELMDevice._parse_result: %s', data)
         error = False
         success = False
+        resend = False
         res = None
         msg = None
         
@@ -241,14 +443,27 @@ class ELMDevice(OBDDevice, PropertyObject):
         err_cb = self._err_cb
         ret_cb = self._ret_cb
         args = self._cb_args
+        span = self._span
         
         if self._sent_command:
-            if data[0] == '>':
-                log.debug('command sent, received >')
+            if 'SEARCHING' in data or 'BUS INIT' in data:
+                # Once the protocol is found the answer follows the
+                # SEARCHING... or BUS INIT: ...OK line, only resend 
+                # when there is none.
+                data = strip_search_lines(data)
+                if not data:
+                    log.info('received SEARCHING or BUS INIT: resending command')
+                    resend = True
+                    
+            if resend:
+                pass
+                
+            elif data[0] == '>':
+                trace('command sent, received >')
                 error = True
                 
             elif data[0] == '?':
-                log.debug('command sent, received ?')
+                trace('command sent, received ?')
                 error = True
                 msg = '?'
 
@@ -257,21 +472,13 @@ class ELMDevice(OBDDevice, PropertyObject):
                 error = True
                 msg = data
                 
-            elif 'SEARCHING' in data:
-                log.info('received SEARCHING: resending command')
-                self._send_command(cmd, ret_cb, err_cb, args)
-
-            elif 'BUS INIT' in data:
-                log.info('received BUS INIT: resending command')
-                self._send_command(cmd, ret_cb, err_cb, args)
-                
             elif 'UNABLE TO CONNECT' in data:
-                log.debug('received UNABLE TO CONNECT')
+                trace('received UNABLE TO CONNECT')
                 error = True
                 msg = 'UNABLE TO CONNECT'
 
             elif 'NO DATA' in data:
-                log.debug('received NO DATA')
+                trace('received NO DATA')
                 error = True
                 msg = 'NO DATA'
                 
@@ -279,146 +486,664 @@ class ELMDevice(OBDDevice, PropertyObject):
                 res = data
                 success = True
                 
-            if self._cleanup_command:
-                self._err_cb = None
-                self._ret_cb = None
-                self._sent_command = None
-                self._cb_args = None
-                
-            if error:
-                err_cb(cmd, msg, args)
-                
-            if success:
-                ret_cb(cmd, data, args)
+            self._clear_sent_command()
+            if span:
+                span.mark('parsed')
+            
+            # Commands that were waiting go out before the ones 
+            # the callbacks send, so nobody is starved.
+            if resend:
+                self._send_command(cmd, ret_cb, err_cb, *args)
+                return
+            else:
+                self._send_pending()
+            
+            # the callbacks mark the decode and notify stages
+            self._stats.current = span
+            try:
+                if error:
+                    err_cb(cmd, msg, args)
+                    
+                if success:
+                    ret_cb(cmd, data, args)
+            finally:
+                self._stats.current = None
+                if span:
+                    self._stats.finish(span)
                 
         else:
             # no command sent
             # are we interested anyway?
             if '>' in data:
-                log.debug('received >')
+                trace('received >')
             else:
-                log.debug('no command sent, received %s' % data)
+                trace('no command sent, received %s', data)
                 
 
     def _port_io_watch_cb(self, fd, condition, data=None):
-        log.debug('entering ELMDevice._port_io_watch_cb')
+        trace('entering ELMDevice._port_io_watch_cb')
         if condition & gobject.IO_HUP:
-            log.debug('received HUP signal')
-            self._sent_command = None
-            self._ret_cb = None
-            self._err_cb = None
-            self._cb_args = None
+            trace('received HUP signal')
+            self.dump_flight_recorder()
+            self._clear_sent_command()
+            self.emit('connection-lost')
             self.close()    
             return False
         elif condition & gobject.IO_ERR:
-            log.debug('received ERR signal')
-            self._sent_command = None
-            self._ret_cb = None
-            self._err_cb = None
-            self._cb_args = None
+            trace('received ERR signal')
+            self.dump_flight_recorder()
+            self._clear_sent_command()
+            self.emit('connection-lost')
             self.close()    
             return False
         elif condition & gobject.IO_IN:
+            if self._monitoring:
+                try:
+                    self._read_monitor()
+                except serial.SerialException, e:
+                    trace('reading monitored frames failed: %s', e)
+                return True
             try:
                 result = self._read_result()
                 self._parse_result(result)
             except OBDPortError, e:
-                log.debug('CONDITION = IO_IN but reading times out. Error: %s' % e[0])
+                trace('CONDITION = IO_IN but reading times out. Error: %s', e[0])
             finally:
                 return True
         else:
-            log.debug('received an unknown io signal')
+            trace('received an unknown io signal')
             return False
 
   
     
-    def _read_supported_pids(self, modes=['09','01']):
+    def _read_monitor(self):
+        """Reads whatever the adapter sent while monitoring and passes
+           the frames to the subscribers"""
+        chunk = self._serial.read(self._serial.inWaiting() or 1)
+        self._recorder.rx(chunk)
+        frames, events = self._monitor_parser.feed(chunk, time.time())
+        if frames:
+            self._frame_subscribers.dispatch(frames)
+        for event in events:
+            if event == BUFFER_FULL:
+                # the adapter stops monitoring and prints a prompt,
+                # we just start again
+                self.buffer_full_count += 1
+                log.info('adapter buffer full while monitoring')
+            elif event == PROMPT:
+                if self._monitor_stop_cb:
+                    self._monitor_stopped()
+                else:
+                    self._write_monitor_command('atma')
+            else:
+                trace('while monitoring: %s', event)
+                
+                
+    def _start_monitoring(self, address, can_filter, mask):
+        self._adapter['headers'] = True
+        self._adapter['spaces'] = False
+        self._monitor_filter = (address, can_filter, mask)
+        self._monitor_parser = MonitorParser()
+        self._write_monitor_command('atma')
+        self._monitoring = True
+        self.notify('monitoring')
+        log.info('monitoring the can bus')
+        
+        
+    def _write_monitor_command(self, command):
+        try:
+            self._recorder.tx(command)
+            self._serial.write(command + '\r')
+        except serial.SerialException:
+            self.emit('connection-lost')
+            self.close()
+            raise self._port_error('PortIOFailed', 
+                                   _('Unable to write to ') + self.port)
+                                   
+                                   
+    def _monitor_stopped(self):
+        """Restores the settings changed for monitoring, then sends the
+           commands that were waiting"""
+        done_cb = self._monitor_stop_cb
+        address, can_filter, mask = self._monitor_filter
+        self._monitoring = False
+        self._monitor_stop_cb = None
+        self._monitor_filter = None
+        self._monitor_parser = None
+        self.notify('monitoring')
+        self._restore_after_monitor(address, can_filter, mask, done_cb)
+        
+        
+    def _restore_after_monitor(self, address, can_filter, mask, done_cb):
+        """Undoes the settings start_monitor applies, the commands go
+           out before the ones that were waiting"""
+        
+        def ignore_cb(cmd, res, args):
+            trace('restoring after monitor: %s: %s', cmd, res)
+            
+        def last_cb(cmd, res, args):
+            ignore_cb(cmd, res, args)
+            if done_cb:
+                done_cb()
+            
+        restore = ['ats1']
+        self._adapter['spaces'] = True
+        if not self._headers:
+            restore.append('ath0')
+            self._adapter['headers'] = False
+        if address:
+            restore.append('atar')
+        if can_filter:
+            restore.append('atcf ' + '0' * len(can_filter))
+        if mask:
+            restore.append('atcm ' + '0' * len(mask))
+        # these go out before the commands that were waiting
+        callbacks = [ignore_cb] * (len(restore) - 1) + [last_cb]
+        self._pending[0:0] = [(command, callback, callback, ()) 
+                              for command, callback 
+                              in zip(restore, callbacks)]
+        self._send_pending()
+        
+        
+    def _read_supported_pids(self, done_cb, first=None):
+        """Reads the supported pids of mode 01 and 09 and calls 
+           done_cb(info), info being a VehicleInfo.
+           @param first: the response to 0100 if that was already read
+        """
+        modes = ['09', '01']
+        info = VehicleInfo(None)
+        pids = PIDBitmap()
 
         def success_cb(cmd, data, args):
-            log.debug('entering zero_success_cb')
+            trace('entering zero_success_cb')
             mode = cmd[:2]
-            offset = int(cmd[2:4])
-            self._supported_pids += decode_pids_from_bitstring(data, mode, offset)
-            next = '%d' % (offset + 20)
-            if mode + next in self._supported_pids:
-                self._send_command(mode + next, success_cb, error_cb)
+            offset = PID_NUMBERS[cmd[2:4]]
+            info.bitmaps[cmd] = data
+            if cmd == '0100':
+                info.key = make_fingerprint(data)
+                if self._headers:
+                    info.ecus = [ecu for ecu, res in 
+                                        split_response(data, self._headers)]
+                    log.info('responding ecus: %s' % info.ecus)
+            decode_pid_bitmap(data, mode, offset, pids, self._headers)
+            if offset < 0xE0 and mode + PID_NAMES[offset + 0x20] in pids:
+                self._send_command(mode + PID_NAMES[offset + 0x20], 
+                                   success_cb, error_cb)
             else:
-                if len(modes):
-                    mode = modes.pop()
-                    self._send_command(mode + '00', success_cb, error_cb)
+                next_mode()
+                
+        def vin_success_cb(cmd, data, args):
+            info.vin = decode_vin(data, self._headers)
+            log.info('vin: %s' % info.vin)
+            finish()
+            
+        def vin_error_cb(cmd, msg, args):
+            log.warning('could not read vin, msg is: %s' % msg)
+            finish()
+            
+        def dpn_success_cb(cmd, data, args):
+            info.protocol = decode_protocol_number(data)
+            log.info('protocol: %s' % info.protocol)
+            done_cb(info)
+
+        def dpn_error_cb(cmd, msg, args):
+            log.warning('could not read protocol, msg is: %s' % msg)
+            done_cb(info)
+            
+        def finish():
+            self._send_command('atdpn', dpn_success_cb, dpn_error_cb)
+
+        def error_cb(cmd, msg, args):
+            if cmd[:2] != '01':
+                log.warning('mode %s not supported, msg is: %s' % 
+                            (cmd[:2], msg))
+                next_mode()
+                return
+            log.error('error reading supported pids, msg is: %s' % msg)
+            raise self._port_error('OpenPortFailed', 
+                                   _('could not read supported pids\n\n' + msg))
+                               
+        def next_mode():
+            if len(modes):
+                mode = modes.pop()
+                self._send_command(mode + '00', success_cb, error_cb)
+            else:
+                log.info('supported pids: %s\n' % list(pids))
+                if '0902' in pids:
+                    self._send_command('0902', vin_success_cb, vin_error_cb)
                 else:
-                    log.info('supported pids: %s\n' % self._supported_pids)
-                    if not self._connected:
-                        self._connected = True
-                        self.emit('connected', True)
-                    self.emit('supported-pids-changed')
+                    finish()
+
+        if first:
+            modes.pop()
+            success_cb('0100', first, ())
+        else:
+            next_mode()
+            
+            
+    def _select_protocol(self):
+        """Forces the protocol of the last vehicle we were connected to,
+           so the adapter does not have to search for it. The automatic
+           search is only used when the forced protocol fails.
+        """
+        last = self._vehicle_cache.lookup(self._vehicle_cache.last)
+        if not last or not last.protocol:
+            self._identify_vehicle()
+            return
+            
+        def success_cb(cmd, res, args):
+            if 'OK' in res:
+                self._identify_vehicle(forced=True)
+            else:
+                error_cb(cmd, res, args)
 
         def error_cb(cmd, msg, args):
+            log.info('could not force protocol %s: %s' % (last.protocol, msg))
+            self._identify_vehicle()
+
+        log.info('forcing protocol %s' % last.protocol)
+        self._send_command('atsp' + last.protocol, success_cb, error_cb)
+        
+        
+    def _identify_vehicle(self, forced=False):
+        """Reads 0100 and looks the answer up in the vehicle cache. 
+           For a known vehicle the cached supported pids are used right 
+           away and the discovery runs in the background to validate 
+           them, otherwise we wait for the discovery to finish.
+           @param forced: True if a protocol was forced with atsp, the 
+                          automatic search is tried when 0100 fails.
+        """
+        def success_cb(cmd, data, args):
+            self._mark_phase('protocol')
+            key = make_fingerprint(data)
+            cached = self._vehicle_cache.lookup(key)
+            if cached:
+                log.info('known vehicle %s, using cached supported pids' % key)
+                self._set_vehicle_info(cached)
+                self._read_supported_pids(validated_cb, data)
+            else:
+                log.info('unknown vehicle %s, reading supported pids' % key)
+                self._read_supported_pids(discovered_cb, data)
+
+        def error_cb(cmd, msg, args):
+            if forced:
+                log.info('forced protocol failed, msg is: %s' % msg)
+                self._send_command('atsp0', auto_cb, auto_cb)
+                return
             log.error('error reading supported pids, msg is: %s' % msg)
-            raise OBDPortError('OpenPortFailed', 
-                               _('could not read supported pids\n\n' + msg))
+            raise self._port_error('OpenPortFailed', 
+                                   _('could not read supported pids\n\n' + msg))
+                               
+        def auto_cb(cmd, res, args):
+            log.info('falling back to automatic protocol search')
+            self._identify_vehicle()
+                               
+        def discovered_cb(info):
+            self._vehicle_cache.store(info)
+            self._set_vehicle_info(info)
 
-        if '01' in modes:
-            self._supported_pids = []
-        mode = modes.pop()
-        self._send_command(mode + '00', success_cb, error_cb)
+        def validated_cb(info):
+            if info != self._vehicle:
+                log.info('cached vehicle info was outdated, updating')
+                self._vehicle_cache.store(info)
+                self._set_vehicle_info(info)
+            else:
+                trace('cached vehicle info is valid')
+
+        self._send_command('0100', success_cb, error_cb)
+        
+        
+    def _set_vehicle_info(self, info):
+        self._vehicle = info
+        self._last_vehicle = info
+        # after discovery the adapter keeps using the protocol it found
+        self._adapter['protocol'] = info.protocol
+        self._vehicle_cache.last = info.key
+        self._ecus = info.ecus
+        pids = PIDBitmap()
+        for cmd, data in info.bitmaps.items():
+            decode_pid_bitmap(data, cmd[:2], PID_NUMBERS[cmd[2:4]], pids, 
+                              self._headers)
+        self._supported_pids = pids
+        self._supported_commands = None
+        if not self._connected:
+            self._mark_phase('discovery')
+            log.info('connected in %.3fs (%s)' % (
+                        sum([t for phase, t in self._connect_timing]),
+                        string.join(['%s %.3fs' % item 
+                                     for item in self._connect_timing], 
+                                    ', ')))
+            self._connected = True
+            self.emit('connected', True)
+        self.emit('supported-pids-changed')
+        
+        
+    def _mark_phase(self, phase):
+        """Records how long the connect phase that just finished took"""
+        now = time.time()
+        if self._phase_start is not None:
+            self._connect_timing.append((phase, now - self._phase_start))
+        self._phase_start = now
         
       
     def _initialize_device(self):
         def atz_success_cb(cmd, res, args):
-            log.debug('in atz_success_cb')
+            trace('in atz_success_cb')
             if not 'ELM327' in res:
-                log.debug('invalid response')
+                trace('invalid response')
                 atz_error_cb(cmd, res, None)
             else:
-                log.debug('received answer valid')
+                trace('received answer valid')
+                self._adapter = {'echo': True, 'headers': False}
+                self._adapter_id = decode_adapter_id(res)
+                self._mark_phase('reset')
                 self._send_command('ate0', ate_success_cb, ate_error_cb)
             
         def atz_error_cb(cmd, msg, args):
-            log.debug('in atz_error_cb')
-            raise OBDPortError('OpenPortFailed', 
-                               _('atz command failed'))
+            trace('in atz_error_cb')
+            raise self._port_error('OpenPortFailed', 
+                                   _('atz command failed'))
             
         def ate_success_cb(cmd, res, args):
-            log.debug('in ate_success_cb')
+            trace('in ate_success_cb')
             if not 'OK' in res:
-                log.debug('invalid response')
+                trace('invalid response')
                 ate_error_cb(cmd, res, args)
             else:
+                self._adapter['echo'] = False
                 #if self.app.get('device.ignore-keywords'):
                 #    self._send_command('atkw0', atkw_success_cb, atkw_error_cb)
                 #else:
-                self._read_supported_pids()
+                if self._headers:
+                    self._send_command('ath1', ath_success_cb, ath_error_cb)
+                else:
+                    self._setup_done()
             
         def ate_error_cb(cmd, msg, args):
-            log.debug('in atz_error_cb')
-            raise OBDPortError('OpenPortFailed', 
-                               _('ate0 command failed'))
+            trace('in atz_error_cb')
+            raise self._port_error('OpenPortFailed', 
+                                   _('ate0 command failed'))
+
+        def ath_success_cb(cmd, res, args):
+            trace('in ath_success_cb')
+            if not 'OK' in res:
+                trace('invalid response')
+                ath_error_cb(cmd, res, args)
+            else:
+                self._adapter['headers'] = True
+                self._setup_done()
+
+        def ath_error_cb(cmd, msg, args):
+            trace('in ath_error_cb')
+            raise self._port_error('OpenPortFailed', 
+                                   _('ath1 command failed'))
 
         def atkw_success_cb(cmd, msg, args):
-            log.debug('in atkw_success_cb')
+            trace('in atkw_success_cb')
             if not 'OK' in res:
-                log.debug('invalid response')
+                trace('invalid response')
                 atkw_error_cb(cmd, res, args)
             else:
-                self._read_supported_pids()            
+                self._setup_done()            
 
         def atkw_error_cb(cmd, msg, args):
-            log.debug('in atkw_error_cb')
-            raise OBDPortError('OpenPortFailed', 
-                               _('atkw0 command failed'))
+            trace('in atkw_error_cb')
+            raise self._port_error('OpenPortFailed', 
+                                   _('atkw0 command failed'))
                                
-        self._send_command('atz', atz_success_cb, atz_error_cb)                        
+        self._connect_timing = []
+        self._phase_start = time.time()
+        self._send_command('atz', atz_success_cb, atz_error_cb)
+        if self._link_rate:
+            # the adapter answers atz at its default rate
+            self._serial.flush()
+            self._serial.baudrate = self.app.prefs.get('device.baudrate')
+            self._link_rate = None
+    
+    
+    def _setup_done(self):
+        self._upgrade_baudrate()
+        self._mark_phase('setup')
+        self._select_protocol()
+        
+        
+    def _upgrade_baudrate(self):
+        """Moves the adapter to the fastest rate it supports, trying
+           the rate that worked last time first. This blocks, so it
+           gives up after BAUDRATE_BUDGET seconds and skips the rates
+           that failed before with this adapter.
+        """
+        if self._link_rate or not self.app.prefs.get('device.fast-baudrate'):
+            return
+        current = self._serial.baudrate
+        adapter = '%s %s' % (self.port, self._adapter_id)
+        best = self._vehicle_cache.get_baudrate(adapter)
+        if best is None:
+            rates = FAST_BAUDRATES
+        else:
+            rates = [best] + [rate for rate in FAST_BAUDRATES if rate < best]
+        failed = self._vehicle_cache.get_failed_baudrates(adapter)
+        rates = [rate for rate in rates 
+                      if rate > current and not rate in failed]
+        if not rates:
+            return
+        
+        # the io watch would get in the way of the exact timing
+        gobject.source_remove(self._watch_id)
+        timeout = self._serial.timeout
+        self._serial.timeout = 0.05
+        end = time.time() + BAUDRATE_BUDGET
+        try:
+            best = current
+            if not 'OK' in self._send_sync('atbrt %02X' % BAUDRATE_TIMEOUT,
+                                           end=end):
+                log.info('adapter does not support atbrt')
+                rates = []
+            for rate in rates:
+                if time.time() >= end:
+                    log.info('no time left to try faster rates')
+                    break
+                if self._switch_baudrate(rate, end):
+                    self._link_rate = best = rate
+                    break
+                if time.time() < end:
+                    # not just out of time, the adapter can't do it
+                    self._vehicle_cache.add_failed_baudrate(adapter, rate)
+        finally:
+            self._serial.timeout = timeout
+            self._watch_id = gobject.io_add_watch(self._serial, 
+              gobject.IO_IN | gobject.IO_PRI | gobject.IO_ERR | gobject.IO_HUP,
+              self._port_io_watch_cb)
+        log.info('using %d baud' % best)
+        self._vehicle_cache.set_baudrate(adapter, best)
+        
+        
+    def _switch_baudrate(self, rate, end):
+        """Asks the adapter to switch to rate with atbrd, the adapter 
+           then sends its id at the new rate and keeps it if we answer 
+           in time. Returns True on success, on failure we are back at
+           the old rate.
+           @param end: the time to give up waiting for the answers
+        """
+        divisor = int(round(4000000.0 / rate))
+        if divisor < 8 or divisor > 0xFF:
+            return False
+        old = self._serial.baudrate
+        # the adapter switches right after the OK
+        res = self._send_sync('atbrd %02X' % divisor, terminators='K?>',
+                              end=end)
+        if not 'OK' in res:
+            if not '>' in res:
+                self._read_sync('>')
+            return False
+        try:
+            self._serial.baudrate = rate
+            res = self._read_sync('\r', skip_empty=True, end=end)
+            if 'ELM' in res:
+                self._write_sync('\r')
+                if 'OK' in self._read_sync('>', end=end):
+                    return True
+        except serial.SerialException, e:
+            log.warning('switching to %d baud failed: %s' % (rate, e))
+        # the adapter falls back to the old rate by itself
+        self._serial.baudrate = old
+        self._read_sync('>')
+        self._serial.flushInput()
+        return False
+        
+        
+    def _write_sync(self, data):
+        self._recorder.tx(data)
+        self._serial.write(data)
+        
+        
+    def _read_sync(self, terminators, skip_empty=False, timeout=0.5,
+                   end=None):
+        """Reads until one of the terminators, until timeout or until
+           the time end, whichever comes first"""
+        buf = ''
+        if end is None or end > time.time() + timeout:
+            end = time.time() + timeout
+        while time.time() < end:
+            ch = self._serial.read(1)
+            if ch in terminators and ch and (buf.strip() or not skip_empty):
+                buf = buf + ch
+                break
+            buf = buf + ch
+        self._recorder.rx(buf)
+        return buf
+        
+        
+    def _send_sync(self, command, terminators='>', end=None):
+        """Sends command and waits for the answer without going through
+           the io watch, which has to be removed by the caller.
+        """
+        self._serial.flushInput()
+        self._write_sync(command + '\r')
+        return self._read_sync(terminators, end=end)
+        
+        
+    def _warm_start(self):
+        """Reconnects to an adapter that might still be set up from the
+           last connection, which is a lot faster than atz and the full
+           discovery. ati tells whether the adapter is alive and, by its
+           echo, whether it was reset in the meantime. atws is tried when
+           it does not answer properly. Only the settings that differ are
+           sent again and the supported pids of the last connection are
+           used right away, a different vehicle is detected by checking
+           0100 afterwards. When nothing answers at the negotiated rate
+           ati is tried again at device.baudrate. Anything unexpected 
+           falls back to _initialize_device.
+        """
+        vehicle = self._last_vehicle
+        
+        def ati_success_cb(cmd, res, args):
+            if not 'ELM327' in res:
+                ati_error_cb(cmd, res, args)
+                return
+            self._adapter_id = decode_adapter_id(res)
+            if res.lstrip().upper().startswith('ATI'):
+                # echo is on again, so the adapter was reset
+                self._adapter = {'echo': True, 'headers': False}
+            self._mark_phase('reset')
+            apply_settings()
+            
+        def ati_error_cb(cmd, msg, args):
+            log.info('no proper answer to ati (%s), trying atws' % msg)
+            self._send_command('atws', atws_success_cb, cold_cb)
+            
+        def atws_success_cb(cmd, res, args):
+            if not 'ELM327' in res:
+                cold_cb(cmd, res, args)
+                return
+            self._adapter = {'echo': True, 'headers': False}
+            self._mark_phase('reset')
+            apply_settings()
+            
+        def cold_cb(cmd, msg, args):
+            baudrate = self.app.prefs.get('device.baudrate')
+            if self._link_rate and self._serial.baudrate != baudrate:
+                # a power cycled adapter is back at its default rate
+                log.info('no answer at %d baud, trying %d' % 
+                         (self._link_rate, baudrate))
+                self._serial.flush()
+                self._serial.baudrate = baudrate
+                self._link_rate = None
+                self._adapter = {}
+                self._send_command('ati', ati_success_cb, ati_error_cb)
+                return
+            log.info('warm start failed (%s), resetting the adapter' % msg)
+            self._initialize_device()
+            
+        def apply_settings():
+            self._upgrade_baudrate()
+            if self._headers:
+                headers_cmd = 'ath1'
+            else:
+                headers_cmd = 'ath0'
+            wanted = [('echo', False, 'ate0'),
+                      ('headers', self._headers, headers_cmd)]
+            if vehicle.protocol:
+                wanted.append(('protocol', vehicle.protocol, 
+                               'atsp' + vehicle.protocol))
+            settings = [item for item in wanted 
+                             if self._adapter.get(item[0]) != item[1]]
+            next_setting(settings)
+            
+        def next_setting(settings):
+            if not settings:
+                self._mark_phase('setup')
+                self._set_vehicle_info(vehicle)
+                self._send_command('0100', check_cb, check_error_cb)
+                return
+            name, value, command = settings.pop(0)
+            
+            def ok_cb(cmd, res, args):
+                if not 'OK' in res:
+                    cold_cb(cmd, res, args)
+                    return
+                self._adapter[name] = value
+                next_setting(settings)
+                
+            self._send_command(command, ok_cb, cold_cb)
+            
+        def check_cb(cmd, data, args):
+            if make_fingerprint(data) != vehicle.key:
+                log.info('a different vehicle answers, identifying it')
+                self._identify_vehicle()
+            else:
+                trace('warm start: same vehicle')
+                
+        def check_error_cb(cmd, msg, args):
+            log.warning('vehicle did not answer 0100 after warm start, '
+                        'msg is: %s' % msg)
+        
+        log.info('warm start, reusing the settings of the last connection')
+        self._connect_timing = []
+        self._phase_start = time.time()
+        self._send_command('ati', ati_success_cb, ati_error_cb)
     
                                
                                
                                        
     ####################### Public Interface ###################
                 
-    def open(self):
-        self._supported_pids = []
+    def open(self, warm=False):
+        """Opens the port and sets up the adapter.
+           @param warm: reuse the adapter settings and supported pids of 
+                        the last connection if possible, see _warm_start
+        """
+        self._supported_pids = PIDBitmap()
+        self._supported_commands = None
+        self._ecus = []
         port = self.app.prefs.get('device.port')
         baudrate = self.app.prefs.get('device.baudrate')
+        self._headers = self.app.prefs.get('device.headers')
+        if port != self._last_port:
+            self._link_rate = None
+        elif self._link_rate:
+            # the adapter is still listening at the negotiated rate
+            baudrate = self._link_rate
         
         try:
             self._serial = serial.Serial(port, baudrate, 
@@ -433,23 +1158,197 @@ class ELMDevice(OBDDevice, PropertyObject):
               gobject.IO_IN | gobject.IO_PRI | gobject.IO_ERR | gobject.IO_HUP,
               self._port_io_watch_cb)                                  
         
-        self._initialize_device()
+        if warm and self._last_vehicle and port == self._last_port:
+            self._warm_start()
+        else:
+            self._initialize_device()
+        self._last_port = port
 
         
     def close(self):
         """Resets the elm chip and closes the open serial port""" 
-        self._supported_pids = []
+        self._supported_pids = PIDBitmap()
         self._supported_freeze_frame_pids = None
-        if self._serial:
+        self._ecus = []
+        self._vehicle = None
+        self._pending = []
+        # a command still in flight would hold back the ones of the
+        # next open forever
+        self._clear_sent_command()
+        self._monitoring = False
+        self._monitor_stop_cb = None
+        self._supported_commands = None
+        if self._watch_id is not None:
             gobject.source_remove(self._watch_id)
+            self._watch_id = None
+        if self._serial:
             self._serial.close()
         self._connected = False
         self.emit('connected', False)
                    
     
+    def read_freeze_frame(self, frame, pids, ret_cb, err_cb):
+        """Reads pids (['0C', '0D', ...]) of a freeze frame and calls 
+           ret_cb(frame, values), values mapping each pid that answered
+           to its data. On can several pids are requested at once.
+           err_cb(frame, msg) is called when the adapter fails.
+           @param frame: the frame number as hex string, '00'
+        """
+        if not self._serial or not self._serial.isOpen():
+            raise OBDPortError('PortNotOpen', _('The port is not open'))
+            
+        if self._vehicle and self._vehicle.protocol in CAN_PROTOCOLS:
+            size = MAX_FREEZE_FRAME_PIDS
+        else:
+            size = 1
+        groups = [pids[i:i + size] for i in range(0, len(pids), size)]
+        values = {}
+        
+        def success_cb(cmd, data, args):
+            group = args[0]
+            for pid, value in decode_freeze_frame(data, frame, 
+                                                  self._headers).items():
+                if pid in group:
+                    values[pid] = value
+            next_group()
+            
+        def error_cb(cmd, msg, args):
+            group = args[0]
+            if msg in ('NO DATA', '?'):
+                if len(group) > 1:
+                    # maybe the ecu doesn't like several at once
+                    groups[0:0] = [[pid] for pid in group]
+                next_group()
+            else:
+                err_cb(frame, msg)
+                
+        def next_group():
+            if groups:
+                group = groups.pop(0)
+                command = '02' + string.join([pid + frame for pid in group], '')
+                self._send_command(command, success_cb, error_cb, group)
+            else:
+                ret_cb(frame, values)
+                
+        next_group()
+        
+        
+    def read_freeze_frame_pids(self, frame, ret_cb, err_cb):
+        """Reads the pids stored in a freeze frame and calls 
+           ret_cb(frame, pids), pids being a PIDBitmap.
+        """
+        pids = PIDBitmap(suffix=frame)
+        
+        def success_cb(frame, values):
+            offset = PID_NUMBERS[pid[0]]
+            if not pid[0] in values:
+                ret_cb(frame, pids)
+                return
+            pids.add_response('02', offset, values[pid[0]])
+            if offset < 0xE0 and '02' + PID_NAMES[offset + 0x20] + frame in pids:
+                pid[0] = PID_NAMES[offset + 0x20]
+                self.read_freeze_frame(frame, pid, success_cb, err_cb)
+            else:
+                ret_cb(frame, pids)
+                
+        pid = ['00']
+        self.read_freeze_frame(frame, pid, success_cb, err_cb)
+        
+        
+    def start_monitor(self, address=None, can_filter=None, mask=None):
+        """Puts the adapter in monitor mode (atma), it then prints all
+           the frames on the can bus without sending anything itself. 
+           Commands sent meanwhile wait until stop_monitor.
+           @param address: only receive frames for this id (atcra)
+           @param can_filter: the id filter (atcf), used with mask
+           @param mask: the bits of the id the filter applies to (atcm)
+        """
+        if not self._serial or not self._serial.isOpen():
+            raise OBDPortError('PortNotOpen', _('The port is not open'))
+        if self._monitoring:
+            return
+            
+        def ok_cb(cmd, res, args):
+            trace('setting up monitor: %s: %s', cmd, res)
+            
+        def error_cb(cmd, msg, args):
+            log.warning('could not set up monitoring, %s failed: %s' %
+                        (cmd, msg))
+            if self._monitoring:
+                # the pending atma went out before this callback
+                self.stop_monitor()
+                return
+            self._pending = [item for item in self._pending 
+                                  if item[0] is not _MONITOR_START and
+                                     item[1] is not ok_cb]
+            # some of the settings may have been applied already
+            self._restore_after_monitor(address, can_filter, mask, None)
+            
+        # we need the ids and no spaces saves a third of the bytes
+        setup = ['ath1', 'ats0']
+        if address:
+            setup.append('atcra ' + address)
+        if can_filter:
+            setup.append('atcf ' + can_filter)
+        if mask:
+            setup.append('atcm ' + mask)
+        # these go out before the commands that are waiting
+        self._pending[0:0] = [(command, ok_cb, error_cb, ()) 
+                              for command in setup] + \
+                             [(_MONITOR_START, None, None, 
+                               (address, can_filter, mask))]
+        self._send_pending()
+        
+        
+    def stop_monitor(self, done_cb=None):
+        """Stops monitoring, done_cb() is called when the adapter is 
+           ready for commands again"""
+        if not self._monitoring:
+            if done_cb:
+                done_cb()
+            return
+        self._monitor_stop_cb = done_cb or (lambda: None)
+        # any character stops atma
+        self._write_monitor_command('')
+        
+        
+    def subscribe_frames(self, callback, can_id=None):
+        """Calls callback(frame) for the monitored frames with can_id, or
+           for all of them, frame being a can_monitor.CANFrame. Returns
+           an id for unsubscribe_frames.
+        """
+        return self._frame_subscribers.add(callback, can_id)
+        
+        
+    def unsubscribe_frames(self, sub_id):
+        self._frame_subscribers.remove(sub_id)
+        
+        
+    def dump_flight_recorder(self, filename=None):
+        """Writes the recent serial traffic to filename, or to
+           flight-recorder in the cache dir. The dump can be replayed
+           with scripts/elm_sim.py. Returns the filename or None.
+        """
+        if filename is None:
+            filename = os.path.join(save_cache_path('garmon'),
+                                    'flight-recorder')
+        try:
+            self._recorder.dump(filename)
+        except (IOError, OSError), e:
+            log.warning('could not dump flight recorder to %s: %s' %
+                        (filename, e))
+            return None
+        return filename
+        
+    
     def read_pid_data(self, pid, ret_cb, err_cb, *args):
+        """Reads a pid and passes the data to ret_cb as an OrderedDict
+           mapping the address of each responding ecu to its data.
+           When headers are off all data is stored under the None key.
+        """
         def success_cb(cmd, data, args):
-            ret = decode_result(data)
+            ret = decode_ecu_result(data, self._headers)
+            self._stats.mark('decoded')
             ret_cb(cmd, ret, args)
 
         if self._serial and self._serial.isOpen():
@@ -463,8 +1362,8 @@ class ELMDevice(OBDDevice, PropertyObject):
             raise ValueError, 'command %s is not supported' % command
             
         def success_cb(cmd, res, args):
-            ret = []
-            ret.append(res)
+            ret = OrderedDict()
+            ret[None] = res
             ret_cb(command, ret, args)
             
         def error_cb(cmd, res, args):
@@ -508,7 +1407,7 @@ class ELMDevice(OBDDevice, PropertyObject):
 
         def success_cb(cmd, result, args):
             try:
-                dtc = decode_dtc_result(result)
+                dtc = decode_dtc_result(result, self._headers)
             except OBDError, (err, msg):
                 err_cb(cmd, err, args)
             ret_cb(cmd, dtc, args)
@@ -519,18 +1418,175 @@ class ELMDevice(OBDDevice, PropertyObject):
             raise OBDPortError('PortNotOpen', _('The port is not open'))
 
 
+    def read_all_dtc(self, ret_cb, err_cb, force=False):
+        """Reads the stored (03), pending (07) and permanent (0A) trouble
+           codes and calls ret_cb(dtcs), dtcs mapping each ecu to a dict 
+           of mode -> list of codes. The three requests are sent right 
+           after each other, the queue keeps running meanwhile.
+           
+           The codes are cached per ecu. Unless force is set, 0101 is 
+           read first and the cache is used when the dtc count and mil of
+           every ecu are the same. New pending codes don't change 0101, 
+           so use force to be sure.
+           err_cb(mode, msg) is called when a request fails.
+        """
+        if not self._serial or not self._serial.isOpen():
+            raise OBDPortError('PortNotOpen', _('The port is not open'))
+            
+        can = self._vehicle and self._vehicle.protocol in CAN_PROTOCOLS
+        vehicle = self._vehicle and self._vehicle.key
+        cached = dict([(ecu, entry) for (key, ecu), entry 
+                                    in self._dtc_cache.items()
+                                    if key == vehicle])
+        statuses = {}
+        dtcs = {}
+        remaining = list(DTC_MODES)
+        
+        def status_cb(cmd, result, args):
+            try:
+                for ecu, data in decode_ecu_result(result, 
+                                                   self._headers).items():
+                    # byte A holds the mil and the dtc count, the 
+                    # readiness bits in the others change while driving
+                    statuses[ecu] = data[:2]
+            except OBDDataError:
+                pass
+            if not force and cached and statuses and \
+               statuses == dict([(ecu, entry[0]) 
+                                 for ecu, entry in cached.items()]):
+                trace('dtc status unchanged, using cached codes')
+                ret_cb(dict([(ecu, entry[1]) 
+                             for ecu, entry in cached.items()]))
+            else:
+                sweep()
+                
+        def status_error_cb(cmd, msg, args):
+            sweep()
+            
+        def sweep():
+            for mode in DTC_MODES:
+                self._send_command(mode, mode_cb, mode_error_cb)
+                
+        def mode_cb(cmd, result, args):
+            try:
+                for ecu, codes in decode_dtc_response(result, cmd, can,
+                                                      self._headers).items():
+                    dtcs.setdefault(ecu, {})[cmd] = codes
+            except OBDDataError, e:
+                log.warning('could not decode mode %s: %s' % (cmd, e[1]))
+            mode_done(cmd)
+            
+        def mode_error_cb(cmd, msg, args):
+            if msg in ('NO DATA', '?'):
+                # no codes, or the mode isn't supported
+                mode_done(cmd)
+            elif remaining:
+                remaining[:] = []
+                err_cb(cmd, msg)
+                
+        def mode_done(mode):
+            if not mode in remaining:
+                return
+            remaining.remove(mode)
+            if remaining:
+                return
+            for ecu in dtcs.keys():
+                for mode in DTC_MODES:
+                    dtcs[ecu].setdefault(mode, [])
+            for key in self._dtc_cache.keys():
+                if key[0] == vehicle:
+                    del self._dtc_cache[key]
+            for ecu, codes in dtcs.items():
+                self._dtc_cache[(vehicle, ecu)] = (statuses.get(ecu), codes)
+            ret_cb(dtcs)
+            
+        if force:
+            sweep()
+        else:
+            self._send_command('0101', status_cb, status_error_cb)
+            
+            
+    def read_monitor_tests(self, ret_cb, err_cb):
+        """Reads all the on-board monitoring test results (mode 06) and
+           calls ret_cb(results), a list of mode06.TestResult. 
+           
+           The supported mids of all ecus are asked with 2 requests of 
+           up to 6 bitmaps, then every supported mid is requested. Those
+           requests all go into the pending list at once, so they follow
+           each other without waiting for the callbacks, and the answer 
+           holds all tests of a mid in one multi frame message.
+           err_cb(command, msg) is called when a request fails.
+           Only can vehicles are supported.
+        """
+        if not self._serial or not self._serial.isOpen():
+            raise OBDPortError('PortNotOpen', _('The port is not open'))
+        if not self._vehicle or not self._vehicle.protocol in CAN_PROTOCOLS:
+            err_cb('06', _('Mode 06 is only supported on CAN vehicles'))
+            return
+            
+        mids = set()
+        results = []
+        requests = []
+        # emptied once the supported mids are known
+        discovering = [True]
+        
+        def supported_cb(cmd, result, args):
+            for ecu, data in split_response(result, self._headers):
+                if not data[:2] == '46':
+                    continue
+                for offset, bitmap in decode_supported_mids(data):
+                    supported = PIDBitmap()
+                    supported.add_response('06', offset, bitmap)
+                    mids.update([mid for mid in supported.pids('06') 
+                                     if not mid in SUPPORTED_MIDS])
+            request_done(cmd)
+            
+        def test_cb(cmd, result, args):
+            for ecu, data in split_response(result, self._headers):
+                if data[:2] == '46':
+                    results.extend(decode_test_results(data, ecu))
+            request_done(cmd)
+            
+        def error_cb(cmd, msg, args):
+            if msg in ('NO DATA', '?'):
+                request_done(cmd)
+            elif requests:
+                requests[:] = []
+                err_cb(cmd, msg)
+                
+        def request_done(cmd):
+            if not cmd in requests:
+                return
+            requests.remove(cmd)
+            if requests:
+                return
+            if discovering and mids:
+                discovering[:] = []
+                send(['06%02X' % mid for mid in sorted(mids)], test_cb)
+            else:
+                ret_cb(results)
+                
+        def send(commands, callback):
+            requests.extend(commands)
+            for command in commands:
+                self._send_command(command, callback, error_cb)
+                
+        bitmaps = ['%02X' % mid for mid in SUPPORTED_MIDS]
+        send(['06' + string.join(bitmaps[i:i + MAX_SUPPORTED_MIDS], '')
+                    for i in range(0, len(bitmaps), MAX_SUPPORTED_MIDS)],
+             supported_cb)
+            
+            
     def clear_dtc(self, ret_cb, err_cb, *args):
     
         def success_cb(cmd, result, args):
             if result:
-                result = string.split(result, "\r")
-                result = result[0]
-
-                result = string.split(result)
-                result = string.join(result, "")
-                result = result[:2]
+                frames = split_response(result, self._headers)
+                result = frames and frames[0][1][:2]
                 
                 if result == '44':
+                    self._dtc_cache = {}
+                    self.emit('dtc-cleared')
                     ret_cb(cmd, result, args)
                 else:
                     err_cb(cmd, OBDDataError, args)
@@ -544,22 +1600,130 @@ class ELMDevice(OBDDevice, PropertyObject):
                 
                 
 
-def decode_dtc_result(result):
+def bus_time(protocol, request, responses):
+    """Returns an estimate of the seconds a request and its answers
+       keep the bus busy, without bit stuffing and the gaps between
+       frames, or 0.0 for an unknown protocol.
+       @param request: the number of bytes of the request
+       @param responses: the number of bytes of each answer
+    """
+    try:
+        rate, byte_bits, frame_bits = BUS_PROTOCOLS[protocol]
+    except KeyError:
+        return 0.0
+    bits = 0
+    for nbytes in [request] + list(responses):
+        if protocol in CAN_PROTOCOLS:
+            # frames are padded to 8 bytes. A single frame carries 7,
+            # longer messages 6 in the first frame, 7 in the next ones
+            # and need a flow control frame.
+            if nbytes <= 7:
+                frames = 1
+            else:
+                frames = 2 + (nbytes - 6 + 6) / 7
+            bits += frames * (frame_bits + 8 * byte_bits)
+        else:
+            bits += frame_bits + nbytes * byte_bits
+    return float(bits) / rate
+    
+    
+_HEX_DIGITS = frozenset(string.hexdigits)
+
+
+def _is_hex(tokens):
+    for token in tokens:
+        if not token or not _HEX_DIGITS.issuperset(token):
+            return False
+    return True
+
+
+def split_response(result, headers=False):
+    """Splits the raw response of the device into a list of (ecu, data) 
+       tuples, where data is the hex string with the spaces removed.
+       
+       Without headers every line is returned with None as ecu. With 
+       headers (ATH1) the header is stripped and the source address is 
+       used as ecu. Multi frame CAN messages are reassembled per ecu.
+    """
+    frames = []
+    pending = {}
+
+    result = string.split(result, "\r")
+    for line in result:
+        tokens = string.split(line)
+        if not tokens:
+            continue
+        if not headers:
+            if len(tokens) == 1 and len(tokens[0]) == 3 and \
+               _is_hex(tokens):
+                # length of a multi frame CAN message, followed by
+                # lines like 0: 49 02 01 31 44 34
+                pending[None] = (len(frames), int(tokens[0], 16))
+                frames.append((None, ''))
+            elif tokens[0][-1] == ':' and None in pending:
+                index, length = pending[None]
+                data = frames[index][1] + string.join(tokens[1:], '')
+                frames[index] = (None, data[:length * 2])
+            elif not _is_hex(tokens):
+                trace('split_response: ignoring line %s', line)
+            else:
+                frames.append((None, string.join(tokens, '')))
+            continue
+            
+        if len(tokens[0]) == 3:
+            # CAN 11 bit: 7E8 06 41 00 BE 3F A8 13
+            ecu, body, can = tokens[0], tokens[1:], True
+        elif len(tokens) > 4 and tokens[0] == '18' and tokens[1] == 'DA':
+            # CAN 29 bit: 18 DA F1 10 06 41 00 BE 3F A8 13
+            ecu, body, can = tokens[3], tokens[4:], True
+        elif len(tokens) > 4:
+            # J1850 and ISO: 48 6B 10 41 00 BE 3F A8 13 C9
+            # the last byte is the checksum
+            ecu, body, can = tokens[2], tokens[3:-1], False
+        else:
+            trace('split_response: ignoring line %s', line)
+            continue
+        if not body or not _is_hex([ecu] + body):
+            # e.g. BUS BUSY or CAN ERROR between the frames
+            trace('split_response: ignoring line %s', line)
+            continue
+            
+        if not can:
+            frames.append((ecu, string.join(body, '')))
+            continue
+            
+        pci = int(body[0], 16)
+        frame_type = pci >> 4
+        if frame_type == 0:
+            length = pci & 0xF
+            frames.append((ecu, string.join(body[1:1 + length], '')))
+        elif frame_type == 1 and len(body) > 1:
+            length = ((pci & 0xF) << 8) + int(body[1], 16)
+            pending[ecu] = (len(frames), length)
+            frames.append((ecu, string.join(body[2:], '')))
+        elif frame_type == 2 and ecu in pending:
+            index, length = pending[ecu]
+            data = frames[index][1] + string.join(body[1:], '')
+            frames[index] = (ecu, data[:length * 2])
+        else:
+            trace('split_response: unexpected frame %s', line)
+            
+    return frames
+    
+    
+def decode_dtc_result(result, headers=False):
     if not result:
         raise OBDDataError('DataReadError',
                            _('No data was received from the device'))
     dtc = []
 
-    result = string.split(result, "\r")
-    for data in result:
+    for ecu, data in split_response(result, headers):
     
         if data:
             if not data[:2] == '43':
                 raise OBDDataError('Data Read Error',
                              _('Did not get a mode 03 result from the device'))
             data = data[2:]
-            data = string.split(data)
-            data = string.join(data, '')
             if not len(data) == 12:
                 raise OBDDataError('Data Read Error',
                                      _('Did not get a valid length of data'))
@@ -569,45 +1733,152 @@ def decode_dtc_result(result):
                 data = data[4:]
     return dtc
 
+
+def decode_dtc_response(result, mode, can=False, headers=False):
+    """Returns an OrderedDict mapping each ecu to the codes in its 
+       answer to mode 03, 07 or 0A. On can the answer starts with the
+       number of codes, otherwise every line holds 3 codes padded with 
+       0000.
+    """
+    if not result:
+        raise OBDDataError('DataReadError',
+                           _('No data was received from the device'))
+    answer = '%02X' % (int(mode, 16) + 0x40)
+    ret = OrderedDict()
+    
+    for ecu, data in split_response(result, headers):
+        if not data:
+            continue
+        if not data[:2] == answer:
+            raise OBDDataError('Data Read Error',
+                   _('Did not get a mode %s result from the device') % mode)
+        codes = ret.setdefault(ecu, [])
+        if can:
+            count = int(data[2:4] or '0', 16)
+            data = data[4:4 + count * 4]
+        else:
+            data = data[2:]
+        for i in xrange(0, len(data) - 3, 4):
+            if not data[i:i + 4] == '0000':
+                codes.append(data[i:i + 4])
+    return ret
+
                            
                            
-def decode_result(result):
-    log.debug('entering decode_result')
+def decode_result(result, headers=False):
+    trace('entering decode_result')
     if not result:
         raise OBDDataError('Data Read Error',
                            _('No data was received from the device'))
     ret = []
     
-    result = string.split(result, "\r")
-
-    for data in result:
-        if data:
-            data = string.split(data)
-            data = string.join(data, '')
-            
-            if data[:2] == '7F':
-                log.debug('we got back 7F which is an error')
-            else:
-                ret.append(data[4:])
+    for ecu, data in split_response(result, headers):
+        if data[:2] == '7F':
+            trace('we got back 7F which is an error')
+        else:
+            ret.append(data[4:])
         
     return ret
     
     
-def decode_pids_from_bitstring(data, mode, offset, suffix=''):
-    log.debug('entering decode_pids_from_bitstring')
-    pids = []
-    decoded = decode_result(data)
-    for item in decoded:
-        bitstr = sensor.hex_to_bitstr(item)
-        for i, bit in enumerate(bitstr):
-            if bit == "1":
-                pid = i + 1 + offset
-                if pid < 16: 
-                    pid_str = mode + '0' + hex(pid)[2:] + suffix
-                else:
-                    pid_str = mode + hex(pid)[2:] + suffix
-                pids.append(pid_str.upper())
-    return pids
+def decode_ecu_result(result, headers=False):
+    """Like decode_result, but returns an OrderedDict mapping each
+       responding ecu to its data, in the order the ecus answered.
+    """
+    trace('entering decode_ecu_result')
+    if not result:
+        raise OBDDataError('Data Read Error',
+                           _('No data was received from the device'))
+    ret = OrderedDict()
+    
+    for ecu, data in split_response(result, headers):
+        if data[:2] == '7F':
+            trace('we got back 7F which is an error')
+        elif ecu in ret:
+            trace('ignoring additional data from ecu %s', ecu)
+        else:
+            ret[ecu] = data[4:]
+    
+    return ret
+    
+    
+def strip_search_lines(result):
+    """Removes the SEARCHING... and BUS INIT: ...OK lines the adapter 
+       sends while looking for the protocol. A failed BUS INIT is kept.
+    """
+    lines = [line for line in string.split(result, '\r') 
+                  if line.strip() and
+                     not 'SEARCHING' in line and 
+                     not ('BUS INIT' in line and not 'ERROR' in line)]
+    return string.join(lines, '\r')
+    
+    
+def decode_adapter_id(result):
+    """Returns the version line ('ELM327 v1.5') from the answer to atz
+       or ati"""
+    for line in string.split(result, '\r'):
+        if 'ELM' in line:
+            return line.strip()
+    return result.strip()
+    
+    
+def decode_protocol_number(result):
+    """Returns the protocol number from the response to atdpn. 
+       The 'A' the adapter puts in front when the protocol was found
+       by an automatic search is removed.
+    """
+    result = result.strip()
+    if len(result) == 2 and result[0] == 'A':
+        result = result[1:]
+    return result or None
+    
+    
+def decode_freeze_frame(result, frame, headers=False):
+    """Splits the answer to a mode 02 request for one or more pids
+       ('42 0C 00 1A F8 0D 00 32') and returns a dict mapping each pid 
+       of frame to its data ({'0C': '1AF8', '0D': '32'}). Only the 
+       first ecu that answers is used.
+    """
+    values = {}
+    for ecu, data in split_response(result, headers):
+        if data[:2] != '42':
+            continue
+        i = 2
+        while i + 4 <= len(data):
+            pid = data[i:i + 2]
+            length = DATA_BYTES.get(pid)
+            if length is None:
+                trace('decode_freeze_frame: unknown pid %s', pid)
+                break
+            if data[i + 2:i + 4] == frame:
+                values[pid] = data[i + 4:i + 4 + 2 * length]
+            i += 4 + 2 * length
+        break
+    return values
+    
+    
+def decode_vin(result, headers=False):
+    """Returns the vin from the response to 0902 or None"""
+    vin = ''
+    for ecu, data in split_response(result, headers):
+        if data[:4] == '4902':
+            # skip the mode, pid and message count bytes
+            vin += data[6:].decode('hex')
+    vin = vin.strip('\x00').strip()
+    return vin or None
+    
+    
+def decode_pid_bitmap(data, mode, offset, bitmap=None, headers=False):
+    """Adds the pids from the raw response to a supported pids request 
+       to bitmap, the answers of all ecus are combined.
+       @return: the PIDBitmap, a new one if none was given
+    """
+    trace('entering decode_pid_bitmap')
+    if bitmap is None:
+        bitmap = PIDBitmap()
+    for item in decode_result(data, headers):
+        bitmap.add_response(mode, offset, item)
+    return bitmap
 
 
 
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+#
+# flight_recorder.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+import os
+import time
+
+from garmon.logger import log
+
+
+TX = 'T'
+RX = 'R'
+
+DUMP_HEADER = '# garmon flight recorder 1'
+
+DEFAULT_SIZE = 2048
+
+
+class MonotonicClock(object):
+    """time.time() that never goes backwards, e.g. when ntp adjusts
+       the system clock during a session.
+    """
+    __slots__ = ('_last',)
+
+    def __init__(self):
+        self._last = 0.0
+
+    def __call__(self):
+        now = time.time()
+        if now < self._last:
+            return self._last
+        self._last = now
+        return now
+
+
+
+class FlightRecorder(object):
+    """Keeps the last size chunks of serial traffic in a ring buffer,
+       so they can be dumped when something goes wrong.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self.clock = MonotonicClock()
+        self.clear()
+
+
+    def clear(self):
+        self._times = [0.0] * self.size
+        self._directions = [None] * self.size
+        self._data = [None] * self.size
+        self._next = 0
+        self._count = 0
+
+
+    def record(self, direction, data):
+        """Stores a chunk of data.
+           @param direction: TX or RX
+        """
+        i = self._next
+        self._times[i] = self.clock()
+        self._directions[i] = direction
+        self._data[i] = data
+        self._next = (i + 1) % self.size
+        if self._count < self.size:
+            self._count += 1
+
+
+    def tx(self, data):
+        self.record(TX, data)
+
+
+    def rx(self, data):
+        self.record(RX, data)
+
+
+    def entries(self):
+        """Returns the recorded (time, direction, data) tuples,
+           oldest first.
+        """
+        start = (self._next - self._count) % self.size
+        ret = []
+        for n in range(self._count):
+            i = (start + n) % self.size
+            ret.append((self._times[i], self._directions[i], self._data[i]))
+        return ret
+
+
+    def __len__(self):
+        return self._count
+
+
+    def dump(self, filename):
+        """Writes the recorded traffic to filename, see load()."""
+        entries = self.entries()
+        if entries:
+            start = entries[0][0]
+        else:
+            start = time.time()
+        tmp = filename + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            f.write('%s %.6f\n' % (DUMP_HEADER, start))
+            for t, direction, data in entries:
+                f.write('%.4f %s %s\n' % (t - start, direction,
+                                          data.encode('string_escape')))
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+        log.info('flight recorder: %d entries written to %s' %
+                 (len(entries), filename))
+
+
+
+def load(filename):
+    """Reads a dump written by FlightRecorder.dump().
+       Returns a list of (time, direction, data) tuples, the time is
+       relative to the first entry.
+    """
+    ret = []
+    f = open(filename)
+    try:
+        header = f.readline()
+        if not header.startswith(DUMP_HEADER):
+            raise ValueError, '%s is not a flight recorder dump' % filename
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            t, direction, data = line.split(' ', 2)
+            ret.append((float(t), direction, data.decode('string_escape')))
+    finally:
+        f.close()
+    return ret
+
+
+def conversation(entries):
+    """Pairs every command in entries with the response that followed.
+       Returns a list of (command, response) tuples.
+    """
+    ret = []
+    command = None
+    for t, direction, data in entries:
+        if direction == TX:
+            command = data
+        elif command is not None:
+            ret.append((command, data))
+            command = None
+    return ret
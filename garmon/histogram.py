@@ -0,0 +1,128 @@
+#!/usr/bin/python
+#
+# histogram.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+import math
+
+
+class Histogram(object):
+    """Counts positive values in logarithmic buckets, each bucket is
+       growth times wider than the previous one. Memory use only depends
+       on the range of the values, percentiles are accurate to within
+       one bucket.
+    """
+
+    __slots__ = ('resolution', 'growth', '_log_growth', '_buckets',
+                 'count', 'total', 'min', 'max')
+
+    def __init__(self, resolution=1e-6, growth=2 ** 0.125):
+        """ @param resolution: values below this end up in bucket 0
+            @param growth: the ratio between the bounds of two buckets
+        """
+        self.resolution = resolution
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self.clear()
+
+
+    def clear(self):
+        self._buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+
+    def _bucket(self, value):
+        if value <= self.resolution:
+            return 0
+        return int(math.log(value / self.resolution) / self._log_growth) + 1
+
+
+    def _upper_bound(self, bucket):
+        return self.resolution * self.growth ** bucket
+
+
+    def add(self, value):
+        bucket = self._bucket(value)
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+
+    def merge(self, other):
+        """Adds the values counted by other"""
+        for bucket, n in other._buckets.items():
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+
+    def percentile(self, q):
+        """Returns the value below which q percent of the values are,
+           or None when empty.
+        """
+        if not self.count:
+            return None
+        rank = self.count * q / 100.0
+        seen = 0
+        for bucket in sorted(self._buckets.keys()):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                # the middle of the bucket, on a log scale
+                value = self._upper_bound(bucket) / self.growth ** 0.5
+                return min(max(value, self.min), self.max)
+        return self.max
+
+
+    def buckets(self):
+        """Returns (upper bound, count) tuples for the used buckets"""
+        return [(self._upper_bound(bucket), self._buckets[bucket])
+                for bucket in sorted(self._buckets.keys())]
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __repr__(self):
+        if not self.count:
+            return '<Histogram empty>'
+        return '<Histogram n=%d mean=%g p50=%g p99=%g max=%g>' % (
+                    self.count, self.mean(), self.percentile(50),
+                    self.percentile(99), self.max)
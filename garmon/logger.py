@@ -23,15 +23,106 @@
 #   51 Franklin Street, Fifth Floor
 #   Boston, MA  02110-1301, USA.
 
+import Queue
 import logging
+import threading
 
 LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
 
-logging.basicConfig(level=logging.INFO,
-                    format='%(name)-10s: %(levelname)-10s %(message)s')
+# records waiting for the writer thread; when it can't keep up,
+# records are dropped instead of blocking the caller
+MAX_QUEUED = 10000
 
 log = logging.getLogger('Garmon')
 
+# True when debug messages are emitted, checked by trace() so the
+# hot paths pay nothing but a function call when debugging is off
+tracing = False
+
+
+def trace(msg, *args):
+    """Logs msg % args at debug level. Formatting only happens when
+       debugging is enabled, so pass the arguments instead of
+       formatting msg yourself.
+    """
+    if tracing:
+        log.debug(msg, *args)
+        
+
+class QueueHandler(logging.Handler):
+    """Hands the records to a worker thread that writes them to target,
+       so slow terminals or files never stall the main loop.
+    """
+    
+    def __init__(self, target, maxsize=MAX_QUEUED):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.dropped = 0
+        self._queue = Queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run,
+                                        name='garmon-logger')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+
+    def emit(self, record):
+        # merge the arguments now, they might change before the
+        # worker gets to them
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = _formatter.formatException(record.exc_info)
+                record.exc_info = None
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.target.handle(logging.LogRecord(
+                        record.name, logging.WARNING, __file__, 0,
+                        '%d log messages dropped', (dropped,), None))
+            self.target.handle(record)
+            
+            
+    def close(self):
+        """Writes the queued records and stops the worker"""
+        if self._thread.isAlive():
+            self._queue.put(None)
+            self._thread.join(1)
+        logging.Handler.close(self)
+        
+        
+_formatter = logging.Formatter('%(name)-10s: %(levelname)-10s %(message)s')
+_stream = logging.StreamHandler()
+_stream.setFormatter(_formatter)
+_queue_handler = QueueHandler(_stream)
+log.addHandler(_queue_handler)
+log.propagate = False
+log.setLevel(logging.INFO)
+
+
 def set_level (level):
+    global tracing
     log.setLevel(getattr(logging, level))
+    tracing = log.isEnabledFor(logging.DEBUG)
+    
+    
+def shutdown():
+    """Flushes the pending messages and logs synchronously from now on,
+       call this before exiting.
+    """
+    if _queue_handler in log.handlers:
+        log.removeHandler(_queue_handler)
+        _queue_handler.close()
+        log.addHandler(_stream)
  
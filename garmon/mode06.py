@@ -0,0 +1,294 @@
+#!/usr/bin/python
+#
+# mode06.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+"""Decoding of the on-board monitoring test results (mode 06) of can
+   vehicles. Every test is identified by a monitor id (mid) and a test
+   id (tid) and comes with a unit and scaling id (uasid) telling how to
+   turn the raw value and limits into something readable.
+"""
+
+
+# the mids that return the supported mids instead of test results
+SUPPORTED_MIDS = (0x00, 0x20, 0x40, 0x60, 0x80, 0xA0, 0xC0, 0xE0)
+
+# a request may ask for this many supported mid bitmaps at once
+MAX_SUPPORTED_MIDS = 6
+
+# OBDMID TID UASID VALUE MIN MAX, in bytes
+RECORD_LENGTH = 9
+
+
+# uasid -> (signed, scale, offset, units)
+UASIDS = {
+    0x01 : (False, 1, 0, ''),
+    0x02 : (False, 0.1, 0, ''),
+    0x03 : (False, 0.01, 0, ''),
+    0x04 : (False, 0.001, 0, ''),
+    0x05 : (False, 0.0000305, 0, ''),
+    0x06 : (False, 0.000305, 0, ''),
+    0x07 : (False, 0.25, 0, 'rpm'),
+    0x08 : (False, 0.01, 0, 'km/h'),
+    0x09 : (False, 1, 0, 'km/h'),
+    0x0A : (False, 0.122, 0, 'mV'),
+    0x0B : (False, 0.001, 0, 'V'),
+    0x0C : (False, 0.01, 0, 'V'),
+    0x0D : (False, 0.00390625, 0, 'mA'),
+    0x0E : (False, 0.001, 0, 'A'),
+    0x0F : (False, 0.01, 0, 'A'),
+    0x10 : (False, 1, 0, 'ms'),
+    0x11 : (False, 100, 0, 'ms'),
+    0x12 : (False, 1, 0, 's'),
+    0x13 : (False, 1, 0, 'mOhm'),
+    0x14 : (False, 1, 0, 'Ohm'),
+    0x15 : (False, 1, 0, 'kOhm'),
+    0x16 : (False, 0.1, -40, 'C'),
+    0x17 : (False, 0.01, 0, 'kPa'),
+    0x18 : (False, 0.0117, 0, 'kPa'),
+    0x19 : (False, 0.079, 0, 'kPa'),
+    0x1A : (False, 1, 0, 'kPa'),
+    0x1B : (False, 10, 0, 'kPa'),
+    0x1C : (False, 0.01, 0, 'deg'),
+    0x1D : (False, 0.5, 0, 'deg'),
+    0x1E : (False, 0.0000305, 0, 'lambda'),
+    0x1F : (False, 0.05, 0, 'A/F'),
+    0x20 : (False, 0.0039062, 0, ''),
+    0x21 : (False, 1, 0, 'mHz'),
+    0x22 : (False, 1, 0, 'Hz'),
+    0x23 : (False, 1, 0, 'kHz'),
+    0x24 : (False, 1, 0, 'counts'),
+    0x25 : (False, 1, 0, 'km'),
+    0x26 : (False, 0.1, 0, 'mV/ms'),
+    0x27 : (False, 0.01, 0, 'g/s'),
+    0x28 : (False, 1, 0, 'g/s'),
+    0x29 : (False, 0.25, 0, 'Pa/s'),
+    0x2A : (False, 0.001, 0, 'kg/h'),
+    0x2B : (False, 1, 0, 'switches'),
+    0x2C : (False, 0.01, 0, 'g/cyl'),
+    0x2D : (False, 0.01, 0, 'mg/stroke'),
+    0x2E : (False, 1, 0, ''),
+    0x2F : (False, 0.01, 0, '%'),
+    0x30 : (False, 0.001526, 0, '%'),
+    0x31 : (False, 0.001, 0, 'L'),
+    0x32 : (False, 0.0000305, 0, 'inch'),
+    0x33 : (False, 0.00024414, 0, ''),
+    0x34 : (False, 1, 0, 'min'),
+    0x35 : (False, 10, 0, 'ms'),
+    0x36 : (False, 0.01, 0, 'g'),
+    0x37 : (False, 0.1, 0, 'g'),
+    0x38 : (False, 1, 0, 'g'),
+    0x39 : (False, 0.01, -327.68, '%'),
+    0x3A : (False, 0.001, 0, 'g'),
+    0x3B : (False, 0.0001, 0, 'g'),
+    0x3C : (False, 0.1, 0, 'us'),
+    0x3D : (False, 0.01, 0, 'mA'),
+    0x3E : (False, 0.00006103516, 0, 'mm2'),
+    0x3F : (False, 0.01, 0, 'L'),
+    0x40 : (False, 1, 0, 'ppm'),
+    0x41 : (False, 0.01, 0, 'uA'),
+    0x81 : (True, 1, 0, ''),
+    0x82 : (True, 0.1, 0, ''),
+    0x83 : (True, 0.01, 0, ''),
+    0x84 : (True, 0.001, 0, ''),
+    0x85 : (True, 0.0000305, 0, ''),
+    0x86 : (True, 0.000305, 0, ''),
+    0x8A : (True, 0.122, 0, 'mV'),
+    0x8B : (True, 0.001, 0, 'V'),
+    0x8C : (True, 0.01, 0, 'V'),
+    0x8D : (True, 0.00390625, 0, 'mA'),
+    0x8E : (True, 0.001, 0, 'A'),
+    0x90 : (True, 1, 0, 'ms'),
+    0x96 : (True, 0.1, 0, 'C'),
+    0x99 : (True, 0.1, 0, 'kPa'),
+    0x9C : (True, 0.01, 0, 'deg'),
+    0x9D : (True, 0.5, 0, 'deg'),
+    0xA8 : (True, 1, 0, 'g/s'),
+    0xA9 : (True, 0.25, 0, 'Pa/s'),
+    0xAD : (True, 0.01, 0, 'mg/stroke'),
+    0xAE : (True, 0.1, 0, 'mg/stroke'),
+    0xAF : (True, 0.01, 0, '%'),
+    0xB0 : (True, 0.003052, 0, '%'),
+    0xB1 : (True, 2, 0, 'mV/s'),
+    0xFC : (True, 0.01, 0, 'kPa'),
+    0xFD : (True, 0.001, 0, 'kPa'),
+    0xFE : (True, 0.25, 0, 'Pa'),
+}
+
+
+MIDS = {
+    0x01 : _('O2 Sensor Monitor Bank 1 - Sensor 1'),
+    0x02 : _('O2 Sensor Monitor Bank 1 - Sensor 2'),
+    0x03 : _('O2 Sensor Monitor Bank 1 - Sensor 3'),
+    0x04 : _('O2 Sensor Monitor Bank 1 - Sensor 4'),
+    0x05 : _('O2 Sensor Monitor Bank 2 - Sensor 1'),
+    0x06 : _('O2 Sensor Monitor Bank 2 - Sensor 2'),
+    0x07 : _('O2 Sensor Monitor Bank 2 - Sensor 3'),
+    0x08 : _('O2 Sensor Monitor Bank 2 - Sensor 4'),
+    0x09 : _('O2 Sensor Monitor Bank 3 - Sensor 1'),
+    0x0A : _('O2 Sensor Monitor Bank 3 - Sensor 2'),
+    0x0B : _('O2 Sensor Monitor Bank 3 - Sensor 3'),
+    0x0C : _('O2 Sensor Monitor Bank 3 - Sensor 4'),
+    0x0D : _('O2 Sensor Monitor Bank 4 - Sensor 1'),
+    0x0E : _('O2 Sensor Monitor Bank 4 - Sensor 2'),
+    0x0F : _('O2 Sensor Monitor Bank 4 - Sensor 3'),
+    0x10 : _('O2 Sensor Monitor Bank 4 - Sensor 4'),
+    0x21 : _('Catalyst Monitor Bank 1'),
+    0x22 : _('Catalyst Monitor Bank 2'),
+    0x23 : _('Catalyst Monitor Bank 3'),
+    0x24 : _('Catalyst Monitor Bank 4'),
+    0x31 : _('EGR Monitor Bank 1'),
+    0x32 : _('EGR Monitor Bank 2'),
+    0x33 : _('EGR Monitor Bank 3'),
+    0x34 : _('EGR Monitor Bank 4'),
+    0x35 : _('VVT Monitor Bank 1'),
+    0x36 : _('VVT Monitor Bank 2'),
+    0x37 : _('VVT Monitor Bank 3'),
+    0x38 : _('VVT Monitor Bank 4'),
+    0x39 : _('EVAP Monitor (Cap Off / 0.150")'),
+    0x3A : _('EVAP Monitor (0.090")'),
+    0x3B : _('EVAP Monitor (0.040")'),
+    0x3C : _('EVAP Monitor (0.020")'),
+    0x3D : _('Purge Flow Monitor'),
+    0x41 : _('O2 Sensor Heater Monitor Bank 1 - Sensor 1'),
+    0x42 : _('O2 Sensor Heater Monitor Bank 1 - Sensor 2'),
+    0x43 : _('O2 Sensor Heater Monitor Bank 1 - Sensor 3'),
+    0x44 : _('O2 Sensor Heater Monitor Bank 1 - Sensor 4'),
+    0x45 : _('O2 Sensor Heater Monitor Bank 2 - Sensor 1'),
+    0x46 : _('O2 Sensor Heater Monitor Bank 2 - Sensor 2'),
+    0x47 : _('O2 Sensor Heater Monitor Bank 2 - Sensor 3'),
+    0x48 : _('O2 Sensor Heater Monitor Bank 2 - Sensor 4'),
+    0x49 : _('O2 Sensor Heater Monitor Bank 3 - Sensor 1'),
+    0x4A : _('O2 Sensor Heater Monitor Bank 3 - Sensor 2'),
+    0x4B : _('O2 Sensor Heater Monitor Bank 3 - Sensor 3'),
+    0x4C : _('O2 Sensor Heater Monitor Bank 3 - Sensor 4'),
+    0x4D : _('O2 Sensor Heater Monitor Bank 4 - Sensor 1'),
+    0x4E : _('O2 Sensor Heater Monitor Bank 4 - Sensor 2'),
+    0x4F : _('O2 Sensor Heater Monitor Bank 4 - Sensor 3'),
+    0x50 : _('O2 Sensor Heater Monitor Bank 4 - Sensor 4'),
+    0x61 : _('Heated Catalyst Monitor Bank 1'),
+    0x62 : _('Heated Catalyst Monitor Bank 2'),
+    0x63 : _('Heated Catalyst Monitor Bank 3'),
+    0x64 : _('Heated Catalyst Monitor Bank 4'),
+    0x71 : _('Secondary Air Monitor 1'),
+    0x72 : _('Secondary Air Monitor 2'),
+    0x73 : _('Secondary Air Monitor 3'),
+    0x74 : _('Secondary Air Monitor 4'),
+    0x81 : _('Fuel System Monitor Bank 1'),
+    0x82 : _('Fuel System Monitor Bank 2'),
+    0x83 : _('Fuel System Monitor Bank 3'),
+    0x84 : _('Fuel System Monitor Bank 4'),
+    0x85 : _('Boost Pressure Control Monitor Bank 1'),
+    0x86 : _('Boost Pressure Control Monitor Bank 2'),
+    0x90 : _('NOx Adsorber Monitor Bank 1'),
+    0x91 : _('NOx Adsorber Monitor Bank 2'),
+    0x98 : _('NOx Catalyst Monitor Bank 1'),
+    0x99 : _('NOx Catalyst Monitor Bank 2'),
+    0xA1 : _('Misfire Monitor General Data'),
+    0xA2 : _('Misfire Cylinder 1 Data'),
+    0xA3 : _('Misfire Cylinder 2 Data'),
+    0xA4 : _('Misfire Cylinder 3 Data'),
+    0xA5 : _('Misfire Cylinder 4 Data'),
+    0xA6 : _('Misfire Cylinder 5 Data'),
+    0xA7 : _('Misfire Cylinder 6 Data'),
+    0xA8 : _('Misfire Cylinder 7 Data'),
+    0xA9 : _('Misfire Cylinder 8 Data'),
+    0xAA : _('Misfire Cylinder 9 Data'),
+    0xAB : _('Misfire Cylinder 10 Data'),
+    0xAC : _('Misfire Cylinder 11 Data'),
+    0xAD : _('Misfire Cylinder 12 Data'),
+    0xB0 : _('PM Filter Monitor Bank 1'),
+    0xB1 : _('PM Filter Monitor Bank 2'),
+}
+
+
+def mid_name(mid):
+    return MIDS.get(mid, _('Monitor %02X') % mid)
+
+
+def scale(uasid, raw):
+    """Returns (value, units) for the raw 16 bit value of a test"""
+    signed, factor, offset, units = UASIDS.get(uasid, (False, 1, 0, ''))
+    if signed and raw & 0x8000:
+        raw -= 0x10000
+    return raw * factor + offset, units
+
+
+
+class TestResult(object):
+    """The outcome of one test, the value and limits are scaled"""
+
+    __slots__ = ('ecu', 'mid', 'tid', 'uasid', 'value', 'minimum',
+                 'maximum', 'units')
+
+    def __init__(self, ecu, mid, tid, uasid, value, minimum, maximum):
+        self.ecu = ecu
+        self.mid = mid
+        self.tid = tid
+        self.uasid = uasid
+        self.value, self.units = scale(uasid, value)
+        self.minimum = scale(uasid, minimum)[0]
+        self.maximum = scale(uasid, maximum)[0]
+
+
+    def _get_passed(self):
+        return self.minimum <= self.value <= self.maximum
+
+    passed = property(_get_passed)
+
+
+    def __repr__(self):
+        return '<TestResult %02X/%02X %g %s [%g, %g]>' % (
+                    self.mid, self.tid, self.value, self.units,
+                    self.minimum, self.maximum)
+
+
+
+def decode_supported_mids(data):
+    """Returns (mid, bitmap) tuples from the answer to a supported mids
+       request, data being the hex string starting with 46.
+    """
+    ret = []
+    data = data[2:]
+    while len(data) >= 10:
+        ret.append((int(data[:2], 16), data[2:10]))
+        data = data[10:]
+    return ret
+
+
+def decode_test_results(data, ecu=None):
+    """Returns the TestResults in the answer to a mode 06 request,
+       data being the hex string starting with 46.
+    """
+    ret = []
+    data = data[2:]
+    size = RECORD_LENGTH * 2
+    for i in xrange(0, len(data) - size + 1, size):
+        record = data[i:i + size]
+        ret.append(TestResult(ecu, int(record[0:2], 16),
+                              int(record[2:4], 16),
+                              int(record[4:6], 16),
+                              int(record[6:10], 16),
+                              int(record[10:14], 16),
+                              int(record[14:18], 16)))
+    return ret
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+#
+# pid_bitmap.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+# '0C' for pid 12 and the other way around
+PID_NAMES = tuple(['%02X' % pid for pid in range(256)])
+PID_NUMBERS = dict([(name, pid) for pid, name in enumerate(PID_NAMES)])
+
+# the pids a supported pids request can announce, 01 to FF. The last
+# bit of the answer to E0 would be pid 100, which does not exist.
+_RESPONSE_PIDS = (1 << len(PID_NAMES)) - 2
+
+
+class PIDBitmap(object):
+    """A set of supported pids, stored as one int per mode where bit n
+       is set when pid n is supported.
+
+       Members are commands like '010C'. A suffix can be given for modes
+       that take an extra argument, like the frame number of mode 02.
+    """
+
+    __slots__ = ('_masks', 'suffix')
+
+    def __init__(self, masks=None, suffix=''):
+        """ @param masks: dict mapping a mode ('01') to its mask
+            @param suffix: appended to every command, e.g. '01' for
+                           freeze frame 1
+        """
+        self._masks = dict(masks or {})
+        self.suffix = suffix
+
+
+    def add_response(self, mode, offset, data):
+        """Adds the pids from the data of a supported pids request.
+           @param mode: the mode of the request ('01')
+           @param offset: the pid of the request (0x00, 0x20, ...)
+           @param data: the 4 byte bitmap as hex string, the msb stands
+                        for pid offset + 1. Extra leading bytes, like
+                        the frame number of mode 02, are ignored.
+        """
+        data = data[-8:]
+        value = int(data, 16)
+        nbits = len(data) * 4
+        mask = 0
+        while value:
+            low = value & -value
+            mask |= 1 << (offset + nbits - low.bit_length() + 1)
+            value ^= low
+        mask &= _RESPONSE_PIDS
+        self._masks[mode] = self._masks.get(mode, 0) | mask
+
+
+    def add(self, command):
+        mode = command[:2]
+        self._masks[mode] = self._masks.get(mode, 0) | \
+                            1 << PID_NUMBERS[command[2:4]]
+
+
+    def pids(self, mode):
+        """Returns the supported pids of mode as a list of ints"""
+        ret = []
+        mask = self._masks.get(mode, 0)
+        while mask:
+            low = mask & -mask
+            ret.append(low.bit_length() - 1)
+            mask ^= low
+        return ret
+
+
+    def modes(self):
+        return sorted(self._masks.keys())
+
+
+    def copy(self):
+        return PIDBitmap(self._masks, self.suffix)
+
+
+    def __contains__(self, command):
+        if command[4:] != self.suffix:
+            return False
+        pid = PID_NUMBERS.get(command[2:4])
+        if pid is None:
+            return False
+        return bool(self._masks.get(command[:2], 0) >> pid & 1)
+
+
+    def __iter__(self):
+        for mode in self.modes():
+            for pid in self.pids(mode):
+                yield mode + PID_NAMES[pid] + self.suffix
+
+
+    def __len__(self):
+        return sum([bin(mask).count('1') for mask in self._masks.values()])
+
+
+    def __nonzero__(self):
+        return bool(len(self))
+
+
+    def _combine(self, other, op):
+        masks = {}
+        for mode in set(self._masks.keys()) | set(other._masks.keys()):
+            mask = op(self._masks.get(mode, 0), other._masks.get(mode, 0))
+            if mask:
+                masks[mode] = mask
+        return PIDBitmap(masks, self.suffix)
+
+    def __or__(self, other):
+        return self._combine(other, lambda a, b: a | b)
+
+    def __and__(self, other):
+        return self._combine(other, lambda a, b: a & b)
+
+    def __sub__(self, other):
+        return self._combine(other, lambda a, b: a & ~b)
+
+    def __eq__(self, other):
+        return isinstance(other, PIDBitmap) and \
+               self.suffix == other.suffix and \
+               (self - other)._masks == {} and \
+               (other - self)._masks == {}
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __repr__(self):
+        return '<PIDBitmap %s>' % list(self)
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+#
+# pipeline_stats.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+import time
+import string
+
+from garmon.histogram import Histogram
+
+
+# The moments a command passes, in order, with the stage that ends there:
+#   write      the device starts writing    queue: waiting in the queue
+#                                                  or for the device
+#   written    the command is written       write: serial write
+#   first-byte the answer starts coming in  latency: adapter and ecu
+#   received   the > prompt arrived         transfer: reading the answer
+#   parsed     the answer was checked       parse: error/SEARCHING checks
+#   decoded    the data was split per ecu   decode
+#   notified   the sensors were updated     notify: sensors and ui
+MARKS = ('dispatch', 'write', 'written', 'first-byte', 'received',
+         'parsed', 'decoded', 'notified')
+STAGES = ('queue', 'write', 'latency', 'transfer', 'parse', 'decode',
+          'notify')
+TOTAL = 'total'
+
+_STAGE_ENDING_AT = dict(zip(MARKS[1:], STAGES))
+
+
+class Span(object):
+    """The marks one command passed on its way through the pipeline"""
+
+    __slots__ = ('command', 'marks')
+
+    def __init__(self, command, dispatched=None):
+        self.command = command
+        self.marks = {}
+        if dispatched is not None:
+            self.marks['dispatch'] = dispatched
+
+    def mark(self, name):
+        self.marks[name] = time.time()
+
+    def duration(self, start, end):
+        """Returns the time between two marks, or None"""
+        if start in self.marks and end in self.marks:
+            return self.marks[end] - self.marks[start]
+        return None
+
+    def stages(self):
+        """Returns (stage, duration) tuples. When a mark is missing,
+           its stage is counted in the next one.
+        """
+        ret = []
+        previous = None
+        for name in MARKS:
+            t = self.marks.get(name)
+            if t is None:
+                continue
+            if previous is not None:
+                ret.append((_STAGE_ENDING_AT[name], max(t - previous, 0.0)))
+            previous = t
+        return ret
+
+
+
+class PipelineStats(object):
+    """Aggregates the spans of the executed commands in a histogram
+       per command and stage.
+    """
+
+    def __init__(self):
+        self.current = None
+        self._dispatched = {}
+        self._histograms = {}
+
+
+    def clear(self):
+        self._histograms = {}
+
+
+    def dispatch(self, command):
+        """Called when the queue hands command to the device"""
+        self._dispatched[command] = time.time()
+
+
+    def start(self, command):
+        """Called when the device starts writing command.
+           Returns a new Span.
+        """
+        span = Span(command, self._dispatched.pop(command, None))
+        span.mark('write')
+        return span
+
+
+    def mark(self, name):
+        """Marks the span of the command whose callbacks are running"""
+        if self.current is not None:
+            self.current.mark(name)
+
+
+    def finish(self, span):
+        """Adds the durations of span to the histograms"""
+        total = 0.0
+        for stage, duration in span.stages():
+            self.histogram(span.command, stage).add(duration)
+            total += duration
+        self.histogram(span.command, TOTAL).add(total)
+
+
+    def histogram(self, command, stage):
+        key = (command, stage)
+        try:
+            return self._histograms[key]
+        except KeyError:
+            hist = self._histograms[key] = Histogram()
+            return hist
+
+
+    def commands(self):
+        return sorted(set([command for command, stage in self._histograms]))
+
+
+    def stages(self, command):
+        """Returns (stage, histogram) tuples for command, in pipeline
+           order, followed by the total.
+        """
+        ret = []
+        for stage in STAGES + (TOTAL,):
+            hist = self._histograms.get((command, stage))
+            if hist is not None:
+                ret.append((stage, hist))
+        return ret
+
+
+    def report(self):
+        """Returns a table of the timings in ms, e.g. for the python
+           shell: print garmon.stats.report()
+        """
+        def ms(value):
+            if value is None:
+                return '-'
+            return '%.2f' % (value * 1000)
+
+        lines = ['%-8s %-9s %7s %8s %8s %8s %8s %8s' % (
+                    'command', 'stage', 'n', 'mean', 'p50', 'p90', 'p99',
+                    'max')]
+        for command in self.commands():
+            for stage, hist in self.stages(command):
+                lines.append('%-8s %-9s %7d %8s %8s %8s %8s %8s' % (
+                    command, stage, hist.count, ms(hist.mean()),
+                    ms(hist.percentile(50)), ms(hist.percentile(90)),
+                    ms(hist.percentile(99)), ms(hist.max)))
+        return string.join(lines, '\n')
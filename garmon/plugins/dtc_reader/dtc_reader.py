@@ -40,15 +40,22 @@ from garmon.sensor import decode_dtc_code
 __name = _('DTC Reader')
 __version = garmon.version
 __author = 'Ben Van Mechelen'
-__description = _('Reads the stored trouble codes from the vehicle')
+__description = _('Reads the stored, pending and permanent trouble codes from the vehicle')
 __class = 'DTCReader'
 
 
 (
     COLUMN_CODE,
     COLUMN_DTC,
-    COLUMN_DESC
-) = range(3)
+    COLUMN_DESC,
+    COLUMN_MODE,
+    COLUMN_KIND,
+    COLUMN_ECU
+) = range(6)
+
+DTC_KINDS = {'03' : _('Stored'),
+             '07' : _('Pending'),
+             '0A' : _('Permanent')}
 
 
 class DTCReader (gtk.VBox, Plugin):
@@ -79,6 +86,9 @@ class DTCReader (gtk.VBox, Plugin):
 
 
         self.treemodel = gtk.ListStore(gobject.TYPE_STRING,
+                                                        gobject.TYPE_STRING,
+                                                        gobject.TYPE_STRING,
+                                                        gobject.TYPE_STRING,
                                                         gobject.TYPE_STRING,
                                                         gobject.TYPE_STRING)
         treeview = gtk.TreeView(self.treemodel)
@@ -89,6 +99,12 @@ class DTCReader (gtk.VBox, Plugin):
         column = gtk.TreeViewColumn(_('DTC'), gtk.CellRendererText(),
                                     text=COLUMN_DTC)
         treeview.append_column(column)
+        column = gtk.TreeViewColumn(_('Type'), gtk.CellRendererText(),
+                                    text=COLUMN_KIND)
+        treeview.append_column(column)
+        column = gtk.TreeViewColumn(_('ECU'), gtk.CellRendererText(),
+                                    text=COLUMN_ECU)
+        treeview.append_column(column)
         
         selection = treeview.get_selection()
         selection.set_mode(gtk.SELECTION_SINGLE)
@@ -133,30 +149,60 @@ class DTCReader (gtk.VBox, Plugin):
 
 
     def _reread_button_clicked(self, button):
-        self.start()
+        self.start(force=True)
 
 
     def stop(self):
         pass
         
 
-    def start(self):
-        def success_cb(cmd, dtcs, args):
-            self.treemodel.clear()
-            for code in dtcs:
-                dtc = decode_dtc_code(code)
-                desc = DTC_CODES[dtc]
-                iter = self.treemodel.append(None)
-                self.treemodel.set(iter, COLUMN_CODE, code,
-                                         COLUMN_DTC, dtc,
-                                         COLUMN_DESC, desc)  
+    def _update_model(self, dtcs):
+        """Makes the model show dtcs, only touching the rows that 
+           changed so the selection stays put.
+        """
+        wanted = []
+        for ecu, modes in dtcs.items():
+            for mode, codes in modes.items():
+                for code in codes:
+                    wanted.append((ecu or '', mode, code))
+                    
+        present = []
+        iter = self.treemodel.get_iter_first()
+        while iter:
+            key = self.treemodel.get(iter, COLUMN_ECU, COLUMN_MODE, 
+                                           COLUMN_CODE)
+            if key in wanted:
+                present.append(key)
+                iter = self.treemodel.iter_next(iter)
+            elif not self.treemodel.remove(iter):
+                iter = None
+                
+        for key in sorted(wanted):
+            if key in present:
+                continue
+            ecu, mode, code = key
+            dtc = decode_dtc_code(code)
+            desc = DTC_CODES.get(dtc, '')
+            iter = self.treemodel.append(None)
+            self.treemodel.set(iter, COLUMN_CODE, code,
+                                     COLUMN_DTC, dtc,
+                                     COLUMN_DESC, desc,
+                                     COLUMN_MODE, mode,
+                                     COLUMN_KIND, DTC_KINDS[mode],
+                                     COLUMN_ECU, ecu)  
         
-        def error_cb(cmd, error, args):
-            self._display_port_error_dialog(error)             
 
-        self.app.queue.stop()
+    def start(self, force=False):
+        """Reads the trouble codes while the queue keeps running.
+           @param force: read all codes, even when the dtc status of the
+                         ecus didn't change since the last read.
+        """
+        def error_cb(mode, msg):
+            self._display_port_error_dialog(
+                        (_('Reading mode %s failed') % mode, msg))
+
         try:
-            self.app.device.read_dtc(success_cb, error_cb)
+            self.app.device.read_all_dtc(self._update_model, error_cb, force)
         except OBDPortError, e:
             self._display_port_error_dialog(e)
             
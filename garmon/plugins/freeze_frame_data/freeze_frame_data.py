@@ -40,6 +40,7 @@ from garmon.device import OBDDataError, OBDPortError
 from garmon.sensor import StateMixin, UnitMixin
 from garmon.sensor import Command, Sensor
 from garmon.sensor import decode_dtc_code
+from garmon.pid_bitmap import PIDBitmap, PID_NAMES, PID_NUMBERS
 from garmon.widgets import SensorView, SensorProgressView
 
 
@@ -50,6 +51,24 @@ __description = _('View Freeze Frame data associated with a certain dtc\n\nEXPER
 __class = 'FreezeFramePlugin'
 
 
+# frames probed for a dtc, starting at 00
+MAX_FRAMES = 8
+
+# (vehicle, dtc, frame) -> (supported pids, values) of the frames read 
+# before and vehicle -> [(frame, dtc), ...] of the last read, so the 
+# ecu isn't asked again for data that can't change until the dtcs 
+# are cleared
+_frame_cache = {}
+_stored_frames = {}
+
+
+def _forget_frames(vehicle):
+    """Drops what is cached of vehicle, e.g. after clearing the dtcs"""
+    _stored_frames.pop(vehicle, None)
+    for key in _frame_cache.keys():
+        if key[0] == vehicle:
+            del _frame_cache[key]
+
 
 class FreezeFrame (GObject, PropertyObject):
     __gtype_name__ = 'FreezeFrame'
@@ -89,7 +108,6 @@ class FreezeFrame (GObject, PropertyObject):
         
         self._setup_gui()
         self._setup_sensors()
-        self._get_supported_pids()
 
 		
     def _setup_gui(self):
@@ -112,7 +130,7 @@ class FreezeFrame (GObject, PropertyObject):
 
         for item in SENSORS: 
             label = entry = unit = None
-            pid = item[PID] + '%0*d' % (2, int(self._frame))
+            pid = item[PID] + self._frame
             index = item[INDEX]
             if item[LABEL]:
                 label = self._builder.get_object(item[LABEL])
@@ -130,7 +148,7 @@ class FreezeFrame (GObject, PropertyObject):
 
         for item in PROGRESS: 
             label = bar = None
-            pid = item[PID] + '%0*d' % (2, int(self._frame))
+            pid = item[PID] + self._frame
             index = item[INDEX]
             if item[LABEL]:
                 label = self._builder.get_object(item[LABEL])
@@ -145,39 +163,21 @@ class FreezeFrame (GObject, PropertyObject):
             self._views.append(view)				
 
 
-    def _get_supported_pids(self):
-
-        def data_changed_cb(cmd, pspec):
-            offset = int(cmd.command[2:4])
-            self._supported_pids += decode_pids_from_bitstring(cmd.data, offset, self._frame)
-            next = '%d' % (offset + 20)
-            if '02' + next in self._supported_pids:
-                command = Command('02' + next + self._frame)
-                command.connect('notify::data', data_changed_cb)
-                self.plugin.app.queue.add(command, True)
-            else:
-                self._update_supported_views()
-
-        def error_cb(cmd, msg, args):
-            log.error('error reading supported pids, msg is: %s' % msg)
-            raise OBDPortError('OpenPortFailed', 
-                               _('could not read supported pids\n\n' + msg))
-
-        self._supported_pids = []
-        command = Command('0200' + self._frame)
-        command.connect('notify::data', data_changed_cb)
-        self.plugin.app.queue.add(command, True)
-
-           
-    def _update_supported_views(self):
-        log.debug('in update_supported_views')
+    def show(self, pids, values):
+        """Shows the data read for this frame
+           @param pids: the supported pids, a PIDBitmap
+           @param values: maps a pid ('0C') to its data
+        """
+        log.debug('showing freeze frame %s' % self._frame)
         for view in self._views:
-            if view.command.command in self._supported_pids:
-                view.supported=True
-                view.active=True
+            command = view.command.command
+            supported = command in pids
+            view.supported = supported
+            view.active = supported
+            if supported:
+                view.command.data = values.get(command[2:4])
             else:
-                view.supported=False
-                view.active=False
+                view.command.data = None
 
                 
     def _notify_units_cb(self, pname, pvalue, args):
@@ -191,19 +191,10 @@ class FreezeFrame (GObject, PropertyObject):
 
             
     def _read_button_clicked(self, button):
-        self.update()
-
-
-    def update(self):
-        log.debug('entering FreezeFrame.update')
-        for view in self._views:
-            if view.supported:
-                self.plugin.app.queue.add(view.command, True)
-        self.plugin.app.queue.start()
+        self.plugin.update(force=True)
 
     
-        def unload(self):
-            self.app.notebook.remove(self)
+    def unload(self):
         for name, cb_id in self._pref_cbs:
             self.plugin.app.prefs.remove_watch(name, cb_id)
         for cb_id in self._app_cbs:
@@ -241,7 +232,8 @@ class FreezeFramePlugin (Plugin, PropertyObject):
 
         self.status = STATUS_STOP
 
-        self._frames = []
+        self._frames = {}
+        self._reading = False
 
         self._setup_gui()
 		
@@ -251,23 +243,123 @@ class FreezeFramePlugin (Plugin, PropertyObject):
         self._frames_notebook = gtk.Notebook()
         self._main_box.pack_start(self._frames_notebook)
 
-        #FIXME: Only 1 frame for the moment
-        for item in range(1):
-            frame = FreezeFrame(self, '%0*d' % (2, item))
-            self._frames_notebook.append_page(frame.widget, 
-                                        gtk.Label(_('Frame %s') % frame.frame))
-            self._frames.append(frame)
+        self._get_frame('00')
            
         self._main_box.show_all()
+        
+        
+    def _get_frame(self, frame):
+        """Returns the FreezeFrame for frame, adding a page if needed"""
+        if not frame in self._frames:
+            self._frames[frame] = FreezeFrame(self, frame)
+            self._frames_notebook.append_page(self._frames[frame].widget, 
+                                        gtk.Label(_('Frame %s') % frame))
+        return self._frames[frame]
+        
+        
+    def _remove_frame(self, frame):
+        freeze_frame = self._frames.pop(frame)
+        self._frames_notebook.remove(freeze_frame.widget)
+        freeze_frame.unload()
+        
+        
+    def _show_frames(self, vehicle, stored):
+        for frame in self._frames.keys():
+            if frame != '00' and not frame in [item[0] for item in stored]:
+                self._remove_frame(frame)
+        if not stored:
+            self._get_frame('00').show(PIDBitmap(suffix='00'), {})
+        for frame, dtc in stored:
+            pids, values = _frame_cache[(vehicle, dtc, frame)]
+            self._get_frame(frame).show(pids, values)
+            
+            
+    def _dtc_cleared_cb(self, device):
+        vehicle = device.vehicle and device.vehicle.key
+        _forget_frames(vehicle)
+        self._show_frames(vehicle, [])
+        
+        
+    def _notebook_page_change_cb (self, notebook, no_use, page):
+        if notebook.get_nth_page(page) is self._main_box:
+            vehicle = self.app.device.vehicle
+            if vehicle and vehicle.key in _stored_frames:
+                self._show_frames(vehicle.key, _stored_frames[vehicle.key])
+            elif self.app.device.connected:
+                self.update()
+                
+                
+    def update(self, force=False):
+        """Finds the stored freeze frames by asking the dtc of every
+           frame, then reads the ones that are not in the cache, or all
+           of them if force is set.
+        """
+        if self._reading:
+            return
+        device = self.app.device
+        vehicle = device.vehicle and device.vehicle.key
+        stored = []
+        
+        def dtc_cb(frame, values):
+            dtc = values.get('02')
+            if not dtc or dtc == '0000':
+                read_next()
+                return
+            stored.append((frame, dtc))
+            if force:
+                _frame_cache.pop((vehicle, dtc, frame), None)
+            if int(frame, 16) + 1 < MAX_FRAMES:
+                device.read_freeze_frame('%02X' % (int(frame, 16) + 1), 
+                                         ['02'], dtc_cb, error_cb)
+            else:
+                read_next()
+                
+        def error_cb(frame, msg):
+            log.error('error reading freeze frame %s, msg is: %s' % 
+                      (frame, msg))
+            self._reading = False
+            
+        def pids_cb(frame, pids):
+            dtc = [item[1] for item in stored if item[0] == frame][0]
+            
+            def values_cb(frame, values):
+                _frame_cache[(vehicle, dtc, frame)] = (pids, values)
+                read_next()
+                
+            # skip the supported pids bitmaps themselves
+            device.read_freeze_frame(frame, 
+                                     [PID_NAMES[pid] for pid in pids.pids('02')
+                                                     if pid % 0x20],
+                                     values_cb, error_cb)
+                                     
+        def read_next():
+            for frame, dtc in stored:
+                if not (vehicle, dtc, frame) in _frame_cache:
+                    device.read_freeze_frame_pids(frame, pids_cb, error_cb)
+                    return
+            _stored_frames[vehicle] = stored
+            self._show_frames(vehicle, stored)
+            self._reading = False
+            
+        self._reading = True
+        try:
+            device.read_freeze_frame('00', ['02'], dtc_cb, error_cb)
+        except OBDPortError, e:
+            self._reading = False
+            log.error('could not read freeze frames: %s' % e[1])
 
 			
     def load(self):
         self.app.notebook.append_page(self._main_box, gtk.Label(_('Freeze Frame Data')))
+        self._notebook_cbs.append(self.app.notebook.connect('switch-page', 
+                                            self._notebook_page_change_cb))
+        self._obd_cbs.append(self.app.device.connect('dtc-cleared',
+                                            self._dtc_cleared_cb))
 
 		
     def unload(self):
         self.app.notebook.remove(self._main_box)
-        for frame in self._frames:
+        for frame in self._frames.values():
             frame.unload()
         for name, cb_id in self._pref_cbs:
             self.app.prefs.remove_watch(name, cb_id)
@@ -279,6 +371,9 @@ class FreezeFramePlugin (Plugin, PropertyObject):
             self.app.queue.disconnect(cb_id)
         for cb_id in self._obd_cbs:
             self.app.device.disconnect(cb_id)
+        # dtcs cleared while unloaded would go unnoticed
+        _frame_cache.clear()
+        _stored_frames.clear()
 
 
 
@@ -290,22 +385,6 @@ def _dtc_code_helper(view):
 
 
 
-def decode_pids_from_bitstring(data, offset, suffix):
-    log.debug('entering decode_pids_from_bitstring')
-    pids = []
-    for item in data:
-        bitstr = sensor.hex_to_bitstr(item)
-        for i, bit in enumerate(bitstr):
-            if bit == "1":
-                pid = i + 1 + offset
-                if pid < 16: 
-                    pid_str = '020' + hex(pid)[2:] + suffix
-                else:
-                    pid_str = '02' + hex(pid)[2:] + suffix
-                pids.append(pid_str.upper())
-    return pids
-
-        
 (COMMAND, NAME) = range(2)
 
 (PID, INDEX, HELPER, LABEL, ENTRY, UNIT) = range (6)
@@ -23,6 +23,7 @@
 #   Boston, MA  02110-1301, USA.
 
 import os
+import time
 
 import gobject
 from gobject import GObject
@@ -39,6 +40,7 @@ from garmon.device import OBDDataError, OBDPortError
 from garmon.sensor import StateMixin, UnitMixin
 from garmon.sensor import Command, Sensor
 from garmon.widgets import MILWidget, SensorView, CommandView, SensorProgressView
+from garmon.widgets import StripChart
 
 
 __name = _('Live Data')
@@ -81,6 +83,8 @@ class LiveData (gtk.VBox, Plugin):
 
         self._obd_cbs.append(app.device.connect('connected', 
                                              self._device_connected_cb))
+        self._obd_cbs.append(app.device.connect('supported-pids-changed', 
+                                             self._supported_pids_changed_cb))
         self._notebook_cbs.append(app.notebook.connect('switch-page', 
                                                   self._notebook_page_change_cb))
         
@@ -100,6 +104,10 @@ class LiveData (gtk.VBox, Plugin):
         main_hbox = self._builder.get_object('main_hbox')
         self.pack_start(main_hbox)
         main_hbox.show_all()
+        
+        self._chart = StripChart()
+        self._chart.set_size_request(-1, 150)
+        self.pack_start(self._chart, False, False)
         self.show_all()
         
         button = self._builder.get_object('deactivate_button')
@@ -142,6 +150,8 @@ class LiveData (gtk.VBox, Plugin):
                 self.os_views.append(view)
             else:
                 self.views.append(view)
+                view.command.connect('notify::data', self._chart_data_cb, 
+                                     view)
 
         
         for item in PROGRESS: 
@@ -166,6 +176,8 @@ class LiveData (gtk.VBox, Plugin):
                 self.os_views.append(view)
             else:
                 self.views.append(view)
+                view.command.connect('notify::data', self._chart_data_cb, 
+                                     view)
 
         
         for item in COMMANDS: 
@@ -209,6 +221,21 @@ class LiveData (gtk.VBox, Plugin):
                 self.app.queue.add(view.command)
         else:
             self.app.queue.remove(view.command)
+            if isinstance(view.command, Sensor):
+                self._chart.remove_trace((view.command.command, 
+                                          view.command.index))
+    
+    
+    def _chart_data_cb(self, command, pspec, view):
+        if not view.active:
+            return
+        try:
+            value = float(command.metric_value)
+        except (TypeError, ValueError):
+            return
+        key = (command.command, command.index)
+        self._chart.add_trace(key, command.name)
+        self._chart.add_sample(key, time.time(), value)
     
     
     def _deactivate_clicked_cb(self, button):
@@ -219,15 +246,18 @@ class LiveData (gtk.VBox, Plugin):
     
     def _update_supported_views(self):
         log.debug('in update_supported_views')
+        if self.app.device:
+            supported = self.app.device.filter_supported(
+                            [view.command.command for views in 
+                                (self.views, self.os_views) for view in views])
+        else:
+            supported = frozenset()
         for views in (self.views, self.os_views):
             for view in views:
-                if self.app.device:
-                    if view.command.command in self.app.device.supported_commands:
-                        view.supported=True
-                        if view in self.os_views or view.command.command == '0101':
-                            view.active=True
-                    else:
-                        view.supported=False
+                if view.command.command in supported:
+                    view.supported=True
+                    if views is self.os_views or view.command.command == '0101':
+                        view.active=True
                 else:
                     view.supported=False
    
@@ -241,6 +271,7 @@ class LiveData (gtk.VBox, Plugin):
         for view in self.os_views:
             if view.active:
                 self.app.queue.add(view.command, True)
+        self._chart.start()
         self.status = STATUS_WORKING
         
             
@@ -251,6 +282,7 @@ class LiveData (gtk.VBox, Plugin):
             for view in views:
                 self.app.queue.remove(view.command)
                 view.command.clear()
+        self._chart.stop()
         self.status = STATUS_STOP
         
         
@@ -263,6 +295,10 @@ class LiveData (gtk.VBox, Plugin):
             self.start()
 
 
+    def _supported_pids_changed_cb(self, device):
+        self._update_supported_views()
+
+
     def _notify_units_cb(self, pname, pvalue, args):
         if pname == 'imperial' and pvalue:
             self._unit_standard = 'Imperial'
@@ -388,6 +424,14 @@ SENSORS= [
          None, 'egr_button', 'egr_entry', 'egr_unit_label'),
         ('012D', 0, False, None, 
          None, 'egr_error_button', 'egr_error_entry', 'egr_error_unit_label'),
+        ('fuel-economy', 0, False, None,
+         None, 'fuel_economy_button', 'fuel_economy_entry', 'fuel_economy_unit_label'),
+        ('fuel-economy', 1, False, None,
+         None, 'fuel_flow_button', 'fuel_flow_entry', 'fuel_flow_unit_label'),
+        ('boost', 0, False, None,
+         None, 'boost_button', 'boost_entry', 'boost_unit_label'),
+        ('power', 0, False, None,
+         None, 'power_button', 'power_entry', 'power_unit_label'),
         ]
 
    
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+#
+# monitor_tests.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+# 
+# This file is part of Garmon 
+# 
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+import time
+
+import gobject
+import gtk
+
+import garmon
+
+from garmon.plugin import Plugin, STATUS_STOP, STATUS_WORKING
+from garmon.device import OBDPortError
+from garmon.mode06 import mid_name
+from garmon.logger import log
+
+__name = _('Monitor Tests')
+__version = garmon.version
+__author = 'Ben Van Mechelen'
+__description = _('Reads the on-board monitoring test results (mode 06), e.g. of the catalyst and O2 sensor monitors')
+__class = 'MonitorTests'
+
+
+(
+    COLUMN_NAME,
+    COLUMN_VALUE,
+    COLUMN_MIN,
+    COLUMN_MAX,
+    COLUMN_UNITS,
+    COLUMN_STATUS
+) = range(6)
+
+
+class MonitorTests (gtk.VBox, Plugin):
+    __gtype_name__='MonitorTests'
+    def __init__(self, app):
+        gtk.VBox.__init__(self)
+        Plugin.__init__(self)
+        
+        self.app = app
+        self.status = STATUS_STOP
+        self._results = None
+        
+        self.treemodel = gtk.TreeStore(gobject.TYPE_STRING,
+                                       gobject.TYPE_STRING,
+                                       gobject.TYPE_STRING,
+                                       gobject.TYPE_STRING,
+                                       gobject.TYPE_STRING,
+                                       gobject.TYPE_STRING)
+        treeview = gtk.TreeView(self.treemodel)
+        treeview.set_rules_hint(True)
+        for title, column_id in ((_('Test'), COLUMN_NAME),
+                                 (_('Value'), COLUMN_VALUE),
+                                 (_('Min'), COLUMN_MIN),
+                                 (_('Max'), COLUMN_MAX),
+                                 (_('Units'), COLUMN_UNITS),
+                                 (_('Status'), COLUMN_STATUS)):
+            column = gtk.TreeViewColumn(title, gtk.CellRendererText(),
+                                        text=column_id)
+            treeview.append_column(column)
+        
+        sw = gtk.ScrolledWindow()
+        sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        sw.add(treeview)
+        self.pack_start(sw, True, True)
+        
+        hbox = gtk.HBox(False, 5)
+        hbox.set_border_width(5)
+        self._info_label = gtk.Label()
+        self._info_label.set_alignment(0, 0.5)
+        hbox.pack_start(self._info_label, True, True)
+        button = gtk.Button(_('Read'))
+        button.set_image(gtk.image_new_from_stock(gtk.STOCK_REFRESH, 
+                                                  gtk.ICON_SIZE_BUTTON))
+        button.connect('clicked', self._read_button_clicked)
+        hbox.pack_start(button, False, False)
+        self.pack_start(hbox, False, False)
+        
+        self.show_all()
+        
+        self._switch_cbid = app.notebook.connect('switch-page', 
+                                              self._notebook_page_change_cb)
+        
+
+    def _notebook_page_change_cb (self, notebook, no_use, page):
+        plugin = notebook.get_nth_page(page)
+        if plugin is self and self._results is None and \
+           self.app.device.connected:
+            self.start()
+
+
+    def _read_button_clicked(self, button):
+        self.start()
+
+
+    def _show_results(self, results):
+        self.treemodel.clear()
+        parents = {}
+        failed = 0
+        for result in results:
+            key = (result.ecu, result.mid)
+            if not key in parents:
+                name = mid_name(result.mid)
+                if result.ecu:
+                    name = '%s (%s)' % (name, result.ecu)
+                parents[key] = self.treemodel.append(None)
+                self.treemodel.set(parents[key], COLUMN_NAME, name)
+            if result.passed:
+                status = _('Passed')
+            else:
+                status = _('Failed')
+                failed += 1
+            iter = self.treemodel.append(parents[key])
+            self.treemodel.set(iter, COLUMN_NAME, _('Test %02X') % result.tid,
+                                     COLUMN_VALUE, '%g' % result.value,
+                                     COLUMN_MIN, '%g' % result.minimum,
+                                     COLUMN_MAX, '%g' % result.maximum,
+                                     COLUMN_UNITS, result.units,
+                                     COLUMN_STATUS, status)
+        self._info_label.set_text(_('%d tests, %d failed') % 
+                                  (len(results), failed))
+
+
+    def stop(self):
+        self.status = STATUS_STOP
+        
+
+    def start(self):
+        if self.status == STATUS_WORKING:
+            return
+        started = time.time()
+        
+        def success_cb(results):
+            log.info('read %d monitor tests in %.1fs' % 
+                     (len(results), time.time() - started))
+            self.status = STATUS_STOP
+            self._results = results
+            self._show_results(results)
+        
+        def error_cb(cmd, msg):
+            self.status = STATUS_STOP
+            self._display_port_error_dialog(
+                        (_('Reading %s failed') % cmd, msg))
+
+        self.status = STATUS_WORKING
+        self._info_label.set_text(_('Reading...'))
+        try:
+            self.app.device.read_monitor_tests(success_cb, error_cb)
+        except OBDPortError, e:
+            self.status = STATUS_STOP
+            self._display_port_error_dialog(e)
+            
+
+    def load(self):
+        self.app.notebook.append_page(self, gtk.Label(_('Monitor Tests')))
+                
+                
+    def unload(self):
+        self.app.notebook.disconnect(self._switch_cbid)    
+        self.app.notebook.remove(self)
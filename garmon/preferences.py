@@ -25,9 +25,11 @@
 
 
 import os
-import random
 import string
+import itertools
+import threading
 import collections
+import StringIO
 import gtk
 import gobject
 from gobject import GObject
@@ -59,33 +61,73 @@ class _PrefsDialog (gtk.Dialog):
 
 
 
-class _Watch(object):
-    def __init__(self, name):
-        self.name = name
-        self.cb_ids = []
+SAVE_DELAY = 2
+
+
+def _split_name(name):
+    if not '.' in name:
+        return 'General', name
+    return name.split('.', 1)
+
+
+def _convert(value, ptype):
+    """Converts value, possibly a string read from the config file, 
+       to ptype"""
+    if ptype is None or isinstance(value, ptype):
+        return value
+    if ptype is str and isinstance(value, basestring):
+        return value
+    if ptype is bool:
+        return value in ('True', 'true', 'yes', '1', 1)
+    return ptype(value)
+
 
-        
                 
 class PreferenceManager(GObject):
+    """Keeps the preferences in memory as typed values.
+    
+       The config file is only read at startup. Changes are written to 
+       disk a few seconds after the last change, from a separate thread,
+       by writing a temporary file and renaming it over the old one.
+    """
     __gtype_name__ ='PreferenceManager'
     
     def __init__(self, app):
         GObject.__init__(self)
 
         self.app = app
-        self._config = ConfigParser()
         self._filename = os.path.join(save_config_path("garmon"), "config")
-        self._config.read(self._filename)
+        
+        # name -> value as read from the file, until it is registered
+        self._raw = {}
+        self._values = {}
+        self._types = {}
+        
+        config = ConfigParser()
+        config.read(self._filename)
+        for section in config.sections():
+            for option, value in config.items(section):
+                if section == 'General':
+                    self._raw[option] = value
+                else:
+                    self._raw[section + '.' + option] = value
         
         self._dialog = _PrefsDialog()
         
-        self._watches = []
+        # name -> {cb_id: (cb, args)}
+        self._watches = {}
+        self._watch_ids = itertools.count(1)
+        
+        self._save_id = None
+        self._save_generation = 0
+        self._saved_generation = 0
+        self._save_lock = threading.Lock()
         
 
     def _pref_notify_cb(self, pname, pvalue, args):
         widget = args[0]
         if hasattr(widget, 'set_text'):
-            widget.set_text(pvalue)
+            widget.set_text(str(pvalue))
         elif isinstance(widget, gtk.ColorButton):
             widget.set_color(gtk.gdk.color_parse(pvalue))
         elif isinstance(widget, gtk.ToggleButton):
@@ -127,77 +169,69 @@ class PreferenceManager(GObject):
         
         
     def notify(self, name):
-        for watch in self._watches:
-            if watch.name == name:
-                value = self.get(name)
-                for cb_id, cb, args in watch.cb_ids:
-                    cb(name, value, args)
+        if name in self._watches:
+            value = self.get(name)
+            for cb, args in self._watches[name].values():
+                cb(name, value, args)
 
 
     def add_watch(self, name, cb, *args):
         if not isinstance(cb, collections.Callable):
             raise AttributeError, 'cb is not callable'
-        watch = None
-        for item in self._watches:
-            if item.name == name:
-                watch = item
-        if watch is None:
-            watch = _Watch(name)
-            self._watches.append(watch)
-        cb_id = random.randint(1, 1000000)
-        watch.cb_ids.append((cb_id, cb, args))
+        cb_id = self._watch_ids.next()
+        self._watches.setdefault(name, {})[cb_id] = (cb, args)
         return cb_id
         
 
     def remove_watch(self, name, cb_id):
-        for watch in self._watches:
-            if watch == name:
-                for item in cb_ids:
-                    if item[0] == cb_id:
-                        cb_ids.remove(item)
+        watches = self._watches.get(name)
+        if watches and cb_id in watches:
+            del watches[cb_id]
+            if not watches:
+                del self._watches[name]
   
       
     def get(self, name, default=None):
-        if not '.' in name:
-            section = 'General'
-            option = name
-        else:
-            section, option = name.split('.')
-            
         try:
-            value = self._config.get(section, option)
-        except:
-            if default:
-                self.set(name, default)
-                value = default
-            else:
-                raise ValueError, 'No pref with name "%s" found and no default value given' % name 
-        return value
+            return self._values[name]
+        except KeyError:
+            pass
+        if name in self._raw:
+            ptype = None
+            if default is not None:
+                ptype = type(default)
+            value = _convert(self._raw.pop(name), ptype)
+            self._values[name] = value
+            return value
+        if default is not None:
+            self.set(name, default)
+            return default
+        raise ValueError, 'No pref with name "%s" found and no default value given' % name 
 
        
     def set(self, name, value):
-        if not '.' in name:
-            section = 'General'
-            option = name
-        else:
-            section, option = name.split('.')
-        if not self._config.has_section(section):
-            self._config.add_section(section)
-        self._config.set(section, option, value)
+        value = _convert(value, self._types.get(name))
+        if name in self._values and self._values[name] == value:
+            return
+        self._values[name] = value
+        self._raw.pop(name, None)
+        self._schedule_save()
         self.notify(name)
         
     
     def register(self, name, default):
-        if not '.' in name:
-            section = 'General'
-            option = name
+        ptype = type(default)
+        self._types[name] = ptype
+        if name in self._values:
+            self._values[name] = _convert(self._values[name], ptype)
+        elif name in self._raw:
+            try:
+                self._values[name] = _convert(self._raw.pop(name), ptype)
+            except ValueError:
+                log.warning('invalid value for %s, using default' % name)
+                self._values[name] = default
         else:
-            section, option = name.split('.')
-        
-        if not self._config.has_section(section):
-            self._config.add_section(section)
-        if not self._config.has_option(section, option):
-            self._config.set(section, option, default)
+            self._values[name] = default
         
         
     def show_dialog(self):
@@ -245,10 +279,63 @@ class PreferenceManager(GObject):
                     self.notify(pname)
 
 
+    def _schedule_save(self):
+        if self._save_id is None:
+            self._save_id = gobject.timeout_add_seconds(SAVE_DELAY,
+                                                        self._save_timeout_cb)
+                                                        
+                                                        
+    def _save_timeout_cb(self):
+        self._save_id = None
+        generation, data = self._snapshot()
+        thread = threading.Thread(target=self._write, args=(generation, data))
+        thread.start()
+        return False
+        
+        
+    def _snapshot(self):
+        config = ConfigParser()
+        items = self._raw.items() + self._values.items()
+        for name, value in items:
+            section, option = _split_name(name)
+            if not config.has_section(section):
+                config.add_section(section)
+            config.set(section, option, value)
+        f = StringIO.StringIO()
+        config.write(f)
+        self._save_generation += 1
+        return self._save_generation, f.getvalue()
+        
+        
+    def _write(self, generation, data):
+        self._save_lock.acquire()
+        try:
+            if generation <= self._saved_generation:
+                # a newer snapshot was written already
+                return
+            tmp = self._filename + '.tmp'
+            try:
+                f = open(tmp, 'w')
+                try:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+                os.rename(tmp, self._filename)
+                self._saved_generation = generation
+            except (IOError, OSError), e:
+                log.error('could not save preferences: %s' % e)
+        finally:
+            self._save_lock.release()
+            
+
     def save(self):
-        f = file(self._filename, 'w')
-        self._config.write(f)
-        f.close()
+        """Writes the preferences to disk right away"""
+        if self._save_id is not None:
+            gobject.source_remove(self._save_id)
+            self._save_id = None
+        self._write(*self._snapshot())
   
 
 
@@ -0,0 +1,643 @@
+#!/usr/bin/python
+#
+# recorder.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+import os
+import time
+import mmap
+import string
+import struct
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+
+from garmon.sensor import numeric_values, result_values
+from garmon import blocks
+from garmon.logger import log
+
+
+RECORDING_HEADER = '# garmon recording'
+# a line of text per result
+TEXT = 1
+# blocks.py, with the zlib or no compression
+PACKED = 2
+ROLLUP_HEADER = '# garmon rollups 1'
+ROLLUP_SUFFIX = '.rollups'
+INDEX_HEADER = '# garmon index 1'
+INDEX_SUFFIX = '.index'
+
+# the results are written in blocks of this many seconds
+BLOCK_SECONDS = 10.0
+
+# the bucket widths in seconds of the rollup levels, finest first
+ROLLUP_LEVELS = (1, 10, 60, 600, 3600)
+
+
+class Rollup(object):
+    """The min, max, sum and count of the values of one channel per
+       bucket of width seconds. Buckets are appended in time order,
+       empty ones are left out.
+    """
+
+    __slots__ = ('width', 'starts', 'mins', 'maxs', 'sums', 'counts')
+
+    def __init__(self, width):
+        self.width = width
+        self.starts = array('d')
+        self.mins = array('d')
+        self.maxs = array('d')
+        self.sums = array('d')
+        self.counts = array('l')
+
+
+    def add(self, t, value):
+        start = t - t % self.width
+        if self.starts and self.starts[-1] == start:
+            if value < self.mins[-1]:
+                self.mins[-1] = value
+            if value > self.maxs[-1]:
+                self.maxs[-1] = value
+            self.sums[-1] += value
+            self.counts[-1] += 1
+        else:
+            self.starts.append(start)
+            self.mins.append(value)
+            self.maxs.append(value)
+            self.sums.append(value)
+            self.counts.append(1)
+
+
+    def range(self, start, end):
+        """Returns (time, min, max, mean) tuples for the buckets that
+           overlap start - end."""
+        first = bisect_right(self.starts, start - self.width)
+        last = bisect_left(self.starts, end)
+        return [(self.starts[i], self.mins[i], self.maxs[i],
+                 self.sums[i] / self.counts[i]) for i in xrange(first, last)]
+
+
+    def write(self, f):
+        f.write('%g %d\n' % (self.width, len(self.starts)))
+        for values in (self.starts, self.mins, self.maxs, self.sums,
+                       self.counts):
+            values.tofile(f)
+
+
+    def read(self, f, n):
+        for values in (self.starts, self.mins, self.maxs, self.sums,
+                       self.counts):
+            values.fromfile(f, n)
+
+
+    def __len__(self):
+        return len(self.starts)
+
+
+
+class RollupPyramid(object):
+    """Rollups of one channel at every level of ROLLUP_LEVELS, all
+       updated with each value so they can be queried while recording.
+    """
+
+    def __init__(self, levels=ROLLUP_LEVELS):
+        self.levels = [Rollup(width) for width in levels]
+
+
+    def add(self, t, value):
+        for level in self.levels:
+            level.add(t, value)
+
+
+    def level_for(self, start, end, width):
+        """Returns the coarsest Rollup that still has a bucket per pixel
+           when start - end is drawn width pixels wide, or None when
+           even the finest one is too coarse and the samples are needed.
+        """
+        seconds_per_pixel = float(end - start) / max(width, 1)
+        ret = None
+        for level in self.levels:
+            if level.width > seconds_per_pixel:
+                break
+            ret = level
+        return ret
+
+
+
+def _channel_name(channel):
+    command, index, ecu = channel
+    return '%s %d %s' % (command, index, ecu or '-')
+
+
+def _parse_channel(command, index, ecu):
+    if ecu == '-':
+        ecu = None
+    return (command, int(index), ecu)
+
+
+
+class BlockIndex(object):
+    """Where the blocks of a recording are: per block the time of the
+       first and last result, the offset and length in the file and the
+       commands in it. Blocks are in time order, so the ones of a time
+       range are found with a binary search.
+    """
+
+    def __init__(self):
+        self.starts = array('d')
+        self.ends = array('d')
+        self.offsets = array('l')
+        self.lengths = array('l')
+        self.commands = []
+
+
+    def add(self, start, end, offset, length, commands):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.commands.append(frozenset(commands))
+
+
+    def find(self, start=None, end=None, commands=None):
+        """Returns the numbers of the blocks with results between start
+           and end, of one of commands if given."""
+        first = 0
+        last = len(self.starts)
+        if start is not None:
+            first = bisect_left(self.ends, start)
+        if end is not None:
+            last = bisect_left(self.starts, end)
+        if commands is None:
+            return range(first, last)
+        commands = frozenset(commands)
+        return [i for i in xrange(first, last) 
+                  if not commands.isdisjoint(self.commands[i])]
+
+
+    def line(self, i):
+        return '%.4f %.4f %d %d %s\n' % (self.starts[i], self.ends[i],
+                                         self.offsets[i], self.lengths[i],
+                                         string.join(sorted(self.commands[i]),
+                                                     ','))
+
+
+    def __len__(self):
+        return len(self.starts)
+
+
+
+def read_index(filename):
+    index = BlockIndex()
+    f = open(filename)
+    try:
+        if not f.readline().startswith(INDEX_HEADER):
+            raise ValueError, '%s is not a block index' % filename
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4:
+                # the last line of a recording that was cut off
+                break
+            if len(fields) == 4:
+                fields.append('')
+            start, end, offset, length, commands = fields
+            index.add(float(start), float(end), int(offset), int(length), 
+                      [command for command in commands.split(',') 
+                               if command])
+    finally:
+        f.close()
+    return index
+
+
+
+class Recorder(object):
+    """Writes the results of the queue to a recording and keeps rollups
+       of the numeric values, see Recording for reading it back.
+
+       The results are written in blocks of BLOCK_SECONDS and every
+       block gets a line in the index file next to the recording as
+       soon as it is written. The rollups are written when the 
+       recording is closed.
+
+       A PACKED recording stores the data of each command in a column
+       per block, see blocks.py, which is about ten times smaller 
+       than the TEXT format: a line per result with the time since 
+       the start, the command, the ecu and the data.
+    """
+
+    def __init__(self, filename, levels=ROLLUP_LEVELS, start=None,
+                 version=PACKED, compress=True):
+        """@param start: the time the recording starts, now if None
+           @param version: PACKED or TEXT
+           @param compress: whether PACKED blocks are compressed
+        """
+        self.filename = filename
+        self.levels = levels
+        if start is None:
+            start = time.time()
+        self.start = start
+        self.version = version
+        self.compress = compress
+        # (command, index, ecu) -> RollupPyramid
+        self.rollups = {}
+        self.index = BlockIndex()
+        self._block = []
+        # (command, ecu) -> blocks.Column, for PACKED
+        self._columns = {}
+        self._block_start = None
+        self._block_end = None
+        self._block_commands = set()
+        self._file = open(filename, 'wb')
+        if version == PACKED:
+            compression = compress and 'zlib' or 'none'
+            self._file.write('%s %d %.6f %s\n' % (RECORDING_HEADER, version,
+                                                  self.start, compression))
+        else:
+            self._file.write('%s %d %.6f\n' % (RECORDING_HEADER, version,
+                                               self.start))
+        self._index_file = open(filename + INDEX_SUFFIX, 'w')
+        self._index_file.write('%s\n' % INDEX_HEADER)
+        log.info('recording to %s' % filename)
+
+
+    def _write_block(self):
+        if self.version == PACKED:
+            if not self._columns:
+                return
+            data = blocks.encode_block(self._columns.values())
+            if self.compress:
+                data = zlib.compress(data)
+            # the length in front of each block lets build_index find
+            # them, the index points past it
+            self._file.write(struct.pack('>I', len(data)))
+        elif self._block:
+            data = string.join(self._block, '')
+        else:
+            return
+        offset = self._file.tell()
+        self._file.write(data)
+        self._file.flush()
+        self.index.add(self._block_start, self._block_end, offset, 
+                       len(data), self._block_commands)
+        self._index_file.write(self.index.line(len(self.index) - 1))
+        self._index_file.flush()
+        self._block = []
+        self._columns = {}
+        self._block_start = None
+        self._block_commands = set()
+
+
+    def add(self, t, command, result, values=None):
+        """Records a result.
+           @param t: the time the result came in
+           @param result: maps each ecu to its data
+           @param values: the (command, index, ecu, metric value) tuples
+                          of the result if already decoded
+        """
+        t -= self.start
+        if self.version == PACKED:
+            # the index has the times the blocks have
+            t = round(t * blocks.TICKS) / blocks.TICKS
+        if self._block_start is None:
+            self._block_start = t
+        elif t - self._block_start >= BLOCK_SECONDS:
+            self._write_block()
+            self._block_start = t
+        self._block_end = t
+        self._block_commands.add(str(command))
+        for ecu, data in result.items():
+            if not data:
+                continue
+            if self.version == PACKED:
+                key = (command, ecu)
+                try:
+                    column = self._columns[key]
+                except KeyError:
+                    column = self._columns[key] = \
+                                    blocks.Column(str(command), ecu)
+                column.add(int(round(t * blocks.TICKS)), data)
+            else:
+                # data can have spaces, like the answer to atdp, which
+                # the reader keeps, and newlines, which are escaped
+                self._block.append('%.4f %s %s %s\n' % (t, command,
+                                        ecu or '-', 
+                                        data.encode('string_escape')))
+        if values is None:
+            values = result_values(command, result)
+        for command, index, ecu, value in values:
+            channel = (command, index, ecu)
+            try:
+                pyramid = self.rollups[channel]
+            except KeyError:
+                pyramid = self.rollups[channel] = RollupPyramid(self.levels)
+            pyramid.add(t, value)
+
+
+    def close(self):
+        self._write_block()
+        self._file.close()
+        self._index_file.close()
+        write_rollups(self.filename + ROLLUP_SUFFIX, self.rollups)
+        log.info('recording %s closed' % self.filename)
+
+
+
+def write_rollups(filename, rollups):
+    tmp = filename + '.tmp'
+    f = open(tmp, 'wb')
+    try:
+        f.write('%s %d\n' % (ROLLUP_HEADER, len(rollups)))
+        for channel, pyramid in rollups.items():
+            f.write('%s %d\n' % (_channel_name(channel),
+                                 len(pyramid.levels)))
+            for level in pyramid.levels:
+                level.write(f)
+    finally:
+        f.close()
+    os.rename(tmp, filename)
+
+
+def read_rollups(filename):
+    """Reads the rollups written by write_rollups, returns a dict
+       mapping each channel to its RollupPyramid."""
+    ret = {}
+    f = open(filename, 'rb')
+    try:
+        header = f.readline()
+        if not header.startswith(ROLLUP_HEADER):
+            raise ValueError, '%s is not a rollup file' % filename
+        for n in range(int(header.split()[-1])):
+            command, index, ecu, nlevels = f.readline().split()
+            pyramid = RollupPyramid(())
+            for m in range(int(nlevels)):
+                width, size = f.readline().split()
+                level = Rollup(float(width))
+                level.read(f, int(size))
+                pyramid.levels.append(level)
+            ret[_parse_channel(command, index, ecu)] = pyramid
+    finally:
+        f.close()
+    return ret
+
+
+
+def _parse_header(filename, header):
+    """Returns the version, start and compression of a recording"""
+    fields = header.split()
+    if not header.startswith(RECORDING_HEADER) or len(fields) < 5:
+        raise ValueError, '%s is not a recording' % filename
+    version = int(fields[3])
+    if version == TEXT:
+        return version, float(fields[4]), None
+    if version == PACKED and len(fields) == 6:
+        if fields[5] == 'zlib':
+            return version, float(fields[4]), 'zlib'
+        return version, float(fields[4]), None
+    raise ValueError, '%s is a recording garmon can not read' % filename
+
+
+def _index_packed(f, index, compression):
+    while True:
+        frame = f.read(4)
+        if len(frame) < 4:
+            break
+        length, = struct.unpack('>I', frame)
+        offset = f.tell()
+        data = f.read(length)
+        if len(data) < length:
+            # cut off when the recording was not closed
+            break
+        if compression == 'zlib':
+            data = zlib.decompress(data)
+        start, end, columns = blocks.read_header(bytearray(data))
+        index.add(float(start) / blocks.TICKS, float(end) / blocks.TICKS,
+                  offset, length, [column[0] for column in columns])
+
+
+def build_index(filename):
+    """Writes the index of a recording that has none, e.g. because
+       it was written by an older version."""
+    index = BlockIndex()
+    f = open(filename, 'rb')
+    try:
+        version, start, compression = _parse_header(filename, f.readline())
+        if version == PACKED:
+            _index_packed(f, index, compression)
+            f.seek(0, 2)
+        offset = start = end = None
+        commands = set()
+        while version == TEXT:
+            position = f.tell()
+            line = f.readline()
+            fields = line.rstrip('\n').split(' ', 3)
+            if len(fields) == 4:
+                t = float(fields[0])
+            if not line or (start is not None and t - start >= BLOCK_SECONDS):
+                if start is not None:
+                    index.add(start, end, offset, position - offset, commands)
+                if not line:
+                    break
+                start = None
+            if len(fields) != 4:
+                continue
+            if start is None:
+                offset, start, commands = position, t, set()
+            end = t
+            commands.add(fields[1])
+    finally:
+        f.close()
+    tmp = filename + INDEX_SUFFIX + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        f.write('%s\n' % INDEX_HEADER)
+        for i in range(len(index)):
+            f.write(index.line(i))
+    finally:
+        f.close()
+    os.rename(tmp, filename + INDEX_SUFFIX)
+    return index
+
+
+
+class Recording(object):
+    """A recording written by Recorder. The file is memory mapped and
+       only the blocks the block index points to are read, of a packed
+       recording only the columns of the commands asked for. The
+       rollups are read from the file next to it, or computed when 
+       that is missing, as is the index.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        f = open(filename, 'rb')
+        try:
+            self.version, self.start, self.compression = \
+                                    _parse_header(filename, f.readline())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            self.index = read_index(filename + INDEX_SUFFIX)
+        except (IOError, ValueError), e:
+            log.info('rebuilding the index of %s: %s' % (filename, e))
+            self.index = build_index(filename)
+        try:
+            self.rollups = read_rollups(filename + ROLLUP_SUFFIX)
+        except (IOError, ValueError), e:
+            log.info('rebuilding rollups of %s: %s' % (filename, e))
+            self.rollups = self._build_rollups()
+
+
+    def close(self):
+        self._map.close()
+
+
+    def results(self, start=None, end=None, commands=None):
+        """Yields the recorded (time, command, ecu, data) tuples between
+           start and end, of commands if given. Only the blocks holding
+           those are read.
+        """
+        if commands is not None:
+            commands = frozenset(commands)
+        for i in self.index.find(start, end, commands):
+            for t, command, ecu, data in self._block(i, commands):
+                if start is not None and t < start:
+                    continue
+                if end is not None and t >= end:
+                    return
+                yield t, command, ecu, data
+
+
+    def _read(self, i):
+        offset = self.index.offsets[i]
+        data = self._map[offset:offset + self.index.lengths[i]]
+        if self.compression == 'zlib':
+            data = zlib.decompress(data)
+        return data
+
+
+    def _block(self, i, commands):
+        """Returns the (time, command, ecu, data) tuples of block i"""
+        if self.version == PACKED:
+            return blocks.decode_block(self._read(i), commands)
+        ret = []
+        for line in self._read(i).splitlines():
+            # the data can have spaces
+            fields = line.split(' ', 3)
+            if len(fields) != 4:
+                # cut off when the recording was not closed
+                continue
+            t, command, ecu, data = fields
+            if commands is not None and not command in commands:
+                continue
+            if ecu == '-':
+                ecu = None
+            ret.append((float(t), command, ecu, data.decode('string_escape')))
+        return ret
+
+
+    def columns(self, command, ecu=None, start=None, end=None):
+        """Yields (body, start tick, column) for the columns of command
+           from ecu in the blocks between start and end of a packed
+           recording, to be decoded with blocks.decode_column.
+        """
+        for i in self.index.find(start, end, [command]):
+            buf = bytearray(self._read(i))
+            first, last, columns = blocks.read_header(buf)
+            for column in columns:
+                if column[:2] == (command, ecu):
+                    yield buf, first, column
+
+
+    def payloads(self, command, ecu=None, start=None, end=None):
+        """Returns the times of the results of command from ecu between
+           start and end as an array and their data as byte strings,
+           see blocks.payload. Packed columns are decoded whole,
+           without going through the text of every result.
+        """
+        times = array('d')
+        ret = []
+        if self.version == PACKED:
+            for buf, first, column in self.columns(command, ecu, start, end):
+                ticks, values = blocks.decode_column(buf, first, column)
+                times.extend([float(tick) / blocks.TICKS for tick in ticks])
+                ret.extend(blocks.column_payloads(column, values))
+        else:
+            for i in self.index.find(start, end, [command]):
+                for t, cmd, e, data in self._block(i, [command]):
+                    if e == ecu:
+                        times.append(t)
+                        ret.append(blocks.payload(data))
+        if start is None and end is None:
+            return times, ret
+        first = 0
+        last = len(times)
+        if start is not None:
+            first = bisect_left(times, start)
+        if end is not None:
+            last = bisect_left(times, end)
+        return times[first:last], ret[first:last]
+
+
+    def _build_rollups(self):
+        rollups = {}
+        for t, command, ecu, data in self.results():
+            if command[:2] != '01':
+                continue
+            for index, value in numeric_values(command[2:4], data):
+                channel = (command, index, ecu)
+                if not channel in rollups:
+                    rollups[channel] = RollupPyramid()
+                rollups[channel].add(t, value)
+        return rollups
+
+
+    def channels(self):
+        return sorted(self.rollups.keys())
+
+
+    def samples(self, channel, start, end):
+        """Returns the (time, value) tuples of channel between start and
+           end."""
+        command, index, ecu = channel
+        ret = []
+        for t, cmd, e, data in self.results(start, end, [command]):
+            if e != ecu:
+                continue
+            for i, value in numeric_values(command[2:4], data):
+                if i == index:
+                    ret.append((t, value))
+        return ret
+
+
+    def query(self, channel, start, end, width):
+        """Returns (time, min, max, mean) tuples to draw channel between
+           start and end, width pixels wide. They come from the coarsest
+           rollup level that still has a point per pixel, or from the
+           samples when zoomed in that far.
+        """
+        level = self.rollups[channel].level_for(start, end, width)
+        if level is not None:
+            return level.range(start, end)
+        return [(t, value, value, value)
+                for t, value in self.samples(channel, start, end)]
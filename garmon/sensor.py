@@ -37,10 +37,15 @@ class Command (GObject, PropertyObject):
     
     gproperty('command', str, flags=gobject.PARAM_READABLE)
     gproperty('data', object)
+    gproperty('ecu', str)
     
-    def __init__(self, command):
+    def __init__(self, command, ecu=''):
+        """ @param command: the command to send to the device
+            @param ecu: only accept data from the ecu with this address
+                        (e.g. '7E9'). Any ecu when empty.
+        """
         GObject.__init__(self)
-        PropertyObject.__init__(self, command=command)
+        PropertyObject.__init__(self, command=command, ecu=ecu)
                
     def clear(self):
         self.data = None
@@ -88,13 +93,13 @@ class Sensor (Command, PropertyObject):
         return self._name    
 
 
-    def __init__(self, command, index=0, units='Metric'):
+    def __init__(self, command, index=0, units='Metric', ecu=''):
         self._indices = len(SENSORS[command[2:4]])
         self._imperial_units = None
         self._metric_units = None
         self._decoder = None
-        Command.__init__(self, command)
-        PropertyObject.__init__(self, command=command, index=index)
+        Command.__init__(self, command, ecu)
+        PropertyObject.__init__(self, command=command, index=index, ecu=ecu)
 
     def __post_init__(self):
         Command.__post_init__(self)
@@ -134,6 +139,46 @@ def num_values(pid):
     return len(SENSORS[pid])
 
 
+# (pid, index) of the values that turned out not to be numbers
+_not_numeric = set()
+
+def numeric_values(pid, data):
+    """Returns (index, metric value) tuples for the values of pid that
+       are numbers, e.g. to compute statistics.
+    """
+    ret = []
+    for index, item in enumerate(SENSORS.get(pid, ())):
+        if (pid, index) in _not_numeric:
+            continue
+        try:
+            value = item[FUNC](data)[0]
+        except (ValueError, TypeError, SyntaxError, NameError,
+                IndexError, KeyError):
+            continue
+        if isinstance(value, (int, long, float)):
+            ret.append((index, value))
+        else:
+            _not_numeric.add((pid, index))
+    return ret
+
+
+def result_values(command, result):
+    """Returns (command, index, ecu, metric value) tuples for the numeric
+       values in a result of a mode 01 command.
+       @param result: maps each ecu to its data
+    """
+    ret = []
+    if command[:2] != '01':
+        return ret
+    command = str(command)
+    for ecu, data in result.items():
+        if not data:
+            continue
+        for index, value in numeric_values(command[2:4], data):
+            ret.append((command, index, ecu, value))
+    return ret
+
+
 def dtc_decode_num(code):
     num = eval ("0x%s" % code[1])
     return (num, num)
@@ -151,15 +196,7 @@ def dtc_decode_mil(code):
 def hex_to_bitstr(str):
     """ Converts a hex value into a bitstring."""
 
-    bitstr = ""
-    for i in str:
-        hex = eval("0x%s" % i)
-        for bit in [8,4,2,1]:
-            if hex & bit :
-                bitstr += '1'
-            else:
-                bitstr += '0'
-    return bitstr
+    return bin(int(str, 16))[2:].zfill(len(str) * 4)
 
 
 def bitstring(data):
@@ -388,6 +425,25 @@ SENSORS = {#  PID               Name                            formula
             "2C": ((_("Commanded EGR"),                      percent,                "%",        "%"         ),),
             "2D": ((_("EGR Error"),                          egr_error,              "%",        "%"         ),),
     }
+
+
+# The number of data bytes of the mode 01 and 02 pids, needed to split
+# the answer to a request for several pids at once.
+DATA_BYTES = {
+               "00": 4, "01": 4, "02": 2, "03": 2, "04": 1, "05": 1, "06": 1, "07": 1,
+               "08": 1, "09": 1, "0A": 1, "0B": 1, "0C": 2, "0D": 1, "0E": 1, "0F": 1,
+               "10": 2, "11": 1, "12": 1, "13": 1, "14": 2, "15": 2, "16": 2, "17": 2,
+               "18": 2, "19": 2, "1A": 2, "1B": 2, "1C": 1, "1D": 1, "1E": 1, "1F": 2,
+               "20": 4, "21": 2, "22": 2, "23": 2, "24": 4, "25": 4, "26": 4, "27": 4,
+               "28": 4, "29": 4, "2A": 4, "2B": 4, "2C": 1, "2D": 1, "2E": 1, "2F": 1,
+               "30": 1, "31": 2, "32": 2, "33": 1, "34": 4, "35": 4, "36": 4, "37": 4,
+               "38": 4, "39": 4, "3A": 4, "3B": 4, "3C": 2, "3D": 2, "3E": 2, "3F": 2,
+               "40": 4, "41": 4, "42": 2, "43": 2, "44": 2, "45": 1, "46": 1, "47": 1,
+               "48": 1, "49": 1, "4A": 1, "4B": 1, "4C": 1, "4D": 2, "4E": 2, "4F": 4,
+               "50": 4, "51": 1, "52": 1, "53": 2, "54": 2, "55": 2, "56": 2, "57": 2,
+               "58": 2, "59": 2, "5A": 1, "5B": 1, "5C": 1, "5D": 2, "5E": 2, "5F": 1,
+               "60": 4,
+              }
 """    
 
 
@@ -0,0 +1,446 @@
+#!/usr/bin/python
+#
+# triggers.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+import os
+import re
+import ast
+import time
+from collections import deque
+
+from garmon.sensor import Command, result_values
+from garmon.recorder import Recorder
+from garmon.logger import log
+
+
+# names that can be used in conditions instead of the command
+ALIASES = {
+    'load'      : '0104',
+    'coolant'   : '0105',
+    'stft1'     : '0106',
+    'ltft1'     : '0107',
+    'stft2'     : '0108',
+    'ltft2'     : '0109',
+    'map'       : '010B',
+    'rpm'       : '010C',
+    'speed'     : '010D',
+    'timing'    : '010E',
+    'iat'       : '010F',
+    'maf'       : '0110',
+    'throttle'  : '0111',
+}
+
+# seconds of history kept before and after a rule fires
+DEFAULT_PRE = 10.0
+DEFAULT_POST = 10.0
+
+# values older than this are not used, the sensor stopped answering
+STALE_SECONDS = 5.0
+
+# 010C, 0114[1] for the second value of a pid, 010C@7E8 for the value
+# of one ecu. Not inside a number like 1.0105.
+_COMMAND_RE = re.compile(r'(?<![\w.])(01[0-9A-Fa-f]{2})\b(?:\[(\d+)\])?'
+                         r'(?:@([0-9A-Fa-f]+)\b)?')
+# rpm@7E8
+_ALIAS_RE = re.compile(r'(?<![\w.])([A-Za-z]\w*)@([0-9A-Fa-f]+)\b')
+
+_ALLOWED_NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.Compare,
+                  ast.Gt, ast.GtE, ast.Lt, ast.LtE, ast.Eq, ast.NotEq,
+                  ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div,
+                  ast.UnaryOp, ast.USub, ast.UAdd, ast.Not, ast.Num,
+                  ast.Name, ast.Load, ast.Call)
+
+_FUNCTIONS = {'abs' : abs, 'min' : min, 'max' : max}
+
+_NAMESPACE = dict(_FUNCTIONS, __builtins__={})
+
+
+def _channel_name(channel):
+    command, index, ecu = channel
+    if ecu:
+        return '_%s_%d_%s' % (command, index, ecu)
+    return '_%s_%d' % (command, index)
+
+
+def _command_name(match):
+    return _channel_name((match.group(1).upper(), int(match.group(2) or 0),
+                          match.group(3) and match.group(3).upper()))
+
+
+def _alias_name(match):
+    if not match.group(1) in ALIASES:
+        # left as is, the compiler complains
+        return match.group(0)
+    return _channel_name((ALIASES[match.group(1)], 0,
+                          match.group(2).upper()))
+
+
+def _resolve(channel, ecu):
+    """Returns the key of the values of channel, those of ecu when
+       the condition doesn't name one"""
+    command, index, named = channel
+    return command, index, named or ecu
+
+
+class _Compiler(ast.NodeTransformer):
+    """Checks a parsed condition and replaces each delta(x, seconds)
+       by a name whose value the Rule computes.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        # name -> (command, index, ecu)
+        self.channels = {}
+        # name -> ((command, index, ecu), seconds)
+        self.deltas = {}
+
+
+    def _channel(self, node):
+        if not isinstance(node, ast.Name):
+            raise ValueError, '%s: expected a sensor, not %s' % (
+                                    self.text, node.__class__.__name__)
+        name = node.id
+        if name in ALIASES:
+            channel = (ALIASES[name], 0, None)
+        else:
+            match = re.match(r'_(01[0-9A-F]{2})_(\d+)(?:_([0-9A-F]+))?$', name)
+            if not match:
+                raise ValueError, '%s: unknown sensor %s' % (self.text, name)
+            channel = (match.group(1), int(match.group(2)), match.group(3))
+        return _channel_name(channel), channel
+
+
+    def generic_visit(self, node):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise ValueError, '%s: %s is not allowed' % (
+                                    self.text, node.__class__.__name__)
+        return ast.NodeTransformer.generic_visit(self, node)
+
+
+    def visit_Name(self, node):
+        if node.id in _FUNCTIONS:
+            return node
+        name, channel = self._channel(node)
+        self.channels[name] = channel
+        return ast.copy_location(ast.Name(name, ast.Load()), node)
+
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name):
+            raise ValueError, '%s: only functions can be called' % self.text
+        if node.func.id == 'delta':
+            if len(node.args) != 2 or not isinstance(node.args[1], ast.Num):
+                raise ValueError, '%s: use delta(sensor, seconds)' % self.text
+            name, channel = self._channel(node.args[0])
+            seconds = float(node.args[1].n)
+            name = '_delta%d' % len(self.deltas)
+            self.deltas[name] = (channel, seconds)
+            return ast.copy_location(ast.Name(name, ast.Load()), node)
+        if not node.func.id in _FUNCTIONS or node.keywords or \
+           node.starargs or node.kwargs:
+            raise ValueError, '%s: unknown function %s' % (self.text,
+                                                           node.func.id)
+        return self.generic_visit(node)
+
+
+
+class Rule(object):
+    """A condition on the latest values of the polled sensors, like
+       "rpm > 4000 and coolant > 105". Sensors are named by an alias
+       from ALIASES, by the command (010C) or by command and index
+       (0114[1]). delta(sensor, seconds) is how much a value changed
+       in the last seconds, so a sudden drop in the fuel trim is
+       "delta(stft1, 1) < -10". Values are metric.
+
+       The condition is checked per ecu, the values of one ecu are
+       never mixed with those of another. A sensor can be bound to an
+       ecu with @, as in "rpm@7E8 > 4000 and 0105@7E9 > 105".
+
+       The condition is checked and compiled once, only comparisons,
+       arithmetic, abs, min and max are allowed.
+    """
+
+    def __init__(self, name, condition, pre=DEFAULT_PRE, post=DEFAULT_POST):
+        """@param pre: the seconds of history before the rule fires
+                       that are written to the capture
+           @param post: the seconds after it
+        """
+        self.name = name
+        self.condition = condition
+        self.pre = pre
+        self.post = post
+        self.fired = 0
+        self.active = False
+        # the ecus for which the condition holds
+        self.ecus = set()
+
+        text = _ALIAS_RE.sub(_alias_name, _COMMAND_RE.sub(_command_name,
+                                                          condition))
+        try:
+            tree = ast.parse(text.strip(), '<rule>', 'eval')
+        except SyntaxError, e:
+            raise ValueError, '%s: %s' % (condition, e)
+        compiler = _Compiler(condition)
+        tree = ast.fix_missing_locations(compiler.visit(tree))
+        self._code = compile(tree, '<rule %s>' % name, 'eval')
+        self._channels = compiler.channels.items()
+        self._deltas = compiler.deltas.items()
+        # the (command, index, ecu) of the sensors that are needed, so
+        # the rule is only checked when one of them changes. ecu is None
+        # unless the condition names one.
+        self.channels = frozenset(compiler.channels.values() +
+                                  [c for c, s in compiler.deltas.values()])
+        # the (command, ecu) to poll
+        self.commands = frozenset([(c, e) for c, i, e in self.channels])
+        self.window = max([s for c, s in compiler.deltas.values()] or [0])
+
+
+    def evaluate(self, latest, history, ecu=None, since=None):
+        """Returns whether the condition holds, False when a value is
+           missing or older than since.
+           @param latest: maps (command, index, ecu) to the (time, value)
+                          of the latest value
+           @param history: maps (command, index, ecu) to a deque of the
+                           (time, value) tuples of the last window
+           @param ecu: the ecu whose values are used for the sensors the
+                       condition doesn't name an ecu for
+        """
+        values = {}
+        try:
+            for name, channel in self._channels:
+                t, value = latest[_resolve(channel, ecu)]
+                if since is not None and t < since:
+                    return False
+                values[name] = value
+            for name, (channel, seconds) in self._deltas:
+                samples = history[_resolve(channel, ecu)]
+                t, value = samples[-1]
+                if since is not None and t < since:
+                    return False
+                for past, old in samples:
+                    if past >= t - seconds:
+                        break
+                values[name] = value - old
+        except (KeyError, IndexError):
+            return False
+        try:
+            return bool(eval(self._code, _NAMESPACE, values))
+        except (ZeroDivisionError, OverflowError, TypeError, ValueError):
+            return False
+
+
+    def __repr__(self):
+        return '<Rule %s: %s>' % (self.name, self.condition)
+
+
+
+class _Capture(object):
+    """The recording of one firing, open until post seconds later"""
+
+    def __init__(self, rule, t, filename):
+        self.rule = rule
+        self.end = t + rule.post
+        self.recorder = Recorder(filename, start=t - rule.pre)
+
+
+    @property
+    def filename(self):
+        return self.recorder.filename
+
+
+
+class TriggerEngine(object):
+    """Checks the Rules on every result of the queue. The results of
+       the last seconds are kept in memory, when a rule fires they are
+       written to a recording in directory, followed by the results of
+       the next seconds. Recordings are only made of what matters, the
+       same format as those of Recorder so they open as a Recording.
+    """
+
+    def __init__(self, directory=None, queue=None, stale=STALE_SECONDS):
+        """@param directory: where the captures go, triggers in the
+                             garmon data dir if None
+           @param queue: the CommandQueue that polls the sensors of the
+                         rules as long as they are added
+           @param stale: the age in seconds after which a value is no
+                         longer used
+        """
+        self.directory = directory
+        self.queue = queue
+        self.stale = stale
+        self._rules = []
+        # rule name -> the Commands added to the queue for it
+        self._polled = {}
+        # (command, index, ecu) -> [Rule], ecu None for any ecu
+        self._by_channel = {}
+        # (command, index) of the values that are needed
+        self._wanted = set()
+        # (command, index, ecu) -> (time, value)
+        self._latest = {}
+        self._history = {}
+        self._buffer = deque()
+        self._pre = 0
+        self._window = 0
+        self._captures = []
+        # (rule name, time, filename) of the captures written
+        self.captures = []
+
+
+    def _update(self):
+        self._by_channel = {}
+        for rule in self._rules:
+            for channel in rule.channels:
+                self._by_channel.setdefault(channel, []).append(rule)
+        self._wanted = set([channel[:2] for channel in self._by_channel])
+        self._pre = max([rule.pre for rule in self._rules] or [0])
+        self._window = max([rule.window for rule in self._rules] or [0])
+        if not self._rules:
+            self._buffer.clear()
+            self._latest = {}
+            self._history = {}
+
+
+    def add_rule(self, name, condition, pre=DEFAULT_PRE, post=DEFAULT_POST):
+        """Adds a Rule, raises ValueError when the condition is invalid.
+           Returns the Rule.
+        """
+        rule = Rule(name, condition, pre, post)
+        self.remove_rule(name)
+        self._rules.append(rule)
+        self._update()
+        if self.queue is not None:
+            commands = [Command(command, ecu or '')
+                        for command, ecu in rule.commands]
+            for command in commands:
+                self.queue.add(command)
+            self._polled[name] = commands
+        return rule
+
+
+    def remove_rule(self, name):
+        self._rules = [rule for rule in self._rules if rule.name != name]
+        self._update()
+        for command in self._polled.pop(name, ()):
+            self.queue.remove(command)
+
+
+    def rules(self):
+        return list(self._rules)
+
+
+    def _directory(self):
+        if self.directory is None:
+            from xdg.BaseDirectory import save_data_path
+            self.directory = save_data_path('garmon', 'triggers')
+        return self.directory
+
+
+    def _fire(self, rule, t):
+        rule.fired += 1
+        for capture in self._captures:
+            if capture.rule is rule:
+                # still capturing the previous time, make it longer
+                capture.end = t + rule.post
+                return
+        name = re.sub(r'[^\w-]', '_', rule.name)
+        filename = os.path.join(self._directory(), '%s-%s.log' % (name,
+                        time.strftime('%Y%m%d-%H%M%S', time.localtime(t))))
+        try:
+            capture = _Capture(rule, t, filename)
+        except (IOError, OSError), e:
+            log.error('%s fired but could not write %s: %s' % (rule.name,
+                                                               filename, e))
+            return
+        log.info('%s fired, capturing to %s' % (rule.name, filename))
+        for past, command, result, values in self._buffer:
+            if past >= capture.recorder.start:
+                capture.recorder.add(past, command, result, values)
+        self._captures.append(capture)
+        self.captures.append((rule.name, t, filename))
+
+
+    def add(self, t, command, result, values=None):
+        """Checks the rules that use command.
+           @param result: maps each ecu to its data, like the results
+                          the queue gets from the device
+           @param values: the (command, index, ecu, metric value) tuples
+                          of the result if already decoded
+        """
+        if not self._rules and not self._captures:
+            return
+        command = str(command)
+        if values is None:
+            values = result_values(command, result)
+
+        for capture in self._captures[:]:
+            if t > capture.end:
+                capture.recorder.close()
+                self._captures.remove(capture)
+            else:
+                capture.recorder.add(t, command, result, values)
+
+        if not self._rules:
+            return
+        buf = self._buffer
+        buf.append((t, command, result, values))
+        while buf and buf[0][0] < t - self._pre:
+            buf.popleft()
+
+        changed = set()
+        for cmd, index, ecu, value in values:
+            if not (cmd, index) in self._wanted:
+                continue
+            channel = (cmd, index, ecu)
+            self._latest[channel] = (t, value)
+            if self._window:
+                try:
+                    history = self._history[channel]
+                except KeyError:
+                    history = self._history[channel] = deque()
+                history.append((t, value))
+                while history[0][0] < t - self._window:
+                    history.popleft()
+            for rule in self._by_channel.get((cmd, index, None), ()):
+                changed.add((rule, ecu))
+            if ecu is not None:
+                for rule in self._by_channel.get(channel, ()):
+                    changed.add((rule, ecu))
+
+        since = t - self.stale
+        for rule, ecu in changed:
+            active = rule.active
+            if rule.evaluate(self._latest, self._history, ecu, since):
+                rule.ecus.add(ecu)
+            else:
+                rule.ecus.discard(ecu)
+            rule.active = bool(rule.ecus)
+            if rule.active and not active:
+                self._fire(rule, t)
+
+
+    def close(self):
+        """Closes the captures that are still running"""
+        for capture in self._captures:
+            capture.recorder.close()
+        self._captures = []
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+#
+# trip_stats.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+import math
+import string
+import time
+
+from garmon.histogram import Histogram
+from garmon import sensor, virtual_sensor
+
+
+class RunningStats(object):
+    """Count, min, max, mean and variance of a stream of values,
+       updated one value at a time (Welford), plus a Histogram for the
+       percentiles. Memory use doesn't grow with the number of values
+       and two RunningStats can be merged.
+    """
+
+    __slots__ = ('count', 'mean', '_m2', 'min', 'max', '_positive',
+                 '_negative')
+
+    def __init__(self):
+        self.clear()
+
+
+    def clear(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = None
+        self.max = None
+        # the histogram only takes positive values, negative ones are
+        # counted by their magnitude in a second one
+        self._positive = Histogram(resolution=1e-3)
+        self._negative = Histogram(resolution=1e-3)
+
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value < 0:
+            self._negative.add(-value)
+        else:
+            self._positive.add(value)
+
+
+    def merge(self, other):
+        """Adds the values counted by other"""
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self._positive.merge(other._positive)
+        self._negative.merge(other._negative)
+
+
+    def variance(self):
+        if self.count < 2:
+            return None
+        return self._m2 / (self.count - 1)
+
+
+    def stddev(self):
+        variance = self.variance()
+        if variance is None:
+            return None
+        return math.sqrt(variance)
+
+
+    def percentile(self, q):
+        """Returns the approximate value below which q percent of the
+           values are, or None when empty.
+        """
+        if not self.count:
+            return None
+        rank = self.count * q / 100.0
+        negative = self._negative.count
+        if negative and rank <= negative:
+            # the lowest values have the largest magnitude
+            return -self._negative.percentile(100 - rank * 100.0 / negative)
+        return self._positive.percentile((rank - negative) * 100.0 /
+                                         self._positive.count)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __repr__(self):
+        if not self.count:
+            return '<RunningStats empty>'
+        return '<RunningStats n=%d min=%g mean=%g max=%g>' % (
+                    self.count, self.min, self.mean, self.max)
+
+
+
+def _describe(command, index):
+    """Returns the name and the metric units of a sensor"""
+    if virtual_sensor.is_virtual(command):
+        item = virtual_sensor.VIRTUAL_SENSORS[command][index]
+        return item[virtual_sensor.NAME], item[virtual_sensor.METRIC]
+    item = sensor.SENSORS[command[2:4]][index]
+    return item[sensor.NAME], item[sensor.METRIC]
+
+
+
+class TripStats(object):
+    """RunningStats of the metric value of every sensor the queue
+       executes, virtual sensors included, per (command, index, ecu),
+       since the last reset.
+    """
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        """Starts a new trip"""
+        self._stats = {}
+        self.started = time.time()
+
+
+    def add(self, values):
+        """Adds the values of a result.
+           @param values: (command, index, ecu, metric value) tuples, as
+                          the queue decodes them once per result
+        """
+        for command, index, ecu, value in values:
+            key = (command, index, ecu)
+            try:
+                stats = self._stats[key]
+            except KeyError:
+                stats = self._stats[key] = RunningStats()
+            stats.add(value)
+
+
+    def get(self, command, index=0, ecu=None):
+        """Returns the RunningStats of a sensor, combining all ecus
+           when ecu is None, or None when there are no values.
+        """
+        if ecu is not None:
+            return self._stats.get((command, index, ecu))
+        ret = None
+        for (cmd, idx, e), stats in self._stats.items():
+            if cmd == command and idx == index:
+                if ret is None:
+                    ret = RunningStats()
+                ret.merge(stats)
+        return ret
+
+
+    def channels(self):
+        """Returns the (command, index, ecu) tuples with values"""
+        return sorted(self._stats.keys())
+
+
+    def report(self):
+        """Returns a table of the trip, e.g. for the python shell:
+           print app.queue.trip.report()
+        """
+        def fmt(value):
+            if value is None:
+                return '-'
+            return '%.2f' % value
+
+        lines = ['%-40s %5s %7s %9s %9s %9s %9s %9s %9s' % (
+                    'sensor', 'ecu', 'n', 'min', 'mean', 'max', 'stddev',
+                    'p50', 'p95')]
+        for command, index, ecu in self.channels():
+            stats = self._stats[(command, index, ecu)]
+            name, units = _describe(command, index)
+            name = '%s (%s)' % (name, units or command)
+            lines.append('%-40s %5s %7d %9s %9s %9s %9s %9s %9s' % (
+                    name[:40], ecu or '-', stats.count, fmt(stats.min),
+                    fmt(stats.mean), fmt(stats.max), fmt(stats.stddev()),
+                    fmt(stats.percentile(50)), fmt(stats.percentile(95))))
+        return string.join(lines, '\n')
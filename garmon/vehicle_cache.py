@@ -0,0 +1,212 @@
+#!/usr/bin/python
+#
+# vehicle_cache.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+import os
+import string
+import hashlib
+
+from xdg.BaseDirectory import save_cache_path
+from ConfigParser import RawConfigParser as ConfigParser
+
+import garmon
+from garmon.logger import log
+
+
+def make_fingerprint(response):
+    """Returns a key identifying the vehicle that sent response.
+       response is the raw answer to the first supported pids
+       request (0100). The order in which the ecus answer is ignored.
+    """
+    lines = []
+    for line in string.split(response, '\r'):
+        line = string.join(string.split(line), '')
+        if line:
+            lines.append(line)
+    lines.sort()
+    return hashlib.md5(string.join(lines, '|')).hexdigest()[:16]
+
+
+
+class VehicleInfo(object):
+    """Everything we learned about a vehicle during discovery"""
+
+    def __init__(self, key):
+        self.key = key
+        self.vin = None
+        self.protocol = None
+        self.ecus = []
+        # raw responses to the supported pids requests, e.g.
+        # {'0100': '41 00 BE 3F A8 13', '0120': ...}
+        self.bitmaps = {}
+
+    def __eq__(self, other):
+        return isinstance(other, VehicleInfo) and \
+               self.key == other.key and \
+               self.vin == other.vin and \
+               self.protocol == other.protocol and \
+               self.ecus == other.ecus and \
+               self.bitmaps == other.bitmaps
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<VehicleInfo %s vin=%s protocol=%s ecus=%s>' % (
+                        self.key, self.vin, self.protocol, self.ecus)
+
+
+
+class VehicleCache(object):
+    """Stores VehicleInfo objects on disk, so the supported pid discovery
+       can be skipped when reconnecting to a known vehicle.
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(save_cache_path('garmon'), 'vehicles')
+        self._filename = filename
+        self._config = ConfigParser()
+        try:
+            self._config.read(self._filename)
+        except Exception, e:
+            log.warning('ignoring broken vehicle cache %s: %s' %
+                        (self._filename, e))
+            self._config = ConfigParser()
+
+
+    def _section(self, key):
+        return 'vehicle %s' % key
+        
+        
+    def _get_last(self):
+        if self._config.has_option('cache', 'last'):
+            return self._config.get('cache', 'last')
+        return None
+        
+    def _set_last(self, key):
+        if key == self._get_last():
+            return
+        if not self._config.has_section('cache'):
+            self._config.add_section('cache')
+        self._config.set('cache', 'last', key)
+        self.save()
+        
+    last = property(_get_last, _set_last, 
+                    doc='key of the vehicle we were connected to last')
+
+
+    def _adapter_section(self, adapter):
+        return 'adapter %s' % adapter
+
+
+    def get_baudrate(self, adapter):
+        """Returns the fastest baudrate that worked for adapter, or None
+           when it was never tried.
+           @param adapter: the port and the answer to ati
+        """
+        section = self._adapter_section(adapter)
+        if self._config.has_option(section, 'baudrate'):
+            return self._config.getint(section, 'baudrate')
+        return None
+
+
+    def set_baudrate(self, adapter, baudrate):
+        section = self._adapter_section(adapter)
+        if not self._config.has_section(section):
+            self._config.add_section(section)
+        self._config.set(section, 'baudrate', baudrate)
+        self.save()
+
+
+    def get_failed_baudrates(self, adapter):
+        """Returns the set of baudrates adapter did not switch to"""
+        section = self._adapter_section(adapter)
+        if self._config.has_option(section, 'failed'):
+            return set([int(rate) for rate in 
+                        self._config.get(section, 'failed').split(',') 
+                        if rate])
+        return set()
+
+
+    def add_failed_baudrate(self, adapter, baudrate):
+        failed = self.get_failed_baudrates(adapter)
+        failed.add(baudrate)
+        section = self._adapter_section(adapter)
+        if not self._config.has_section(section):
+            self._config.add_section(section)
+        self._config.set(section, 'failed', 
+                         string.join([str(rate) for rate in sorted(failed)],
+                                     ','))
+        self.save()
+
+
+    def lookup(self, key):
+        """Returns the VehicleInfo stored for key or None"""
+        if not key:
+            return None
+        section = self._section(key)
+        if not self._config.has_section(section):
+            return None
+        info = VehicleInfo(key)
+        for option, value in self._config.items(section):
+            if option == 'vin':
+                info.vin = value or None
+            elif option == 'protocol':
+                info.protocol = value or None
+            elif option == 'ecus':
+                info.ecus = [ecu for ecu in value.split(',') if ecu]
+            elif option.startswith('bitmap.'):
+                cmd = option[len('bitmap.'):].upper()
+                info.bitmaps[cmd] = value.replace('|', '\r')
+        return info
+
+
+    def store(self, info):
+        """Stores info and writes the cache to disk"""
+        section = self._section(info.key)
+        if self._config.has_section(section):
+            self._config.remove_section(section)
+        self._config.add_section(section)
+        self._config.set(section, 'vin', info.vin or '')
+        self._config.set(section, 'protocol', info.protocol or '')
+        self._config.set(section, 'ecus', string.join(info.ecus, ','))
+        for cmd, response in info.bitmaps.items():
+            self._config.set(section, 'bitmap.' + cmd.lower(),
+                             response.replace('\r', '|'))
+        self.save()
+
+
+    def save(self):
+        tmp = self._filename + '.tmp'
+        try:
+            f = open(tmp, 'w')
+            try:
+                self._config.write(f)
+            finally:
+                f.close()
+            os.rename(tmp, self._filename)
+        except (IOError, OSError), e:
+            log.warning('could not write vehicle cache %s: %s' %
+                        (self._filename, e))
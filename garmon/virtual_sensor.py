@@ -0,0 +1,176 @@
+#!/usr/bin/python
+#
+# virtual_sensor.py
+#
+# Copyright (C) Ben Van Mechelen 2011 <me@benvm.be>
+#
+# This file is part of Garmon
+#
+# Garmon is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, write to:
+#   The Free Software Foundation, Inc.,
+#   51 Franklin Street, Fifth Floor
+#   Boston, MA  02110-1301, USA.
+
+
+from garmon.sensor import Command, Sensor
+from garmon.utils import PropertyObject
+
+
+# stoichiometric air/fuel ratio and density (g/l) of petrol
+AIR_FUEL_RATIO = 14.7
+FUEL_DENSITY = 740.0
+
+LITRES_PER_GALLON = 3.785
+MILES_PER_KM = 0.621
+PSI_PER_KPA = 0.14504
+KW_PER_HP = 0.7457
+# a rule of thumb for petrol engines: 1 g/s of air gives about 1.32 hp
+HP_PER_GRAM_AIR = 1.32
+
+
+# the inputs, decoded to metric floats. The decoders in sensor.py
+# round, which is too coarse to compute with.
+INPUT_DECODERS = {
+    '010B' : lambda data: float(int(data[:2], 16)),
+    '010C' : lambda data: int(data[:4], 16) / 4.0,
+    '010D' : lambda data: float(int(data[:2], 16)),
+    '0110' : lambda data: int(data[:4], 16) / 100.0,
+    '0133' : lambda data: float(int(data[:2], 16)),
+}
+
+
+def _fuel_flow(maf):
+    """Returns the fuel flow in l/h for an air flow in g/s"""
+    return maf * 3600 / AIR_FUEL_RATIO / FUEL_DENSITY
+
+
+def fuel_economy(values):
+    speed = values['010D']
+    if speed < 1:
+        return ('', '')
+    litres = _fuel_flow(values['0110']) / speed * 100
+    if not litres:
+        return ('', '')
+    mpg = 100 / litres * LITRES_PER_GALLON * MILES_PER_KM
+    return ('%.1f' % litres, '%.1f' % mpg)
+
+
+def fuel_flow(values):
+    flow = _fuel_flow(values['0110'])
+    return ('%.2f' % flow, '%.2f' % (flow / LITRES_PER_GALLON))
+
+
+def boost(values):
+    pressure = values['010B'] - values['0133']
+    return ('%.0f' % pressure, '%.1f' % (pressure * PSI_PER_KPA))
+
+
+def power(values):
+    hp = values['0110'] * HP_PER_GRAM_AIR
+    return ('%.0f' % (hp * KW_PER_HP), '%.0f' % hp)
+
+
+(NAME, INPUTS, FUNC, METRIC, IMPERIAL) = range(5)
+
+VIRTUAL_SENSORS = {#  Command          Name                     inputs              formula        unit
+                   #                                                                              metric     imperial
+    'fuel-economy' : ((_('Fuel Economy'),      ('0110', '010D'),   fuel_economy,  'l/100km', 'MPG'     ),
+                      (_('Fuel Flow'),         ('0110',),          fuel_flow,     'l/h',     'gal/h'   )),
+    'boost'        : ((_('Boost Pressure'),    ('010B', '0133'),   boost,         'kPa',     'psi'     ),),
+    'power'        : ((_('Estimated Power'),   ('0110',),          power,         'kW',      'hp'      ),),
+}
+
+
+def is_virtual(command):
+    return command in VIRTUAL_SENSORS
+
+
+def virtual_inputs(command):
+    """Returns the set of pids all values of a virtual sensor need"""
+    ret = set()
+    for item in VIRTUAL_SENSORS[command]:
+        ret.update(item[INPUTS])
+    return ret
+
+
+def make_sensor(command, index=0, units='Metric', ecu=''):
+    """Returns a VirtualSensor or a Sensor for command"""
+    if is_virtual(command):
+        return VirtualSensor(command, index, units, ecu)
+    return Sensor(command, index, units, ecu)
+
+
+
+class VirtualSensor (Sensor, PropertyObject):
+    """A Sensor whose value is computed from other pids instead of read
+       from the vehicle. It holds a Command for every input, the queue
+       polls those instead of the VirtualSensor itself, so inputs that
+       are already polled cause no extra traffic. The value is
+       recomputed whenever one of the inputs gets new data.
+    """
+    __gtype_name__ = 'VirtualSensor'
+
+    def __init__(self, command, index=0, units='Metric', ecu=''):
+        self._indices = len(VIRTUAL_SENSORS[command])
+        self._imperial_units = None
+        self._metric_units = None
+        self._decoder = None
+        self._func = None
+        self._values = {}
+        self._input_cbs = []
+        self.inputs = []
+        Command.__init__(self, command, ecu)
+        PropertyObject.__init__(self, command=command, index=index, ecu=ecu)
+
+
+    def _update_info(self):
+        item = VIRTUAL_SENSORS[self.command][self.index]
+        self._name = item[NAME]
+        self._metric_units = item[METRIC]
+        self._imperial_units = item[IMPERIAL]
+        self._decoder = lambda data: data
+        self._func = item[FUNC]
+
+        self._values = {}
+        for command, cb_id in zip(self.inputs, self._input_cbs):
+            command.disconnect(cb_id)
+        self.inputs = [Command(pid, self.ecu) for pid in item[INPUTS]]
+        self._input_cbs = [command.connect('notify::data', 
+                                           self._input_changed_cb)
+                           for command in self.inputs]
+
+
+    def _index_changed_cb(self, o, pspec):
+        self.data = None
+        self._update_info()
+
+
+    def _input_changed_cb(self, command, pspec):
+        if command.data is None:
+            self._values.pop(command.command, None)
+            return
+        try:
+            self._values[command.command] = \
+                    INPUT_DECODERS[command.command](command.data)
+        except ValueError:
+            return
+        if len(self._values) == len(self.inputs):
+            self.data = self._func(self._values)
+
+
+    def clear(self):
+        for command in self.inputs:
+            command.clear()
+        self._values = {}
+        self.data = None
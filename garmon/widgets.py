@@ -24,13 +24,19 @@
 
 
 
+import time
+from array import array
+
 import gobject
 from gobject import GObject
 import gtk
+import cairo
 
 import garmon
 from garmon.utils import PropertyObject, gproperty
 from garmon.sensor import Sensor, Command, StateMixin, UnitMixin, dtc_decode_mil
+from garmon.virtual_sensor import make_sensor
+from garmon.pipeline_stats import TOTAL
 
 
 
@@ -211,7 +217,7 @@ class SensorView(BaseView, UnitMixin, PropertyObject):
                        value_widget=None, units_widget=None,
                        helper=None):
         
-        self.command = Sensor(pid, index)
+        self.command = make_sensor(pid, index)
         self.command.connect('notify::data', self._data_changed_cb)
         
         BaseView.__init__(self, active_widget, name_widget,
@@ -271,7 +277,7 @@ class SensorProgressView(BaseView, PropertyObject):
                        value_widget=None,
                        helper=None, progress_widget=None):
         
-        self.command = Sensor(pid, index)
+        self.command = make_sensor(pid, index)
         self.command.connect('notify::data', self._data_changed_cb)
         
         BaseView.__init__(self, active_widget, name_widget,
@@ -308,3 +314,333 @@ class SensorProgressView(BaseView, PropertyObject):
             self.progress_widget.set_fraction(fraction)
             
 
+
+
+
+class PipelineStatsDialog(gtk.Dialog):
+    """Shows the timings of a PipelineStats per command and stage,
+       refreshed every second while visible.
+    """
+    
+    RESPONSE_CLEAR = 1
+
+    def __init__(self, stats, parent=None):
+        gtk.Dialog.__init__(self, _("Command Timing"), parent,
+                                gtk.DIALOG_DESTROY_WITH_PARENT,
+                                (gtk.STOCK_CLEAR, self.RESPONSE_CLEAR,
+                                 gtk.STOCK_CLOSE, gtk.RESPONSE_CLOSE))
+        self.stats = stats
+        self._timeout_id = None
+        self.set_default_size(600, 400)
+        self.vbox.set_border_width(5)
+        
+        # command or stage, count, mean, p50, p90, p99, max
+        self._store = gtk.TreeStore(str, int, str, str, str, str, str)
+        treeview = gtk.TreeView(self._store)
+        titles = (_('Command'), _('Count'), _('Mean (ms)'), _('p50'),
+                  _('p90'), _('p99'), _('Max'))
+        for column, title in enumerate(titles):
+            cell = gtk.CellRendererText()
+            treeview.append_column(gtk.TreeViewColumn(title, cell, 
+                                                      text=column))
+        self._treeview = treeview
+        
+        sw = gtk.ScrolledWindow()
+        sw.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        sw.add(treeview)
+        self.vbox.pack_start(sw)
+        
+        self.connect('response', self._response_cb)
+        self.connect('delete-event', lambda w, e: w.hide_on_delete())
+        self.connect('show', self._show_cb)
+        self.connect('hide', self._hide_cb)
+        
+
+    def _response_cb(self, dialog, response):
+        if response == self.RESPONSE_CLEAR:
+            self.stats.clear()
+            self.refresh()
+        else:
+            self.hide()
+            
+            
+    def _show_cb(self, dialog):
+        self.refresh()
+        if self._timeout_id is None:
+            self._timeout_id = gobject.timeout_add(1000, self._timeout_cb)
+            
+            
+    def _hide_cb(self, dialog):
+        if self._timeout_id is not None:
+            gobject.source_remove(self._timeout_id)
+            self._timeout_id = None
+            
+            
+    def _timeout_cb(self):
+        self.refresh()
+        return True
+        
+        
+    def refresh(self):
+        def ms(value):
+            if value is None:
+                return '-'
+            return '%.2f' % (value * 1000)
+            
+        expanded = []
+        self._treeview.map_expanded_rows(
+                    lambda view, path: expanded.append(path))
+        self._store.clear()
+        for command in self.stats.commands():
+            parent = self._store.append(None, (command, 0) + ('',) * 5)
+            for stage, hist in self.stats.stages(command):
+                row = (hist.count, ms(hist.mean()), ms(hist.percentile(50)),
+                       ms(hist.percentile(90)), ms(hist.percentile(99)),
+                       ms(hist.max))
+                if stage == TOTAL:
+                    # the totals go on the row of the command
+                    for column, value in enumerate(row):
+                        self._store.set_value(parent, column + 1, value)
+                else:
+                    self._store.append(parent, (stage,) + row)
+        for path in expanded:
+            self._treeview.expand_row(path, False)
+
+
+
+class RingBuffer(object):
+    """The last size (time, value) pairs, kept in two preallocated
+       arrays so appending never allocates.
+    """
+
+    __slots__ = ('size', 'times', 'values', 'count', 'total')
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array('d', [0.0]) * size
+        self.values = array('d', [0.0]) * size
+        # the number of pairs held, and ever appended
+        self.count = 0
+        self.total = 0
+
+
+    def append(self, t, value):
+        i = self.total % self.size
+        self.times[i] = t
+        self.values[i] = value
+        self.total += 1
+        if self.count < self.size:
+            self.count += 1
+
+
+    def since(self, total):
+        """Returns the (time, value) pairs appended after the first
+           total ones, as far as they are still held."""
+        first = max(total, self.total - self.count)
+        size = self.size
+        return [(self.times[n % size], self.values[n % size]) 
+                for n in xrange(first, self.total)]
+
+
+    def __len__(self):
+        return self.count
+
+
+
+class _Trace(object):
+
+    def __init__(self, label, color, size, minimum, maximum):
+        self.label = label
+        self.color = color
+        self.buffer = RingBuffer(size)
+        self.minimum = minimum
+        self.maximum = maximum
+        # buffer.total when the trace was last drawn
+        self.drawn = 0
+
+
+
+class StripChart(gtk.DrawingArea):
+    """Plots the last seconds of any number of traces, scrolling from
+       right to left. The plot is kept on a surface: every frame the
+       surface is shifted by the time that passed and only the samples
+       that arrived since the previous frame are drawn. Everything is
+       redrawn from the ring buffers when the size or a range changes.
+    """
+    __gtype_name__ = 'StripChart'
+
+    BACKGROUND = (1.0, 1.0, 1.0)
+    COLORS = ((0.80, 0.00, 0.00), (0.20, 0.40, 0.80), (0.30, 0.60, 0.02),
+              (0.96, 0.47, 0.00), (0.46, 0.31, 0.48), (0.76, 0.63, 0.00),
+              (0.00, 0.60, 0.60), (0.34, 0.34, 0.34))
+
+    def __init__(self, seconds=60, size=2048, fps=10):
+        """ @param seconds: the time shown
+            @param size: the number of samples kept per trace
+            @param fps: the number of frames drawn per second
+        """
+        gtk.DrawingArea.__init__(self)
+        self.seconds = seconds
+        self.size = size
+        self.fps = fps
+        self._traces = {}
+        self._order = []
+        self._surface = None
+        self._back = None
+        self._drawn_at = None
+        self._redraw = True
+        self._timeout_id = None
+        
+        self.connect('expose-event', self._expose_cb)
+        self.connect('configure-event', self._configure_cb)
+        
+        
+    def add_trace(self, key, label, minimum=None, maximum=None):
+        """Adds a trace, the range grows to fit the values unless
+           minimum and maximum are given."""
+        if key in self._traces:
+            return
+        color = self.COLORS[len(self._order) % len(self.COLORS)]
+        self._traces[key] = _Trace(label, color, self.size, 
+                                   minimum, maximum)
+        self._order.append(key)
+        
+        
+    def remove_trace(self, key):
+        if key in self._traces:
+            del self._traces[key]
+            self._order.remove(key)
+            self._redraw = True
+            
+            
+    def add_sample(self, key, t, value):
+        trace = self._traces.get(key)
+        if trace is None:
+            return
+        trace.buffer.append(t, value)
+        if trace.minimum is None or value < trace.minimum:
+            trace.minimum = value
+            self._redraw = True
+        if trace.maximum is None or value > trace.maximum:
+            trace.maximum = value
+            self._redraw = True
+            
+            
+    def start(self):
+        if self._timeout_id is None:
+            self._timeout_id = gobject.timeout_add(1000 / self.fps, 
+                                                   self._timeout_cb)
+                                                   
+                                                   
+    def stop(self):
+        if self._timeout_id is not None:
+            gobject.source_remove(self._timeout_id)
+            self._timeout_id = None
+            
+            
+    def _configure_cb(self, widget, event):
+        width, height = self.allocation.width, self.allocation.height
+        self._surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+        self._back = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+        self._redraw = True
+        return False
+        
+        
+    def _timeout_cb(self):
+        if self._surface and self.window:
+            self._draw_frame(time.time())
+            self.queue_draw()
+        return True
+        
+        
+    def _x(self, t, now, width):
+        return width - (now - t) * width / self.seconds
+        
+        
+    def _y(self, trace, value, height):
+        span = trace.maximum - trace.minimum
+        if not span:
+            return height / 2.0
+        # keep a pixel free at the top and the bottom
+        return height - 1 - (value - trace.minimum) * (height - 2) / span
+        
+        
+    def _draw_frame(self, now):
+        width = self._surface.get_width()
+        height = self._surface.get_height()
+        
+        if self._redraw or self._drawn_at is None:
+            ctx = cairo.Context(self._surface)
+            ctx.set_source_rgb(*self.BACKGROUND)
+            ctx.paint()
+            for trace in self._traces.values():
+                trace.drawn = 0
+            self._redraw = False
+            oldest = now - self.seconds
+        else:
+            # shift by whole pixels, the rest is left for the next frame
+            shift = int((now - self._drawn_at) * width / self.seconds)
+            if shift <= 0:
+                return
+            now = self._drawn_at + float(shift) * self.seconds / width
+            self._surface, self._back = self._back, self._surface
+            ctx = cairo.Context(self._surface)
+            ctx.set_source_surface(self._back, -shift, 0)
+            ctx.paint()
+            ctx.set_source_rgb(*self.BACKGROUND)
+            ctx.rectangle(width - shift, 0, shift, height)
+            ctx.fill()
+            oldest = None
+        self._drawn_at = now
+        
+        ctx.set_line_width(1.0)
+        for trace in self._traces.values():
+            # start at the last point drawn so the line continues
+            points = trace.buffer.since(max(trace.drawn - 1, 0))
+            if oldest is not None:
+                points = [point for point in points if point[0] >= oldest]
+            # samples newer than this frame wait for the next one
+            later = 0
+            while later < len(points) and points[-1 - later][0] > now:
+                later += 1
+            trace.drawn = trace.buffer.total - later
+            if later:
+                points = points[:-later]
+            if not points or trace.minimum is None:
+                continue
+            ctx.set_source_rgb(*trace.color)
+            t, value = points[0]
+            ctx.move_to(self._x(t, now, width), self._y(trace, value, height))
+            for t, value in points[1:]:
+                ctx.line_to(self._x(t, now, width), 
+                            self._y(trace, value, height))
+            ctx.stroke()
+            
+            
+    def _expose_cb(self, widget, event):
+        if not self._surface:
+            return False
+        ctx = self.window.cairo_create()
+        ctx.rectangle(event.area.x, event.area.y, 
+                      event.area.width, event.area.height)
+        ctx.clip()
+        ctx.set_source_surface(self._surface, 0, 0)
+        ctx.paint()
+        
+        # the legend is drawn on top so it doesn't scroll
+        ctx.set_font_size(10)
+        y = 12
+        for key in self._order:
+            trace = self._traces[key]
+            buf = trace.buffer
+            if buf.count:
+                text = '%s: %g (%g - %g)' % (trace.label,
+                            buf.values[(buf.total - 1) % buf.size], 
+                            trace.minimum, trace.maximum)
+            else:
+                text = trace.label
+            ctx.set_source_rgb(*trace.color)
+            ctx.move_to(4, y)
+            ctx.show_text(text)
+            y += 12
+        return False
@@ -19,10 +19,17 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor Boston, MA 02110-1301,  USA
 
 
+import os
 import sys
 import serial
 import time
 
+dname = os.path.dirname(__file__)
+if os.path.basename(dname) == 'scripts':
+    sys.path.insert(0, os.path.join(os.path.abspath(dname), '..'))
+
+import garmon.flight_recorder
+
 DEFAULT_PORT = '/dev/ttyUSB1'
 
 
@@ -192,8 +199,17 @@ class ElmSimulator(object):
     def __init__(self, port, baudrate=9600, 
                          size=serial.EIGHTBITS, 
                          parity=serial.PARITY_NONE, 
-                         stopbits=serial.STOPBITS_ONE ):
+                         stopbits=serial.STOPBITS_ONE,
+                         replay=None):
         
+        # responses from a flight recorder dump, per command
+        self.replay = {}
+        if replay:
+            entries = garmon.flight_recorder.load(replay)
+            for command, response in garmon.flight_recorder.conversation(entries):
+                self.replay.setdefault(command.upper(), []).append(response)
+            print 'Replaying %d commands from %s' % (len(self.replay), replay)
+            
         try:
             print 'Opening serial port'
             self.port = serial.Serial(port, 
@@ -233,7 +249,15 @@ class ElmSimulator(object):
             self.port.flushInput()
 
             time.sleep(0.1)
-            if commands.has_key(buf):
+            if self.replay.has_key(buf):
+                # answer in the recorded order, repeat the last answer
+                responses = self.replay[buf]
+                ret = responses[0]
+                if len(responses) > 1:
+                    responses.pop(0)
+                print 'replaying %s' % repr(ret)
+                self.port.write(ret + '>')
+            elif commands.has_key(buf):
                 if buf[:2] == '02':
                     ret = commands[buf]
                 else:
@@ -259,9 +283,13 @@ if __name__ == "__main__":
     except IndexError:
         print 'No port specified'
         port = DEFAULT_PORT
+    try:
+        replay = sys.argv[2]
+    except IndexError:
+        replay = None
     print 'trying port: %s' % port
     try:
-        sim = ElmSimulator(port)
+        sim = ElmSimulator(port, replay=replay)
     except:
         sys.exit(2)
     sim.start()
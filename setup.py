@@ -45,7 +45,8 @@ setup ( name='garmon',
                   'garmon.plugins.dtc_reader',
                   'garmon.plugins.dtc_clearer',
                   'garmon.plugins.live_data',
-                  'garmon.plugins.freeze_frame_data'],
+                  'garmon.plugins.freeze_frame_data',
+                  'garmon.plugins.monitor_tests'],
         package_data={'garmon': ['data/*','locale/*/LC_MESSAGES/*.mo'],
                       'garmon.plugins.dtc_reader': ['*.ui'],
                       'garmon.plugins.freeze_frame_data': ['*.ui'],